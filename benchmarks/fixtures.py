@@ -0,0 +1,374 @@
+"""
+Synthetic inputs for the benchmarks: app bundles, provisioning profiles, and
+stand-ins for the Xcode command line tools fox runs.
+"""
+
+import datetime
+import hashlib
+import os
+import plistlib
+import random
+import stat
+import struct
+import sys
+
+
+TEAM_ID = 'ABCDE12345'
+
+# cputype and cpusubtype of each architecture binaries are built for
+CPU_TYPES = {
+    'armv7': (12, 9),
+    'arm64': (0x0100000c, 0),
+    'x86_64': (0x01000007, 3),
+}
+# architectures the app is built for
+APP_ARCHS = ['armv7', 'arm64']
+
+MH_EXECUTE = 2
+MH_DYLIB = 6
+MH_DSYM = 10
+
+
+## Provisioning profiles
+
+def _der(tag, body):
+    n = len(body)
+    if n < 0x80:
+        length = chr(n)
+    else:
+        length = ''
+        while n:
+            length = chr(n & 0xff) + length
+            n >>= 8
+        length = chr(0x80 | len(length)) + length
+    return chr(tag) + length + body
+
+
+def _oid(dotted):
+    parts = [int(p) for p in dotted.split('.')]
+    body = chr(40 * parts[0] + parts[1])
+    for part in parts[2:]:
+        encoded = chr(part & 0x7f)
+        part >>= 7
+        while part:
+            encoded = chr(0x80 | (part & 0x7f)) + encoded
+            part >>= 7
+        body += encoded
+    return _der(0x06, body)
+
+
+def _signed_data(content):
+    """Wrap `content` in an (unsigned) CMS SignedData envelope."""
+    encap = _der(0x30, _oid('1.2.840.113549.1.7.1') + _der(0xa0, _der(0x04, content)))
+    signed_data = _der(0x30, _der(0x02, '\x01') + _der(0x31, '') + encap + _der(0x31, ''))
+    return _der(0x30, _oid('1.2.840.113549.1.7.2') + _der(0xa0, signed_data))
+
+
+def _certificate(common_name):
+    """An X.509 certificate with `common_name` as its subject, structurally
+    valid but with random keys and signature."""
+    algorithm = _der(0x30, _oid('1.2.840.113549.1.1.11') + _der(0x05, ''))
+    subject = _der(0x30, _der(0x31, _der(0x30, _oid('2.5.4.3') + _der(0x0c, common_name))))
+    tbs = _der(0x30, _der(0xa0, _der(0x02, '\x02')) + _der(0x02, os.urandom(8)) + algorithm +
+               subject + _der(0x30, '') + subject + _der(0x30, os.urandom(270)))
+    return _der(0x30, tbs + algorithm + _der(0x03, '\x00' + os.urandom(256)))
+
+
+def identity_name(i):
+    return 'iPhone Distribution: Bench %d (%s)' % (i, TEAM_ID)
+
+
+def profile_name(i):
+    return 'Bench Profile %d' % (i)
+
+
+def profile_uuid(i):
+    return '00000000-0000-0000-0000-%012d' % (i)
+
+
+def make_profile(path, name, uuid, app_id, identity, expires_in=365):
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    plist = {
+        'Name': name,
+        'UUID': uuid,
+        'TeamIdentifier': [TEAM_ID],
+        'TeamName': 'Bench',
+        'CreationDate': now,
+        'ExpirationDate': now + datetime.timedelta(days=expires_in),
+        'Entitlements': {
+            'application-identifier': app_id,
+            'com.apple.developer.team-identifier': TEAM_ID,
+            'keychain-access-groups': [TEAM_ID + '.*'],
+            'get-task-allow': False,
+        },
+        # real profiles carry certificates and device lists that dwarf the rest
+        'DeveloperCertificates': [plistlib.Data(_certificate(identity))],
+        'ProvisionedDevices': ['%040x' % (random.getrandbits(160)) for i in range(100)],
+    }
+    with open(path, 'wb') as f:
+        f.write(_signed_data(plistlib.writePlistToString(plist)))
+
+
+def make_profiles(directory, count):
+    """Write `count` profiles to `directory`. Every third one has a wildcard
+    app id, profiles alternate between two signing identities, and every
+    tenth one has expired."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for i in range(count):
+        if i % 3 == 0:
+            app_id = '%s.com.example.*' % (TEAM_ID)
+        else:
+            app_id = '%s.com.example.app%d' % (TEAM_ID, i)
+        make_profile(os.path.join(directory, '%s.mobileprovision' % (profile_uuid(i))),
+                     profile_name(i), profile_uuid(i), app_id, identity_name(i % 2),
+                     expires_in=-1 if i % 10 == 9 else 365)
+
+
+## Binaries
+
+def binary_uuid(name, arch):
+    """The LC_UUID of `name` built for `arch`, the same in the app and its
+    dSYM."""
+    return hashlib.md5('%s-%s' % (name, arch)).digest()
+
+
+def macho_binary(name, arch, filetype=MH_EXECUTE, dylibs=(), payload=''):
+    """A little-endian Mach-O image for `arch` with an LC_UUID and an
+    LC_LOAD_DYLIB for each of `dylibs`, followed by `payload`."""
+    cputype, cpusubtype = CPU_TYPES[arch]
+    commands = [struct.pack('<II', 0x1b, 24) + binary_uuid(name, arch)]
+    for dylib in dylibs:
+        size = (24 + len(dylib) + 1 + 7) // 8 * 8
+        commands.append(struct.pack('<IIIIII', 0xc, size, 24, 2, 0x10000, 0x10000) +
+                        dylib.ljust(size - 24, '\0'))
+    commands = ''.join(commands)
+    if cputype & 0x01000000:
+        header = struct.pack('<IiiIIIII', 0xfeedfacf, cputype, cpusubtype, filetype,
+                             len(dylibs) + 1, len(commands), 0, 0)
+    else:
+        header = struct.pack('<IiiIIII', 0xfeedface, cputype, cpusubtype, filetype,
+                             len(dylibs) + 1, len(commands), 0)
+    return header + commands + payload
+
+
+def fat_binary(images, align=14):
+    """A fat binary of `images`, a list of `(arch, image)`, each aligned to
+    `2 ** align` bytes."""
+    header = struct.pack('>II', 0xcafebabe, len(images))
+    body = ''
+    offset = 8 + 20 * len(images)
+    for arch, image in images:
+        start = (offset + (1 << align) - 1) // (1 << align) * (1 << align)
+        body += '\0' * (start - offset) + image
+        header += struct.pack('>iiIII', CPU_TYPES[arch][0], CPU_TYPES[arch][1], start,
+                              len(image), align)
+        offset = start + len(image)
+    return header + body
+
+
+def universal_binary(name, archs, filetype=MH_EXECUTE, dylibs=(), payload=''):
+    """A fat binary with a slice for each of `archs`, splitting `payload`
+    between them, or a thin one for a single arch."""
+    share = len(payload) // len(archs)
+    images = [(arch, macho_binary(name, arch, filetype=filetype, dylibs=dylibs,
+                                  payload=payload[i * share:(i + 1) * share]))
+              for (i, arch) in enumerate(archs)]
+    if len(images) == 1:
+        return images[0][1]
+    return fat_binary(images)
+
+
+## App bundles
+
+def _write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def make_bundle(path, bundle_id, package_type):
+    """Write a small app or app extension bundle, with its own profile, to
+    `path`, for nesting in an app."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    info = {
+        'CFBundleIdentifier': bundle_id,
+        'CFBundleExecutable': name,
+        'CFBundleName': name,
+        'CFBundlePackageType': package_type,
+    }
+    _write(os.path.join(path, 'Info.plist'), plistlib.writePlistToString(info))
+    _write(os.path.join(path, name), universal_binary(name, ['arm64'], payload=os.urandom(1024)))
+    make_profile(os.path.join(path, 'embedded.mobileprovision'), name, profile_uuid(0),
+                 '%s.%s' % (TEAM_ID, bundle_id), identity_name(0))
+    return path
+
+
+def make_app(path, files, total_bytes, seed=0):
+    """
+    Write a synthetic app bundle to `path` with roughly `files` files and
+    `total_bytes` bytes of content: an executable and frameworks that look
+    like Mach-O binaries, a dylib, an app extension and a watch app with an
+    extension of its own, plus resources of which half are incompressible.
+    """
+    rng = random.Random(seed)
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    info = {
+        'CFBundleIdentifier': 'com.example.bench',
+        'CFBundleExecutable': name,
+        'CFBundleName': name,
+        'CFBundleVersion': '42',
+        'CFBundleShortVersionString': '1.0',
+        'CFBundlePackageType': 'APPL',
+    }
+    _write(os.path.join(path, 'Info.plist'), plistlib.writePlistToString(info))
+    _write(os.path.join(path, '_CodeSignature', 'CodeResources'), 'unsigned')
+    _write(os.path.join(path, 'embedded.mobileprovision'), 'placeholder')
+
+    files = max(files - 4, 1)
+    per_file = max(total_bytes // (files + 1), 1)
+
+    def content(i):
+        if i % 2:
+            pattern = ''.join(chr(rng.getrandbits(8)) for j in range(64))
+            return (pattern * (per_file // 64 + 1))[:per_file]
+        return os.urandom(per_file)
+
+    frameworks = max(files // 50, 1)
+    _write(os.path.join(path, name), universal_binary(
+        name, APP_ARCHS, payload=content(0),
+        dylibs=['@rpath/Bench%d.framework/Bench%d' % (i, i) for i in range(frameworks)] +
+               ['/usr/lib/libSystem.B.dylib']))
+
+    # vendor frameworks that still carry simulator slices
+    for i in range(frameworks):
+        fw = 'Bench%d' % (i)
+        _write(os.path.join(path, 'Frameworks', fw + '.framework', fw), universal_binary(
+            fw, APP_ARCHS + ['x86_64'], filetype=MH_DYLIB, payload=content(i)))
+        files -= 1
+
+    _write(os.path.join(path, 'Frameworks', 'libBenchSupport.dylib'), universal_binary(
+        'libBenchSupport', ['arm64'], filetype=MH_DYLIB, payload=content(1)))
+    widget = make_bundle(os.path.join(path, 'PlugIns', 'BenchWidget.appex'),
+                         'com.example.bench.widget', 'XPC!')
+    _write(os.path.join(widget, 'Frameworks', 'BenchWidgetKit.framework', 'BenchWidgetKit'),
+           universal_binary('BenchWidgetKit', APP_ARCHS, filetype=MH_DYLIB))
+    watch = make_bundle(os.path.join(path, 'Watch', 'BenchWatch.app'),
+                        'com.example.bench.watchkitapp', 'APPL')
+    make_bundle(os.path.join(watch, 'PlugIns', 'BenchWatch Extension.appex'),
+                'com.example.bench.watchkitapp.watchkitextension', 'XPC!')
+    files -= 7
+
+    for i in range(max(files, 0)):
+        directory = os.path.join(path, 'Resources', 'Group%d' % (i // 100))
+        _write(os.path.join(directory, 'resource%d.dat' % (i)), content(i))
+
+    return path
+
+
+def make_dsym(path, total_bytes):
+    """Write a synthetic dSYM bundle with a single DWARF file to `path`,
+    whose UUIDs match the app's executable."""
+    name = os.path.splitext(os.path.splitext(os.path.basename(path))[0])[0]
+    _write(os.path.join(path, 'Contents', 'Resources', 'DWARF', name),
+           universal_binary(name, APP_ARCHS, filetype=MH_DSYM, payload=os.urandom(total_bytes)))
+    return path
+
+
+## Tool stand-ins
+
+_XCODEBUILD = r'''
+import os, sys
+
+args = sys.argv[1:]
+symroot = %(srcroot)r + '/build'
+config = 'Debug'
+for i, arg in enumerate(args):
+    if arg.startswith('SYMROOT='):
+        symroot = arg.split('=', 1)[1]
+    if arg in ('-config', '-configuration'):
+        config = args[i + 1]
+
+if '-showBuildSettings' in args:
+    print 'Build settings for action build and target %(app_name)s:'
+    for item in [('BUILT_PRODUCTS_DIR', '%%s/%%s-iphoneos' %% (symroot, config)),
+                 ('CONFIGURATION', config),
+                 ('FULL_PRODUCT_NAME', '%(app_name)s.app'),
+                 ('INFOPLIST_PATH', '%(app_name)s.app/Info.plist'),
+                 ('SRCROOT', %(srcroot)r),
+                 ('WRAPPER_EXTENSION', 'app')]:
+        print '    %%s = %%s' %% item
+    sys.exit(0)
+
+# the products are generated ahead of time, so building is a no-op
+print '** BUILD SUCCEEDED **'
+'''
+
+# With FOX_BENCH_CODESIGN_LOG set, each call appends a JSON line with what it
+# signed, its entitlements and when it started and finished; with
+# FOX_BENCH_CODESIGN_DELAY set, each call takes at least that many seconds.
+_CODESIGN = r'''
+import json, os, sys, time
+
+start = time.time()
+target = sys.argv[-1]
+if os.path.isdir(target):
+    signature = os.path.join(target, '_CodeSignature')
+    if not os.path.isdir(signature):
+        os.makedirs(signature)
+    with open(os.path.join(signature, 'CodeResources'), 'w') as f:
+        f.write('signed')
+else:
+    with open(target, 'ab') as f:
+        f.write('signed')
+time.sleep(float(os.environ.get('FOX_BENCH_CODESIGN_DELAY') or 0))
+print '%%s: replacing existing signature' %% (target)
+
+log = os.environ.get('FOX_BENCH_CODESIGN_LOG')
+if log:
+    args = sys.argv[1:]
+    entitlements = args[args.index('--entitlements') + 1] if '--entitlements' in args else None
+    with open(log, 'a') as f:
+        f.write(json.dumps({'path': target, 'entitlements': entitlements,
+                            'start': start, 'end': time.time()}) + '\n')
+'''
+
+_SECURITY = r'''
+import sys
+
+if sys.argv[1:2] == ['list-keychains'] and '-s' not in sys.argv:
+    print '    "%(keychain)s"'
+'''
+
+
+def install_tools(bin_dir, srcroot, app_name):
+    """
+    Write stand-ins for `xcodebuild`, `codesign` and `security` to
+    `bin_dir`, for putting at the front of PATH.
+    """
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    values = {
+        'srcroot': srcroot,
+        'app_name': app_name,
+        'keychain': os.path.join(bin_dir, 'login.keychain-db'),
+    }
+    for name, source in [('xcodebuild', _XCODEBUILD), ('codesign', _CODESIGN),
+                         ('security', _SECURITY)]:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write('#!%s\n' % (sys.executable))
+            f.write(source % values)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+
+def make_project(srcroot, app_name):
+    """Write a minimal project directory, enough for fox's build settings
+    cache to hash."""
+    _write(os.path.join(srcroot, app_name + '.xcodeproj', 'project.pbxproj'),
+           '// !$*UTF8*$!\n{ archiveVersion = 1; objectVersion = 46; }\n')
+    return os.path.join(srcroot, app_name + '.xcodeproj')
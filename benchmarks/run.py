@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+"""
+Time fox's main operations against synthetic inputs, with stand-ins for the
+Xcode tools on PATH so that only fox's own work is measured.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --baseline results.json --threshold 0.2
+
+Results are written as JSON. With `--baseline`, each benchmark's median is
+compared to the baseline's and the exit status is 1 if any got slower by
+more than the threshold.
+"""
+
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from fox.defaults import defaults
+from fox.ipa import build_ipa, resign_ipa, extract_info
+from fox import provisioningprofile
+
+import fixtures
+
+
+APP_NAME = 'Bench'
+CONFIG = 'Release'
+IDENTITY = 'iPhone Distribution: Bench'
+
+
+class Benchmark(object):
+
+    def __init__(self, name, func, setup=None):
+        self.name = name
+        self.func = func
+        self.setup = setup
+
+
+class Workspace(object):
+    """Synthetic project, app, profiles and tools in a scratch directory."""
+
+    def __init__(self, root, files, total_bytes, profiles):
+        self.root = root
+        self.profiles = profiles
+        self.bin_dir = os.path.join(root, 'bin')
+        self.profile_dir = os.path.join(root, 'Provisioning Profiles')
+        self.cache_dir = os.path.join(root, 'cache')
+        self.srcroot = os.path.join(root, 'src')
+        self.symroot = os.path.join(self.srcroot, 'build')
+        self.output_dir = os.path.join(root, 'out')
+        self.project = fixtures.make_project(self.srcroot, APP_NAME)
+
+        fixtures.install_tools(self.bin_dir, self.srcroot, APP_NAME)
+        fixtures.make_profiles(self.profile_dir, profiles)
+        products = os.path.join(self.symroot, '%s-iphoneos' % (CONFIG))
+        fixtures.make_app(os.path.join(products, APP_NAME + '.app'), files, total_bytes)
+        fixtures.make_dsym(os.path.join(products, APP_NAME + '.app.dSYM'), total_bytes // 4)
+        os.makedirs(self.output_dir)
+
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ.get('PATH', '')
+        defaults['cache_dir'] = self.cache_dir
+        defaults['provisioning_profile_dir'] = self.profile_dir
+
+        self.ipa = None
+
+    def profile_path(self, i):
+        return os.path.join(self.profile_dir, '%s.mobileprovision' % (fixtures.profile_uuid(i)))
+
+    def output(self, name):
+        return os.path.join(self.output_dir, name)
+
+
+def _reset_profile_cache():
+    provisioningprofile._metadata_cache = None
+    provisioningprofile._index = None
+    try:
+        os.remove(os.path.join(defaults['cache_dir'], 'profiles.json'))
+    except OSError:
+        pass
+
+
+# run the fox command line with the workspace's cache and profile directories
+_FOX_MAIN = """
+import json, sys
+from fox.defaults import defaults
+defaults.update(json.loads(sys.argv[1]))
+from fox.cli import main
+main(sys.argv[2:])
+"""
+
+
+def _fox_cmd(args):
+    settings = dict((k, defaults[k]) for k in ('cache_dir', 'provisioning_profile_dir'))
+    return [sys.executable, '-c', _FOX_MAIN, json.dumps(settings)] + list(args)
+
+
+def _fox_env():
+    return dict(os.environ, PYTHONPATH=REPO_ROOT)
+
+
+def _fox(*args):
+    """Run the fox command line in a fresh interpreter."""
+    def run():
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(_fox_cmd(args), env=_fox_env(), stderr=devnull)
+    return run
+
+
+class Daemon(object):
+    """A `fox serve` for the workspace, started on first use."""
+
+    def __init__(self):
+        self.process = None
+
+    def start(self):
+        if self.process is not None:
+            return
+        from fox import client
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(_fox_cmd(['serve']), env=_fox_env(),
+                                            stdout=devnull, stderr=devnull)
+        for i in range(100):
+            s = client.connect()
+            if s is not None:
+                s.close()
+                return
+            time.sleep(0.1)
+        raise RuntimeError("fox serve didn't start")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+
+def benchmarks(ws, daemon):
+    last = ws.profiles - 1
+    find_profiles = ['find-profiles', '--bundle-id', 'com.example.app%d' % (last)]
+
+    def build(**kwargs):
+        return build_ipa(project=ws.project, target=APP_NAME, config=CONFIG,
+                         profile=fixtures.profile_name(0), identity=IDENTITY,
+                         output=ws.output_dir, overwrite=True, build_dir=ws.symroot,
+                         **kwargs)
+
+    def ipa():
+        if ws.ipa is None:
+            ws.ipa = build()
+        return ws.ipa
+
+    def resign(**kwargs):
+        return resign_ipa(ipa=ipa(), profile=fixtures.profile_name(1), identity=IDENTITY,
+                          output=ws.output('resigned.ipa'), **kwargs)
+
+    def resign_variants():
+        return resign_ipa(ipa=ipa(), identity=IDENTITY, variants=[
+            dict(profile=fixtures.profile_name(i), output=ws.output('variant-%d.ipa' % (i)))
+            for i in range(1, 5)])
+
+    return [
+        # interpreter startup on its own, for reference
+        Benchmark('cli.python', lambda: subprocess.check_call([sys.executable, '-c', 'pass'])),
+        Benchmark('cli.version', _fox('--version')),
+        Benchmark('cli.profile_uuid', _fox('profile-uuid', ws.profile_path(last))),
+        Benchmark('cli.help', _fox('--help')),
+        Benchmark('cli.find_profiles', _fox('--no-daemon', *find_profiles)),
+        Benchmark('cli.find_profiles.daemon', _fox(*find_profiles), setup=daemon.start),
+        Benchmark('profiles.scan.cold', provisioningprofile.scan, setup=_reset_profile_cache),
+        Benchmark('profiles.scan.warm', provisioningprofile.scan),
+        Benchmark('profiles.find.cold', lambda: provisioningprofile.find(fixtures.profile_name(last)),
+                  setup=_reset_profile_cache),
+        Benchmark('profiles.find.warm', lambda: provisioningprofile.find(fixtures.profile_name(last))),
+        Benchmark('profiles.find_pattern.warm',
+                  lambda: provisioningprofile.find_all('Bench Profile 1*')),
+        Benchmark('profiles.uuid.warm', lambda: provisioningprofile.uuid(ws.profile_path(last))),
+        Benchmark('profiles.find_best.cold',
+                  lambda: provisioningprofile.find_best('com.example.app%d' % (last),
+                                                        identity=fixtures.identity_name(1)),
+                  setup=_reset_profile_cache),
+        Benchmark('profiles.find_best.warm',
+                  lambda: provisioningprofile.find_best('com.example.app%d' % (last),
+                                                        identity=fixtures.identity_name(1))),
+        Benchmark('build_ipa', build),
+        Benchmark('build_ipa.no_settings_cache', lambda: build(settings_cache=False)),
+        Benchmark('build_ipa.dsym', lambda: build(dsym=True)),
+        Benchmark('build_ipa.incremental', lambda: build(incremental=True)),
+        Benchmark('build_ipa.build_cache', lambda: build(build_cache=True)),
+        Benchmark('build_ipa.thin', lambda: build(thin=['arm64'])),
+        Benchmark('extract_info', lambda: extract_info(ipa())),
+        Benchmark('resign_ipa', resign),
+        Benchmark('resign_ipa.stream', lambda: resign(stream=True)),
+        Benchmark('resign_ipa.variants', resign_variants),
+    ]
+
+
+@contextmanager
+def _quiet():
+    """Send everything written to stdout, by fox or its subprocesses, to
+    /dev/null."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def run_benchmark(bench, repeat, warmup=1):
+    runs = []
+    for i in range(warmup + repeat):
+        if bench.setup is not None:
+            bench.setup()
+        start = time.time()
+        bench.func()
+        if i >= warmup:
+            runs.append(time.time() - start)
+    return {
+        'runs': runs,
+        'min': min(runs),
+        'median': _median(runs),
+        'mean': sum(runs) / len(runs),
+    }
+
+
+def compare(baseline, results, threshold, min_delta=0):
+    """
+    Return a list of `(name, old, new, ratio, regressed)` for benchmarks in
+    both `baseline` and `results`. A benchmark regressed if its median grew
+    by more than `threshold` of the baseline and by more than `min_delta`
+    seconds.
+    """
+    rows = []
+    for name, result in sorted(results['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        ratio = result['median'] / old['median'] if old['median'] else float('inf')
+        regressed = ratio > 1 + threshold and result['median'] - old['median'] > min_delta
+        rows.append((name, old['median'], result['median'], ratio, regressed))
+    return rows
+
+
+def _log(s):
+    sys.stderr.write(s + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fox against synthetic inputs.')
+    parser.add_argument('--files', type=int, default=500,
+            help='Number of files in the app bundle.')
+    parser.add_argument('--megabytes', type=float, default=20,
+            help='Total size of the app bundle.')
+    parser.add_argument('--profiles', type=int, default=200,
+            help='Number of installed provisioning profiles.')
+    parser.add_argument('--repeat', type=int, default=5,
+            help='Timed runs per benchmark, after one untimed warm-up run.')
+    parser.add_argument('--only', action='store', metavar='REGEX',
+            help='Only run benchmarks whose name matches.')
+    parser.add_argument('--output', action='store',
+            help='Write results to this file instead of stdout.')
+    parser.add_argument('--baseline', action='store',
+            help='Results of an earlier run to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.15,
+            help='Fractional slowdown of the median that counts as a regression.')
+    parser.add_argument('--min-delta', type=float, default=0.005,
+            help='Ignore slowdowns of fewer seconds than this, which are mostly noise.')
+    parser.add_argument('--keep', action='store_true', default=False,
+            help='Keep the scratch directory.')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='fox-bench-')
+    daemon = Daemon()
+    try:
+        _log('Generating inputs in %s' % (root))
+        ws = Workspace(root, args.files, int(args.megabytes * 1024 * 1024), args.profiles)
+
+        results = dict()
+        for bench in benchmarks(ws, daemon):
+            if args.only and not re.search(args.only, bench.name):
+                continue
+            with _quiet():
+                result = run_benchmark(bench, args.repeat)
+            results[bench.name] = result
+            _log('%-30s %8.3fs median %8.3fs min' % (bench.name, result['median'], result['min']))
+    finally:
+        daemon.stop()
+        if args.keep:
+            _log('Kept %s' % (root))
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {
+            'files': args.files,
+            'megabytes': args.megabytes,
+            'profiles': args.profiles,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != report['params']:
+            _log('Warning: baseline was run with different parameters: %s' % (baseline.get('params')))
+        rows = compare(baseline, report, args.threshold, args.min_delta)
+        regressions = 0
+        for name, old, new, ratio, regressed in rows:
+            _log('%-30s %8.3fs -> %8.3fs  %+6.1f%%%s' % (
+                name, old, new, (ratio - 1) * 100, '  REGRESSION' if regressed else ''))
+            regressions += regressed
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
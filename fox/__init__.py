@@ -1,4 +1,6 @@
 import logging
 
+__version__ = '0.1.10'
+
 LOG_FORMAT = '%(levelname)s: %(message)s'
 logging.basicConfig(format=LOG_FORMAT)
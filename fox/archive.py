@@ -0,0 +1,599 @@
+"""
+In-process zip packaging. Entries are deflated concurrently in a thread pool
+(zlib releases the GIL while compressing) and written to the archive in order.
+Members of an existing archive can be carried over without recompressing.
+
+`update_archive` also writes a manifest next to the archive recording the
+size, mtime and SHA-1 of each member's source, so the next update can reuse
+the compressed bytes of members that haven't changed.
+"""
+
+from collections import deque
+import errno
+import hashlib
+import json
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import stat
+import struct
+import tempfile
+from tempfile import SpooledTemporaryFile
+import time
+import zipfile
+import zlib
+
+from .cache import write_json_atomic
+from .defaults import defaults
+from .util import makedirs
+from . import trace
+
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+MANIFEST_FORMAT_VERSION = 1
+MSDOS_DIRECTORY = 0x10
+UNIX_SYSTEM = 3
+
+# archives are created with the permissions `open` would give them; the
+# umask can only be read by setting it, so it's read once, at import
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class Entry(object):
+    """
+    A member to be written to an archive. `path` is the file on disk it's
+    read from; `mode` is its full `st_mode`.
+    """
+
+    def __init__(self, arcname, path, mode, mtime):
+        self.arcname = arcname
+        self.path = path
+        self.mode = mode
+        self.mtime = mtime
+        self.sha1 = None  # set once the entry has been read
+
+    def record(self, zinfo):
+        """The manifest record for this entry, once written as `zinfo`."""
+        if self.is_dir():
+            return None
+        return {'size': zinfo.file_size, 'mtime': self.mtime, 'mode': self.mode,
+                'sha1': self.sha1}
+
+    @classmethod
+    def from_path(cls, arcname, path):
+        st = os.lstat(path)
+        if stat.S_ISDIR(st.st_mode) and not arcname.endswith('/'):
+            arcname += '/'
+        return cls(arcname, path, st.st_mode, st.st_mtime)
+
+    @classmethod
+    def directory(cls, arcname, mtime=None):
+        """A directory entry that doesn't exist on disk."""
+        if not arcname.endswith('/'):
+            arcname += '/'
+        return cls(arcname, None, stat.S_IFDIR | 0755,
+                   time.time() if mtime is None else mtime)
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def is_link(self):
+        return stat.S_ISLNK(self.mode)
+
+    def zipinfo(self):
+        date_time = time.localtime(self.mtime)[:6]
+        if date_time[0] < 1980:
+            date_time = (1980, 1, 1, 0, 0, 0)
+        zinfo = zipfile.ZipInfo(self.arcname, date_time)
+        zinfo.create_system = UNIX_SYSTEM
+        zinfo.external_attr = (self.mode & 0xFFFF) << 16
+        if self.is_dir():
+            zinfo.external_attr |= MSDOS_DIRECTORY
+        return zinfo
+
+
+class ZipMember(object):
+    """
+    An existing member of an open `ZipFile`, copied into a new archive as raw
+    compressed bytes along with its CRC.
+    """
+
+    def __init__(self, zf, zinfo, manifest_record=None):
+        self.zf = zf
+        self.source = zinfo
+        self.arcname = zinfo.filename
+        self.manifest_record = manifest_record
+
+    def record(self, zinfo):
+        return self.manifest_record
+
+    def zipinfo(self):
+        src = self.source
+        zinfo = zipfile.ZipInfo(src.filename, src.date_time)
+        zinfo.create_system = src.create_system
+        zinfo.external_attr = src.external_attr
+        zinfo.flag_bits = src.flag_bits & 0x800  # keep the UTF-8 flag only
+        zinfo.compress_type = src.compress_type
+        zinfo.CRC = src.CRC
+        zinfo.file_size = src.file_size
+        zinfo.compress_size = src.compress_size
+        return zinfo
+
+    def open_raw(self):
+        """Position the source archive at this member's data and return it."""
+        fp = self.zf.fp
+        fp.seek(self.source.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile('Bad local file header for %s' % (self.arcname))
+        fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        return fp
+
+
+def tree_entries(root, prefix, follow_external=False):
+    """
+    Yield entries for `root` and everything below it, with arcnames starting
+    at `prefix`. `root` itself is followed if it's a symlink. Symlinks that
+    resolve inside `root` are stored as links. Ones that don't are stored as
+    links too, unless `follow_external`, in which case what they point to
+    is stored in their place, as copying the tree would; a dangling one
+    then raises an OSError.
+    """
+    root = os.path.realpath(root)
+    return _tree_entries(root, prefix, root, follow_external, set([root]))
+
+
+def _tree_entries(path, arcname, root, follow_external, following):
+    entry = Entry.from_path(arcname, path)
+    if entry.is_link() and follow_external:
+        target = os.path.realpath(path)
+        if target != root and not target.startswith(root + os.sep):
+            if not os.path.exists(target):
+                raise OSError(errno.ENOENT, "Symlink '%s' points to '%s', which doesn't exist"
+                              % (path, os.readlink(path)))
+            if target in following:
+                raise OSError(errno.ELOOP, "Symlink '%s' loops back to '%s'" % (path, target))
+            entry = Entry.from_path(arcname, target)
+            path = target
+            following = following | set([target])
+    yield entry
+    if not entry.is_dir():
+        return
+    for name in sorted(os.listdir(path)):
+        for e in _tree_entries(os.path.join(path, name), '%s%s' % (entry.arcname, name),
+                               root, follow_external, following):
+            yield e
+
+
+def overlay_entries(entries, overlays):
+    """
+    Yield `entries`, replacing any whose arcname is a key of `overlays` with
+    the entry it maps to. Overlays that don't replace an existing entry are
+    yielded last.
+    """
+    remaining = dict(overlays)
+    for entry in entries:
+        yield remaining.pop(entry.arcname, entry)
+    for arcname in sorted(remaining):
+        yield remaining[arcname]
+
+
+def _read_chunks(f):
+    while True:
+        chunk = f.read(COPY_BUFFER_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _deflate(entry, compresslevel):
+    """
+    Compress a single entry. Returns the `ZipInfo` and a file-like object
+    positioned at the start of the member's (possibly compressed) data.
+    """
+    zinfo = entry.zipinfo()
+    spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    if entry.is_dir():
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        return zinfo, spool
+
+    if entry.is_link():
+        target = os.readlink(entry.path)
+        entry.sha1 = hashlib.sha1(target).hexdigest()
+        spool.write(target)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.file_size = zinfo.compress_size = len(target)
+        zinfo.CRC = zlib.crc32(target) & 0xffffffff
+        spool.seek(0)
+        return zinfo, spool
+
+    crc = 0
+    file_size = 0
+    digest = hashlib.sha1()
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    with open(entry.path, 'rb') as f:
+        for chunk in _read_chunks(f):
+            crc = zlib.crc32(chunk, crc)
+            digest.update(chunk)
+            file_size += len(chunk)
+            spool.write(compressor.compress(chunk))
+    spool.write(compressor.flush())
+    entry.sha1 = digest.hexdigest()
+    zinfo.CRC = crc & 0xffffffff
+    zinfo.file_size = file_size
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.compress_size = spool.tell()
+
+    if zinfo.compress_size >= file_size:
+        # not worth it, store the data instead
+        spool.close()
+        spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        with open(entry.path, 'rb') as f:
+            shutil.copyfileobj(f, spool, COPY_BUFFER_SIZE)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.compress_size = file_size
+
+    spool.seek(0)
+    return zinfo, spool
+
+
+class HashingWriter(object):
+    """
+    Wraps a file opened for writing, computing the SHA-256 of everything
+    written to it. Writes must be sequential; there's no `seek`.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self._sha256.update(data)
+        self.f.write(data)
+        self.size += len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.f.flush()
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
+def write_raw(zf, zinfo, data):
+    """
+    Write a member whose CRC, sizes and compression type are already set in
+    `zinfo`, copying its already compressed bytes from the file-like `data`.
+    """
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zinfo.header_offset = zf.fp.tell()
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or \
+        zinfo.compress_size > zipfile.ZIP64_LIMIT
+    zf.fp.write(zinfo.FileHeader(zip64))
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        chunk = data.read(min(COPY_BUFFER_SIZE, remaining))
+        if not chunk:
+            raise IOError('Unexpected end of data for %s' % (zinfo.filename))
+        zf.fp.write(chunk)
+        remaining -= len(chunk)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def write_archive(output_path, entries, jobs=None, compresslevel=None, manifest=None):
+    """
+    Write `entries` to a new zip archive at `output_path`, compressing with
+    up to `jobs` threads. `ZipMember` entries are copied without
+    recompressing. The archive is written to a temporary file next to
+    `output_path` and moved into place once complete.
+
+    If `manifest` is a dict, it's filled in with each member's manifest
+    record, keyed by arcname.
+
+    Returns a dict with the archive's path, size, SHA-256 and number of
+    entries. The digest is computed as the archive is written.
+    """
+    jobs = jobs or defaults['package_jobs'] or multiprocessing.cpu_count()
+    if compresslevel is None:
+        compresslevel = defaults['package_compresslevel']
+
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    makedirs(output_dir)
+    # a temp file of our own, so concurrent writers of the same output don't
+    # write into each other's
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir,
+                                    prefix='.%s.' % (os.path.basename(output_path)),
+                                    suffix='.tmp')
+    os.fchmod(fd, 0666 & ~_UMASK)
+
+    pool = ThreadPool(jobs)
+    pending = deque()
+    try:
+        with trace.span('write_archive', path=output_path, jobs=jobs) as span, \
+                os.fdopen(fd, 'wb') as f:
+            out = HashingWriter(f)
+            with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+
+                def write_next():
+                    entry, item = pending.popleft()
+                    if isinstance(entry, ZipMember):
+                        zinfo = entry.zipinfo()
+                        write_raw(zf, zinfo, entry.open_raw())
+                    else:
+                        zinfo, spool = item.get()
+                        try:
+                            write_raw(zf, zinfo, spool)
+                        finally:
+                            spool.close()
+                    if manifest is not None:
+                        record = entry.record(zinfo)
+                        if record is not None:
+                            manifest[zinfo.filename] = record
+
+                for entry in entries:
+                    if isinstance(entry, ZipMember):
+                        pending.append((entry, None))
+                    else:
+                        pending.append((entry, pool.apply_async(
+                            _deflate, (entry, compresslevel))))
+                    # bound the number of compressed entries held at once
+                    if len(pending) >= jobs * 2:
+                        write_next()
+                while pending:
+                    write_next()
+
+            span.set(entries=len(zf.filelist),
+                     bytes_in=sum(zinfo.file_size for zinfo in zf.filelist),
+                     bytes_out=out.size)
+
+        os.rename(tmp_path, output_path)
+    except:
+        pool.terminate()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    return {'path': output_path, 'size': out.size, 'sha256': out.hexdigest(),
+            'entries': len(zf.filelist)}
+
+
+def _safe_path(dest, arcname):
+    path = os.path.normpath(os.path.join(dest, *arcname.split('/')))
+    if not path.startswith(os.path.join(dest, '')):
+        raise zipfile.BadZipfile("Refusing to extract '%s' outside of '%s'" % (arcname, dest))
+    return path
+
+
+def extract_archive(path, dest):
+    """
+    Extract the archive at `path` into `dest`, restoring symlinks, Unix
+    permissions and the mtimes of files and directories. Symlinks are
+    created last, and nothing is created in or through a directory that
+    resolves outside of `dest`, so a member can't use a link from the
+    archive, or one already in `dest`, to escape it.
+    """
+    dest = os.path.abspath(dest)
+    makedirs(dest)
+    real_dest = os.path.realpath(dest)
+    links = []
+    directories = []
+    with trace.span('extract_archive', path=path) as span, zipfile.ZipFile(path) as zf:
+        span.set(entries=len(zf.filelist),
+                 bytes_in=os.path.getsize(path),
+                 bytes_out=sum(zinfo.file_size for zinfo in zf.filelist))
+        for zinfo in zf.infolist():
+            target = _safe_path(dest, zinfo.filename)
+            mode = zinfo.external_attr >> 16
+            if zinfo.filename.endswith('/'):
+                _makedirs_inside(real_dest, target, zinfo.filename)
+                directories.append((target, _zip_mtime(zinfo)))
+                continue
+            _makedirs_inside(real_dest, os.path.dirname(target), zinfo.filename)
+            if stat.S_ISLNK(mode):
+                links.append((zf.read(zinfo), target, zinfo.filename))
+                continue
+            with zf.open(zinfo) as src:
+                with open(target, 'wb') as f:
+                    shutil.copyfileobj(src, f, COPY_BUFFER_SIZE)
+            if mode & 0777:
+                os.chmod(target, mode & 0777)
+            mtime = _zip_mtime(zinfo)
+            os.utime(target, (mtime, mtime))
+
+        for link_target, target, arcname in links:
+            _check_inside(real_dest, os.path.dirname(target), arcname)
+            if os.path.lexists(target):
+                raise zipfile.BadZipfile("Symlink '%s' conflicts with another member" % (arcname))
+            os.symlink(link_target, target)
+
+        # last, since creating anything in a directory changes its mtime
+        for target, mtime in directories:
+            os.utime(target, (mtime, mtime))
+
+
+def _zip_mtime(zinfo):
+    """The mtime of a member, whose date and time are local."""
+    return time.mktime(zinfo.date_time + (0, 0, -1))
+
+
+def _makedirs_inside(real_dest, directory, arcname):
+    """Create `directory` after checking that the deepest part of it that
+    already exists is inside `real_dest`."""
+    existing = directory
+    while not os.path.lexists(existing):
+        existing = os.path.dirname(existing)
+    _check_inside(real_dest, existing, arcname)
+    makedirs(directory)
+
+
+def _check_inside(real_dest, directory, arcname):
+    real = os.path.realpath(directory)
+    if real != real_dest and not real.startswith(os.path.join(real_dest, '')):
+        raise zipfile.BadZipfile("Refusing to extract '%s' outside of '%s'" % (arcname, real_dest))
+
+
+def _stat_signature(path):
+    st = os.lstat(path)
+    return (st.st_size, st.st_mtime, st.st_ctime, st.st_ino, st.st_mode)
+
+
+def snapshot(root, prefix):
+    """
+    Record the state of every entry under `root`, keyed by arcname, so
+    `rewrite_archive` can tell which ones were modified later.
+    """
+    return dict((e.arcname, _stat_signature(e.path))
+                for e in tree_entries(root, prefix))
+
+
+def rewrite_archive(src_path, output_path, root, prefix, before, changed=(),
+                    jobs=None, compresslevel=None):
+    """
+    Write a new archive at `output_path` from the tree at `root`, which was
+    extracted from `src_path` when `before` was taken with `snapshot`.
+    Members that are unchanged on disk are copied from `src_path` as raw
+    compressed bytes; modified and new ones are compressed again, and ones
+    that were deleted are dropped. Arcnames in `changed` are always treated
+    as modified, as are entries below `changed` directories.
+    """
+    current = dict((e.arcname, e) for e in tree_entries(root, prefix))
+    changed = tuple(changed)
+
+    def is_changed(arcname):
+        for c in changed:
+            if arcname == c or (c.endswith('/') and arcname.startswith(c)):
+                return True
+        entry = current[arcname]
+        return before.get(arcname) != _stat_signature(entry.path)
+
+    with zipfile.ZipFile(src_path) as src:
+        def entries():
+            seen = set()
+            for zinfo in src.infolist():
+                arcname = zinfo.filename
+                if arcname not in current or arcname in seen:
+                    continue
+                seen.add(arcname)
+                if is_changed(arcname):
+                    yield current[arcname]
+                else:
+                    yield ZipMember(src, zinfo)
+            for arcname in sorted(current):
+                if arcname not in seen:
+                    yield current[arcname]
+
+        write_archive(output_path, entries(), jobs=jobs, compresslevel=compresslevel)
+
+
+def manifest_path(archive_path):
+    return archive_path + '.manifest.json'
+
+
+def read_manifest(archive_path, compresslevel):
+    """
+    Return the member records from the manifest of the archive at
+    `archive_path`, or None if there's no usable manifest: it's missing,
+    was written for a different version of the archive, or with a
+    different compression level.
+    """
+    try:
+        with open(manifest_path(archive_path)) as f:
+            manifest = json.load(f)
+        st = os.stat(archive_path)
+    except (IOError, OSError, ValueError), e:
+        logger.debug("Not using manifest for '%s': %s" % (archive_path, e))
+        return None
+    if manifest.get('version') != MANIFEST_FORMAT_VERSION or \
+            manifest.get('archive') != {'size': st.st_size, 'mtime': st.st_mtime} or \
+            manifest.get('compresslevel') != compresslevel:
+        logger.debug("Manifest for '%s' is out of date" % (archive_path))
+        return None
+    return manifest['entries']
+
+
+def _file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in _read_chunks(f):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _unchanged(entry, record):
+    """Whether `entry` has the contents recorded in `record`. Files whose
+    size matches but whose mtime doesn't are compared by hash."""
+    if entry.is_dir() or entry.is_link() or entry.mode != record['mode']:
+        return False
+    st = os.stat(entry.path)
+    if st.st_size != record['size']:
+        return False
+    if st.st_mtime == record['mtime']:
+        return True
+    return _file_sha1(entry.path) == record['sha1']
+
+
+def update_archive(output_path, entries, reuse=True, jobs=None, compresslevel=None):
+    """
+    Write `entries` to an archive at `output_path` along with its manifest.
+    With `reuse`, members of the archive already at `output_path` whose
+    sources are unchanged according to its manifest are copied over without
+    recompressing, so the work done is proportional to what changed.
+    Returns the result of `write_archive`.
+    """
+    if compresslevel is None:
+        compresslevel = defaults['package_compresslevel']
+
+    records = read_manifest(output_path, compresslevel) if reuse else None
+    manifest = dict()
+
+    with trace.span('update_archive', path=output_path) as span:
+        if records is None:
+            span.set(reused=0)
+            result = write_archive(output_path, entries, jobs=jobs, compresslevel=compresslevel,
+                          manifest=manifest)
+        else:
+            with zipfile.ZipFile(output_path) as previous:
+                reused = []
+
+                def reusing(entries):
+                    for entry in entries:
+                        record = records.get(entry.arcname)
+                        zinfo = previous.NameToInfo.get(entry.arcname)
+                        if record is not None and zinfo is not None and _unchanged(entry, record):
+                            record = dict(record, mtime=entry.mtime)
+                            reused.append(entry.arcname)
+                            yield ZipMember(previous, zinfo, manifest_record=record)
+                        else:
+                            yield entry
+
+                result = write_archive(output_path, reusing(entries), jobs=jobs,
+                                       compresslevel=compresslevel, manifest=manifest)
+            logger.info("Reused %d of %d members of '%s'" % (
+                len(reused), len(manifest), output_path))
+            span.set(reused=len(reused))
+
+        st = os.stat(output_path)
+        write_json_atomic(manifest_path(output_path), {
+            'version': MANIFEST_FORMAT_VERSION,
+            'archive': {'size': st.st_size, 'mtime': st.st_mtime},
+            'compresslevel': compresslevel,
+            'entries': manifest,
+        })
+    return result
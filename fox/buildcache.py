@@ -0,0 +1,320 @@
+"""
+A local, content-addressed store of build outputs. Each build is keyed on a
+hash of its inputs: the contents of the source tree, the resolved build
+settings and arguments, the profile and identity, the selected Xcode and
+the version of fox. Artifacts are stored once per SHA-256, so identical IPAs
+built by different keys share storage. The least recently used builds are
+evicted once the store grows past `defaults['build_cache_max_size']`.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from . import __version__
+from . import buildsettings
+from .cache import FileMetadataCache, write_json_atomic
+from .defaults import defaults
+from .util import file_lock, makedirs
+
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+CACHE_FORMAT_VERSION = 1
+
+# directories in the source tree that hold build outputs or VCS metadata
+_SKIP_DIRS = ('.git', '.hg', '.svn', 'build', 'DerivedData', 'xcuserdata')
+# fox's own outputs, which may be written inside the source tree
+_SKIP_SUFFIXES = ('.ipa', '.dSYM.zip', '.manifest.json', '.artifacts.json')
+
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+_hash_cache = None
+
+
+def _source_hashes():
+    global _hash_cache
+    cache_path = os.path.join(defaults['cache_dir'], 'source-hashes.json')
+    if _hash_cache is None or _hash_cache.cache_path != cache_path:
+        _hash_cache = FileMetadataCache(cache_path, _file_sha1)
+    return _hash_cache
+
+
+def source_tree_digest(root, exclude=()):
+    """
+    Return a hash of the names and contents of the files below `root`,
+    skipping build and VCS directories and anything under `exclude`.
+    Content hashes are cached and only recomputed for changed files.
+    """
+    exclude = [os.path.join(os.path.abspath(p), '') for p in exclude if p]
+    hashes = _source_hashes()
+    h = hashlib.sha1()
+    root = os.path.abspath(root)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in _SKIP_DIRS and
+                             not any(os.path.join(dirpath, d, '').startswith(e) for e in exclude))
+        for name in sorted(filenames):
+            if name == '.DS_Store' or name.endswith(_SKIP_SUFFIXES):
+                continue
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            if os.path.islink(path):
+                h.update('link:%s:%s\0' % (rel, os.readlink(path)))
+            else:
+                h.update('file:%s:%s\0' % (rel, hashes.get(path)))
+    hashes.save()
+    return h.hexdigest()
+
+
+def build_key(source_root, build_settings_output, build_args, profile_uuid, identity,
+              exclude=(), replacements=()):
+    """
+    Return the cache key for a build. `replacements` is a list of `(path,
+    placeholder)` substituted in the build settings and arguments, so that
+    builds differing only in where their products go share a key.
+    """
+    def normalize(s):
+        for path, placeholder in replacements:
+            if path:
+                s = s.replace(path, placeholder)
+        return s
+
+    h = hashlib.sha1()
+    h.update('fox:%s\0' % (__version__))
+    developer_dir = buildsettings._developer_dir()
+    h.update('developer_dir:%s\0' % (developer_dir))
+    if developer_dir is not None:
+        version_plist = os.path.join(os.path.dirname(developer_dir), 'version.plist')
+        if os.path.exists(version_plist):
+            h.update('xcode:%s\0' % (_file_sha1(version_plist)))
+    for arg in build_args:
+        h.update('arg:%s\0' % (normalize(arg)))
+    h.update('settings:%s\0' % (normalize(build_settings_output)))
+    h.update('profile:%s\0' % (profile_uuid))
+    h.update('identity:%s\0' % (identity))
+    h.update('source:%s\0' % (source_tree_digest(source_root, exclude=exclude)))
+    return h.hexdigest()
+
+
+class BuildCache(object):
+    """
+    Builds are recorded in `entries/<key>.json`, which maps artifact names
+    to the SHA-256 of their content in `objects/`. An entry's mtime is its
+    last use.
+    """
+
+    def __init__(self, root=None, max_size=None):
+        self.root = root or os.path.join(defaults['cache_dir'], 'builds')
+        self.max_size = max_size if max_size is not None else defaults['build_cache_max_size']
+        self.entries_dir = os.path.join(self.root, 'entries')
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.stats_path = os.path.join(self.root, 'stats.json')
+
+    def _lock(self):
+        return file_lock(os.path.join(self.root, 'lock'))
+
+    def _entry_path(self, key):
+        return os.path.join(self.entries_dir, key + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def lookup(self, key):
+        """Return the entry for `key`, or None."""
+        try:
+            with open(self._entry_path(key)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('version') != CACHE_FORMAT_VERSION:
+            return None
+        return entry
+
+    def restore(self, key, entry, paths):
+        """
+        Copy the artifacts of `entry` to `paths`, a dict of artifact name to
+        destination, and record the hit. Returns False, and records a miss,
+        if any artifact is missing or corrupt.
+        """
+        for name, dest in paths.items():
+            artifact = entry['artifacts'].get(name)
+            if artifact is None or not self._copy_out(artifact['sha256'], dest):
+                logger.warning("Build cache entry %s is incomplete, rebuilding" % (key))
+                self.record_miss()
+                return False
+
+        now = time.time()
+        for name in paths:
+            try:
+                os.utime(self._object_path(entry['artifacts'][name]['sha256']), (now, now))
+            except OSError:
+                pass
+        try:
+            os.utime(self._entry_path(key), (now, now))
+        except OSError:
+            pass
+        self._update_stats(hits=1, bytes_saved=sum(entry['artifacts'][name]['size'] for name in paths),
+                           seconds_saved=entry.get('duration') or 0)
+        return True
+
+    def _copy_out(self, digest, dest):
+        makedirs(os.path.dirname(os.path.abspath(dest)))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)),
+                                        prefix='.fox-restore-')
+        try:
+            h = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                with open(self._object_path(digest), 'rb') as src:
+                    for chunk in iter(lambda: src.read(COPY_BUFFER_SIZE), ''):
+                        h.update(chunk)
+                        f.write(chunk)
+            if h.hexdigest() != digest:
+                raise IOError("Cached object %s is corrupt" % (digest))
+            os.rename(tmp_path, dest)
+            return True
+        except (IOError, OSError), e:
+            logger.debug("Couldn't restore %s: %s" % (digest, e))
+            os.remove(tmp_path)
+            return False
+
+    def _store_object(self, path):
+        """Copy the file at `path` into the store and return its digest and
+        size."""
+        makedirs(self.objects_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, prefix='.tmp-')
+        try:
+            h = hashlib.sha256()
+            size = 0
+            with open(path, 'rb') as src:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in iter(lambda: src.read(COPY_BUFFER_SIZE), ''):
+                        h.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+            digest = h.hexdigest()
+            makedirs(os.path.dirname(self._object_path(digest)))
+            os.rename(tmp_path, self._object_path(digest))
+            return digest, size
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def store(self, key, artifacts, info=None, duration=None):
+        """
+        Add a build to the store. `artifacts` is a dict of artifact name to
+        path; `info` is kept with the entry. The entry is only published
+        once all of its artifacts are in place.
+        """
+        with self._lock():
+            stored = dict()
+            for name, path in artifacts.items():
+                digest, size = self._store_object(path)
+                stored[name] = {'sha256': digest, 'size': size,
+                                'name': os.path.basename(path)}
+            write_json_atomic(self._entry_path(key), {
+                'version': CACHE_FORMAT_VERSION,
+                'created': time.time(),
+                'duration': duration,
+                'artifacts': stored,
+                'info': info or {},
+            })
+            self._evict()
+
+    def _entries(self):
+        """Return a list of `(path, entry)`, least recently used first."""
+        if not os.path.isdir(self.entries_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.entries_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.entries_dir, name)
+            try:
+                with open(path) as f:
+                    entries.append((os.path.getmtime(path), path, json.load(f)))
+            except (IOError, OSError, ValueError):
+                continue
+        entries.sort()
+        return [(path, entry) for (mtime, path, entry) in entries]
+
+    def _objects(self):
+        """Return a dict of digest to size for every stored object."""
+        objects = dict()
+        if not os.path.isdir(self.objects_dir):
+            return objects
+        for dirpath, dirnames, filenames in os.walk(self.objects_dir):
+            for name in filenames:
+                if not name.startswith('.'):
+                    objects[name] = os.path.getsize(os.path.join(dirpath, name))
+        return objects
+
+    def _evict(self):
+        """Drop least recently used entries until the objects still
+        referenced fit in `max_size`, then delete unreferenced objects.
+        Must be called with the lock held."""
+        entries = self._entries()
+        objects = self._objects()
+
+        def referenced(entries):
+            return set(a['sha256'] for (path, entry) in entries
+                       for a in entry.get('artifacts', {}).values())
+
+        live = referenced(entries)
+        while entries and sum(objects.get(d, 0) for d in live) > self.max_size:
+            path, entry = entries.pop(0)
+            logger.info("Evicting build %s from the build cache" % (os.path.basename(path)))
+            os.remove(path)
+            self._update_stats(evictions=1)
+            live = referenced(entries)
+
+        for digest in objects:
+            if digest not in live:
+                try:
+                    os.remove(self._object_path(digest))
+                except OSError:
+                    pass
+
+    def record_miss(self):
+        self._update_stats(misses=1)
+
+    def _read_stats(self):
+        try:
+            with open(self.stats_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _update_stats(self, **counts):
+        with file_lock(os.path.join(self.root, 'stats.lock')):
+            stats = self._read_stats()
+            for name, count in counts.items():
+                stats[name] = stats.get(name, 0) + count
+            write_json_atomic(self.stats_path, stats)
+
+    def stats(self):
+        """Return a dict of counters and the current size of the store."""
+        stats = dict(hits=0, misses=0, evictions=0, bytes_saved=0, seconds_saved=0)
+        stats.update(self._read_stats())
+        stats['entries'] = len(self._entries())
+        stats['size'] = sum(self._objects().values())
+        stats['max_size'] = self.max_size
+        return stats
+
+    def clear(self):
+        """Remove every build from the store. Counters are kept."""
+        with self._lock():
+            for directory in (self.entries_dir, self.objects_dir):
+                if os.path.isdir(directory):
+                    shutil.rmtree(directory)
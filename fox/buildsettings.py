@@ -0,0 +1,240 @@
+"""
+Running `xcodebuild -showBuildSettings` and parsing its output, with results
+cached on disk. The cache key covers the exact arguments, the selected Xcode,
+and the contents of the files that can change build settings: project files,
+xcconfigs and schemes.
+"""
+
+from collections import OrderedDict
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+
+from .cache import write_file_atomic
+from .defaults import defaults
+from .helpers import shellify, puts, TerminalSink
+from . import executor
+from . import helpers
+from . import trace
+
+
+logger = logging.getLogger(__name__)
+
+XCODE_SELECT_LINK = '/var/db/xcode_select_link'
+
+# directories that never contain xcconfigs worth tracking
+_SKIP_DIRS = ('build', 'DerivedData')
+_SKIP_EXTS = ('.xcodeproj', '.xcworkspace', '.xcassets', '.app', '.framework',
+              '.bundle', '.lproj', '.dSYM')
+
+# match lines like this:
+#     Build settings for action build and target MyApp:
+_SECTION_RE = re.compile(r'^Build settings for action (\S+) and target "?(.+?)"?:\s*$')
+
+# match lines like this:
+#     KEY = VAL
+_SETTING_RE = re.compile(r'^\s+(\S+) =(?: (.*))?$')
+
+_WORKSPACE_FILEREF_RE = re.compile(r'location\s*=\s*"(group|container|absolute):([^"]+\.xcodeproj)"')
+
+
+def _scheme_files(container):
+    return (glob.glob(os.path.join(container, 'xcshareddata', 'xcschemes', '*.xcscheme')) +
+            glob.glob(os.path.join(container, 'xcuserdata', '*', 'xcschemes', '*')))
+
+
+def _workspace_projects(workspace):
+    contents = os.path.join(workspace, 'contents.xcworkspacedata')
+    if not os.path.exists(contents):
+        return []
+    with open(contents) as f:
+        data = f.read()
+    base = os.path.dirname(os.path.abspath(workspace))
+    projects = []
+    for kind, location in _WORKSPACE_FILEREF_RE.findall(data):
+        if kind == 'absolute':
+            projects.append(location)
+        else:
+            projects.append(os.path.join(base, location))
+    return projects
+
+
+def _xcconfig_files(root):
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames
+                       if not d.startswith('.') and d not in _SKIP_DIRS and
+                       os.path.splitext(d)[1] not in _SKIP_EXTS]
+        found.extend(os.path.join(dirpath, f) for f in filenames if f.endswith('.xcconfig'))
+    return found
+
+
+def input_files(workspace=None, project=None):
+    """Return the sorted paths of the files whose contents determine the
+    build settings of `workspace` or `project`."""
+    files = []
+    projects = []
+    if workspace is not None:
+        files.append(os.path.join(workspace, 'contents.xcworkspacedata'))
+        files.extend(_scheme_files(workspace))
+        projects.extend(_workspace_projects(workspace))
+    if project is not None:
+        projects.append(project)
+
+    for p in projects:
+        files.append(os.path.join(p, 'project.pbxproj'))
+        files.extend(_scheme_files(p))
+
+    root = os.path.dirname(os.path.abspath(workspace or project))
+    files.extend(_xcconfig_files(root))
+    return sorted(set(os.path.abspath(f) for f in files if os.path.isfile(f)))
+
+
+def _developer_dir():
+    developer_dir = (helpers.command_env() or os.environ).get('DEVELOPER_DIR')
+    if developer_dir is None and os.path.exists(XCODE_SELECT_LINK):
+        developer_dir = os.path.realpath(XCODE_SELECT_LINK)
+    return developer_dir
+
+
+def cache_key(build_args, workspace=None, project=None):
+    h = hashlib.sha1()
+    for arg in build_args:
+        h.update('arg:%s\0' % (arg))
+
+    developer_dir = _developer_dir()
+    if developer_dir is not None:
+        h.update('developer_dir:%s\0' % (developer_dir))
+        version_plist = os.path.join(os.path.dirname(developer_dir), 'version.plist')
+        if os.path.exists(version_plist):
+            st = os.stat(version_plist)
+            h.update('xcode:%r:%r\0' % (st.st_mtime, st.st_size))
+
+    for path in input_files(workspace=workspace, project=project):
+        with open(path, 'rb') as f:
+            h.update('file:%s:%s\0' % (path, hashlib.sha1(f.read()).hexdigest()))
+    return h.hexdigest()
+
+
+def _cache_dir():
+    return os.path.join(defaults['cache_dir'], 'build-settings')
+
+
+def _prune(directory, keep):
+    entries = [os.path.join(directory, f) for f in os.listdir(directory)
+               if not f.startswith('.')]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for path in entries[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def show_build_settings(build_args, workspace=None, project=None, use_cache=True):
+    """
+    Return the output of `xcodebuild -showBuildSettings` for `build_args`,
+    from the cache if none of its inputs have changed. Pass `use_cache=False`
+    to always run xcodebuild.
+    """
+    with trace.span('show_build_settings') as span:
+        return _show_build_settings(build_args, workspace, project, use_cache, span)
+
+
+def _show_build_settings(build_args, workspace, project, use_cache, span):
+    cmd = ['xcodebuild', '-showBuildSettings'] + build_args
+
+    use_cache = use_cache and defaults['build_settings_cache']
+    if use_cache:
+        key = cache_key(build_args, workspace=workspace, project=project)
+        cache_path = os.path.join(_cache_dir(), key)
+        try:
+            with open(cache_path) as f:
+                output = f.read()
+            os.utime(cache_path, None)
+            logger.info('Build settings cache hit (%s)' % (key))
+            span.set(cache='hit')
+            return output
+        except IOError:
+            logger.info('Build settings cache miss (%s)' % (key))
+            span.set(cache='miss')
+
+    puts(shellify(cmd))
+    output = executor.output(cmd, stderr=[TerminalSink()])
+    span.set(exit_code=0)
+
+    if use_cache:
+        try:
+            write_file_atomic(cache_path, output)
+            _prune(_cache_dir(), defaults['build_settings_cache_size'])
+        except (IOError, OSError), e:
+            logger.warning("Couldn't write build settings cache: %s" % (e))
+
+    return output
+
+
+def parse_build_settings(output):
+    """
+    Parse the output of `xcodebuild -showBuildSettings`, either as text or
+    as JSON (`-json`), into an ordered dict of target name to that target's
+    settings. Values are kept whole, even if they contain '='.
+    """
+    if output.lstrip().startswith('['):
+        targets = OrderedDict()
+        for section in json.loads(output):
+            targets.setdefault(section.get('target'), {}).update(section['buildSettings'])
+        return targets
+
+    targets = OrderedDict()
+    settings = None
+    for l in output.splitlines():
+        m = _SECTION_RE.match(l)
+        if m is not None:
+            settings = targets.setdefault(m.group(2), {})
+            continue
+        m = _SETTING_RE.match(l)
+        if m is not None:
+            if settings is None:
+                # no section header, as printed by some older versions of Xcode
+                settings = targets.setdefault(None, {})
+            settings[m.group(1)] = (m.group(2) or '').rstrip()
+    return targets
+
+
+def select_target(targets, target=None):
+    """
+    Pick one target's settings from the result of `parse_build_settings`:
+    `target` if given, otherwise the first application target, otherwise the
+    first target.
+    """
+    if target is not None and target in targets:
+        return targets[target]
+    for settings in targets.values():
+        if settings.get('WRAPPER_EXTENSION') == 'app':
+            return settings
+    for settings in targets.values():
+        return settings
+    return {}
+
+
+def all_build_settings(workspace=None, scheme=None, project=None, config=None,
+                       sdk='iphoneos', extra_args=None, use_cache=True):
+    """
+    Return the settings of every target of `project` (or every target built
+    by `scheme` in `workspace`) for `config`, from a single xcodebuild call.
+    """
+    build_args = ['-sdk', sdk]
+    if config is not None:
+        build_args.extend(['-configuration', config])
+    if workspace is not None:
+        build_args.extend(['-workspace', workspace, '-scheme', scheme])
+    elif scheme is not None:
+        build_args.extend(['-project', project, '-scheme', scheme])
+    else:
+        build_args.extend(['-project', project, '-alltargets'])
+    build_args.extend(extra_args or [])
+    return parse_build_settings(show_build_settings(
+        build_args, workspace=workspace, project=project, use_cache=use_cache))
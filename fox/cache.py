@@ -0,0 +1,129 @@
+import datetime
+import json
+import logging
+import os
+import tempfile
+
+from .util import makedirs
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 2
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    if hasattr(obj, 'data'):  # plistlib.Data
+        return obj.data.encode('base64')
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size]
+
+
+def write_file_atomic(path, data):
+    """Write `data` to `path` via a temp file and rename, so readers never
+    see a partially written file."""
+    directory = os.path.dirname(path)
+    makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def write_json_atomic(path, obj):
+    write_file_atomic(path, json.dumps(obj, default=_json_default))
+
+
+class FileMetadataCache(object):
+    """
+    A persistent cache of metadata derived from files, keyed on the file's
+    path, mtime and size. `loader` is called with a path and must return a
+    JSON-serializable value; it's only called when a file is new or changed.
+    """
+
+    def __init__(self, cache_path, loader):
+        self.cache_path = cache_path
+        self.loader = loader
+        self._entries = None
+        self._dirty = False
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = dict()
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+            if data.get('version') == CACHE_FORMAT_VERSION:
+                self._entries = data['entries']
+        except (IOError, OSError, ValueError, KeyError), e:
+            logger.debug("Not using cache '%s': %s" % (self.cache_path, e))
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            write_json_atomic(self.cache_path, {
+                'version': CACHE_FORMAT_VERSION,
+                'entries': self._entries,
+            })
+            self._dirty = False
+        except (IOError, OSError), e:
+            logger.warning("Couldn't write cache '%s': %s" % (self.cache_path, e))
+
+    def _evict(self, path):
+        if self._entries.pop(path, None) is not None:
+            self._dirty = True
+
+    def get(self, path):
+        """Return the metadata for `path`, reloading it if the file changed."""
+        self._load()
+        path = os.path.abspath(path)
+        try:
+            key = _stat_key(path)
+        except OSError:
+            self._evict(path)
+            raise
+        entry = self._entries.get(path)
+        if entry is None or entry['key'] != key:
+            # round-trip through JSON so fresh and cached values look alike
+            value = json.loads(json.dumps(self.loader(path), default=_json_default))
+            entry = {'key': key, 'value': value}
+            self._entries[path] = entry
+            self._dirty = True
+        return entry['value']
+
+    def scan(self, directory, predicate=None):
+        """
+        Return a list of `(path, metadata)` for the files in `directory` that
+        satisfy `predicate`. Entries for files that no longer exist in
+        `directory` are evicted.
+        """
+        self._load()
+        directory = os.path.abspath(directory)
+        results = []
+        seen = set()
+        for f in sorted(os.listdir(directory)):
+            if predicate is not None and not predicate(f):
+                continue
+            path = os.path.join(directory, f)
+            try:
+                results.append((path, self.get(path)))
+            except OSError:
+                continue
+            seen.add(path)
+        for path in self._entries.keys():
+            if os.path.dirname(path) == directory and path not in seen:
+                self._evict(path)
+        self.save()
+        return results
@@ -1,18 +1,46 @@
+"""
+The fox command line. Small commands are run from scripts in tight loops, so
+startup is kept cheap: each subcommand's handler imports what it needs, and
+only the selected subcommand's arguments are set up.
+"""
+
 import argparse
 import logging
-import toml
+import os
+import sys
 
+from . import __version__
 from .defaults import defaults
-from .ipa import build_ipa, resign_ipa
-from .keychain import install_keychain, unlock_keychain
-from . import provisioningprofile
 
 
 logger = logging.getLogger(__name__)
 
+# global options, for finding them and the subcommand in argv
+_GLOBAL_LONG_OPTIONS = ('--verbose', '--trace', '--no-daemon', '--version')
+_GLOBAL_OPTIONS_WITH_VALUES = ('-C', '--trace')
+
+
+def set_log_level(level):
+    """Log messages of `level` and above. `fox serve` replaces this so that
+    it only applies to the request being run."""
+    logging.getLogger().setLevel(level)
+
+
+_fox_configs = dict()
+
 
 def load_fox_config(fox_config_path):
-    return toml.load(fox_config_path)
+    """Parse the fox config at `fox_config_path`. The result is kept until
+    the file changes."""
+    import copy
+    path = os.path.abspath(os.path.expanduser(fox_config_path))
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size)
+    cached = _fox_configs.get(path)
+    if cached is None or cached[0] != key:
+        import toml
+        cached = _fox_configs[path] = (key, toml.load(path))
+    return copy.deepcopy(cached[1])
 
 
 def load_fox_config_from_args(args):
@@ -24,44 +52,173 @@ def get_presets(fox_config, preset_name):
     return fox_config.get(preset_key)
 
 
-def call_with_presets(func, args):
+def args_with_presets(args, preset_name, fox_config=None):
 
     func_args = dict()
 
-    if args.preset is not None:
-        fox_config = load_fox_config_from_args(args)
-        presets = get_presets(fox_config, args.preset)
-        print "Using presets:"
+    if preset_name is not None:
+        if fox_config is None:
+            fox_config = load_fox_config_from_args(args)
+        presets = get_presets(fox_config, preset_name)
+        if presets is None:
+            raise Exception("Preset '%s' not found." % (preset_name))
+        print "Using presets (%s):" % (preset_name)
         for (k, v) in presets.iteritems():
             print "   %s = %s" % (k, v)
         func_args = dict(func_args.items() + presets.items())
 
-    func_args = dict(vars(args).items() + func_args.items())
+    return dict(vars(args).items() + func_args.items())
 
-    func(**func_args)
+
+def call_with_presets(func, args):
+    return func(**args_with_presets(args, args.preset))
+
+
+def _parse_matrix(specs):
+    matrix = []
+    for spec in specs or []:
+        key, sep, values = spec.partition('=')
+        if not sep or not values:
+            raise ValueError("Invalid matrix '%s', expected KEY=VALUE[,VALUE...]" % (spec))
+        matrix.append((key.replace('-', '_'), values.split(',')))
+    return matrix
 
 
 def cmd_ipa(args):
-    call_with_presets(build_ipa, args)
+    from .ipa import build_ipa
+    from . import scheduler
+
+    preset_names = args.preset or [None]
+    matrix = _parse_matrix(args.matrix)
+
+    if len(preset_names) == 1 and not matrix:
+        args.preset = preset_names[0]
+        call_with_presets(build_ipa, args)
+        return
+
+    fox_config = load_fox_config_from_args(args) if args.preset else None
+    jobs = []
+    for preset_name in preset_names:
+        jobs.extend(scheduler.matrix_jobs(
+            preset_name, args_with_presets(args, preset_name, fox_config), matrix))
+
+    scheduler.isolate(jobs, os.path.abspath(args.build_dir or 'build'))
+    scheduler.run_jobs(build_ipa, jobs, max_jobs=args.jobs)
+
+    print
+    for line in scheduler.summary_table(jobs):
+        print line
+
+    if any(job.status != 'ok' for job in jobs):
+        sys.exit(1)
 
 
 def cmd_resign(args):
+    from .ipa import resign_ipa
+
+    if args.variants:
+        fox_config = load_fox_config_from_args(args)
+        variants = []
+        for preset_name in args.variants:
+            presets = get_presets(fox_config, preset_name)
+            if presets is None:
+                raise Exception("Preset '%s' not found." % (preset_name))
+            variants.append(presets)
+        args.variants = variants
     call_with_presets(resign_ipa, args)
 
 
+def cmd_info(args):
+    import json
+    from .ipa import extract_infos
+
+    for info in extract_infos(args.ipas, jobs=args.jobs):
+        print json.dumps(info, sort_keys=True)
+
+
+def cmd_inspect(args):
+    import json
+    from . import macho
+
+    for path in args.paths:
+        try:
+            for name, slices in macho.inspect(path):
+                print json.dumps({'path': path, 'binary': name,
+                                  'slices': [s.to_dict() for s in slices]}, sort_keys=True)
+        except (IOError, OSError, macho.MachOError), e:
+            logger.error("Couldn't inspect '%s': %s" % (path, e))
+            sys.exit(1)
+
+
+def _format_size(size):
+    if size < 1024:
+        return '%d B' % (size)
+    for unit in ('KB', 'MB', 'GB'):
+        size /= 1024.0
+        if size < 1024 or unit == 'GB':
+            return '%.1f %s' % (size, unit)
+
+
+def cmd_cache(args):
+    import json
+    from . import buildcache
+
+    cache = buildcache.BuildCache()
+    if args.clear:
+        cache.clear()
+    stats = cache.stats()
+    if args.json:
+        print json.dumps(stats, sort_keys=True)
+        return
+    lookups = stats['hits'] + stats['misses']
+    print "Build cache: %s" % (cache.root)
+    print "   entries = %d" % (stats['entries'])
+    print "   size = %s of %s" % (_format_size(stats['size']), _format_size(stats['max_size']))
+    print "   hits = %d, misses = %d (%.0f%% hit rate)" % (
+        stats['hits'], stats['misses'], 100.0 * stats['hits'] / lookups if lookups else 0)
+    print "   saved = %s, %.0fs" % (_format_size(stats['bytes_saved']), stats['seconds_saved'])
+    print "   evictions = %d" % (stats['evictions'])
+
+
+def cmd_serve(args):
+    from . import client
+
+    if args.status or args.stop:
+        reply = client.control('stop' if args.stop else 'status')
+        if reply is None:
+            logger.error("No fox daemon is listening on '%s'." % (client.socket_path()))
+            sys.exit(1)
+        print "fox %s (pid %d) on %s" % (reply['version'], reply['pid'], reply['socket'])
+        print "   uptime = %.0fs" % (reply['uptime'])
+        print "   workers = %d, active = %d, served = %d" % (
+            reply['workers'], reply['active'], reply['served'])
+        return
+
+    from . import server
+    try:
+        server.serve(workers=args.workers)
+    except RuntimeError, e:
+        logger.error(str(e))
+        sys.exit(1)
+
+
 def cmd_install_keychain(args):
+    from .keychain import install_keychain
     print install_keychain(args.keychain_path)
 
 
 def cmd_unlock_keychain(args):
+    from .keychain import unlock_keychain
     unlock_keychain(args.keychain, args.password)
 
 
 def cmd_install_profile(args):
+    from . import provisioningprofile
     print provisioningprofile.install_profile(args.profile_path)
 
 
 def cmd_list(args):
+    from . import provisioningprofile
     d = defaults['provisioning_profile_dir']
     print("%s:" % d)
     try:
@@ -75,7 +232,22 @@ def cmd_list(args):
  
 
 def cmd_find_profile(args):
-    results = provisioningprofile.find_all(args.name, patternMatch=args.pattern)
+    from . import provisioningprofile
+    if args.name is not None:
+        results = provisioningprofile.find_all(args.name, patternMatch=args.pattern)
+    elif args.bundle_id is None and args.identity is None:
+        logging.error("Give a profile name, --bundle-id or --identity.")
+        sys.exit(2)
+    else:
+        index = provisioningprofile.index()
+        if args.bundle_id is not None:
+            matches = index.candidates(args.bundle_id, identity=args.identity,
+                                       team_id=args.team, include_expired=args.all)
+            if not args.all:
+                matches = matches[:1]
+        else:
+            matches = index.for_identity(args.identity, team_id=args.team)
+        results = [path for (path, m) in matches] or None
     if results is None:
         logging.error("No matching profiles found.")
     else:
@@ -84,6 +256,7 @@ def cmd_find_profile(args):
 
 
 def cmd_profile_uuid(args):
+    from . import provisioningprofile
     print(provisioningprofile.uuid(args.path))
 
 
@@ -92,19 +265,13 @@ def cmd_debug(args):
     print _find_prov_profile('i*')
 
 
-def main():
-    parser = argparse.ArgumentParser(description='')
-    parser.add_argument('-C', action='store', required=False, default=defaults['config_path'],
-                        dest='config_path',
-                        help="Path to fox config, defaults to '~/.fox'")
-
-    subparsers = parser.add_subparsers(title='subcommands',
-                                       description='valid subcommands',
-                                       help='additional help')
-
-    # ipa
-    parser_ipa = subparsers.add_parser('ipa', help='Create a signed ipa file.')
-    parser_ipa.add_argument('--preset', action='store', required=False)
+def _configure_ipa(parser_ipa):
+    parser_ipa.add_argument('--preset', action='append', required=False,
+            help='Name of a preset in the fox config. Repeat to build several presets at once.')
+    parser_ipa.add_argument('--matrix', action='append', required=False, metavar='KEY=V1[,V2...]',
+            help='Build every combination of these values, e.g. config=Debug,Release. May be repeated.')
+    parser_ipa.add_argument('--jobs', action='store', type=int, required=False,
+            help='Maximum number of builds to run at once when building several.')
     parser_ipa.add_argument('--project', action='store', required=False)
     parser_ipa.add_argument('--target', action='store', required=False)
     parser_ipa.add_argument('--workspace', action='store', required=False)
@@ -119,10 +286,22 @@ def main():
     parser_ipa.add_argument('--overwrite', action='store_true', default=False, required=False)
     parser_ipa.add_argument('--dsym', action='store_true', default=False, required=False)
     parser_ipa.add_argument('--build_dir', action='store', required=False)
-    parser_ipa.set_defaults(func=cmd_ipa)
-
-    # resign
-    parser_resign = subparsers.add_parser('resign', help='Resign an ipa file.')
+    parser_ipa.add_argument('--build-log', action='store', required=False,
+            help='Also append xcodebuild output to this file.')
+    parser_ipa.add_argument('--incremental', action='store_true', default=False, required=False,
+            help='Update the existing ipa at the output path, recompressing only changed files.')
+    parser_ipa.add_argument('--build-cache', action='store_true', default=False, required=False,
+            help='Restore the ipa from the build cache instead of building if nothing changed.')
+    parser_ipa.add_argument('--no-settings-cache', action='store_false', dest='settings_cache',
+            default=True, required=False,
+            help="Always run 'xcodebuild -showBuildSettings' instead of using cached results.")
+    parser_ipa.add_argument('--thin', action='append', required=False, metavar='ARCH[,ARCH...]',
+            help='Package fat binaries with only these architectures, e.g. arm64. May be repeated.')
+    parser_ipa.add_argument('--staging-dir', action='store', required=False,
+            help='Directory for scratch files, instead of memory or the temp dir.')
+
+
+def _configure_resign(parser_resign):
     parser_resign.add_argument('--preset', action='store', required=False)
     parser_resign.add_argument('--ipa', action='store', required=True)
     parser_resign.add_argument('--identity', action='store', required=False)
@@ -130,45 +309,209 @@ def main():
     parser_resign.add_argument('--keychain', action='store', required=False)
     parser_resign.add_argument('--bundle-id', action='store', required=False)
     parser_resign.add_argument('--entitlements', action='store', required=False)
-    parser_resign.add_argument('--output', action='store', required=True)
-    parser_resign.set_defaults(func=cmd_resign)
+    parser_resign.add_argument('--output', action='store', required=False)
+    parser_resign.add_argument('--variant', action='append', dest='variants', required=False,
+            help='Name of a preset with profile, identity, bundle-id, entitlements and '
+                 'output for one variant. May be given more than once.')
+    parser_resign.add_argument('--workers', action='store', type=int, required=False,
+            help='Maximum number of variants to resign at once.')
+    parser_resign.add_argument('--sign-workers', action='store', type=int, required=False,
+            help='Maximum number of nested frameworks and extensions to sign at once.')
+    parser_resign.add_argument('--stream', action='store_true', default=False, required=False,
+            help='Copy members that resigning leaves unchanged without recompressing them.')
+    parser_resign.add_argument('--staging-dir', action='store', required=False,
+            help='Directory to extract the ipa in, instead of memory or the temp dir.')
+
+
+def _configure_info(parser_info):
+    parser_info.add_argument('--jobs', action='store', type=int, required=False,
+            help='Number of ipa files to read at once.')
+    parser_info.add_argument('ipas', metavar='ipa', nargs='+')
+
+
+def _configure_inspect(parser_inspect):
+    parser_inspect.add_argument('paths', metavar='path', nargs='+',
+            help='A binary, a bundle such as an app or dSYM, or an ipa.')
+
+
+def _configure_cache(parser_cache):
+    parser_cache.add_argument('--clear', action='store_true', default=False, required=False,
+            help='Remove every build from the cache.')
+    parser_cache.add_argument('--json', action='store_true', default=False, required=False,
+            help='Print the statistics as JSON.')
+
+
+def _configure_serve(parser_serve):
+    parser_serve.add_argument('--workers', action='store', type=int, required=False,
+            help='Maximum number of commands to run at once.')
+    parser_serve.add_argument('--status', action='store_true', default=False, required=False,
+            help='Print the status of the running daemon.')
+    parser_serve.add_argument('--stop', action='store_true', default=False, required=False,
+            help='Stop the running daemon once its commands finish.')
 
-    # install-profile
-    parser_install_profile = subparsers.add_parser('install-profile', help='Install a provisioning profile.')
+
+def _configure_install_profile(parser_install_profile):
     parser_install_profile.add_argument('profile_path', action='store')
-    parser_install_profile.set_defaults(func=cmd_install_profile)
 
-    # list-profiles
-    parser_list_profiles = subparsers.add_parser('list-profiles', help='List installed Provisioning Profiles.')
-    parser_list_profiles.set_defaults(func=cmd_list)
 
-    # find-profiles
-    parser_path = subparsers.add_parser('find-profiles', help='Get the path(s) of Provisioning Profile by name.')
+def _configure_find_profiles(parser_path):
     parser_path.add_argument('-p', '--pattern', action='store_true',
             required=False, default=False,
             help='Treat as a pattern using `fnmatch` style matching.')
-    parser_path.add_argument('name')
-    parser_path.set_defaults(func=cmd_find_profile)
-
-    # profile-uuid
-    parser_uuid = subparsers.add_parser('profile-uuid', help='Display the UDID of a Provisioning Profile by path.')
+    parser_path.add_argument('--bundle-id', action='store', required=False,
+            help='Find the best unexpired profile for this bundle id: an exact app id, '
+                 'otherwise the most specific wildcard.')
+    parser_path.add_argument('--identity', action='store', required=False,
+            help='Only profiles including this certificate, by name or SHA-1 fingerprint.')
+    parser_path.add_argument('--team', action='store', required=False,
+            help='Only profiles for this team id.')
+    parser_path.add_argument('--all', action='store_true', default=False,
+            help='With --bundle-id, print every match best first, including expired ones.')
+    parser_path.add_argument('name', nargs='?')
+
+
+def _configure_profile_uuid(parser_uuid):
     parser_uuid.add_argument('path')
-    parser_uuid.set_defaults(func=cmd_profile_uuid)
 
-    # install-keychain
-    parser_install_keychain = subparsers.add_parser('install-keychain', help='Install a keychain file.')
+
+def _configure_install_keychain(parser_install_keychain):
     parser_install_keychain.add_argument('keychain_path', action='store')
-    parser_install_keychain.set_defaults(func=cmd_install_keychain)
 
-    # unlock-keychain
-    parser_unlock_keychain = subparsers.add_parser('unlock-keychain', help='Unlock a keychain.')
+
+def _configure_unlock_keychain(parser_unlock_keychain):
     parser_unlock_keychain.add_argument('keychain', action='store', help='Keychain name or path')
     parser_unlock_keychain.add_argument('password', action='store', nargs='?',
                                         default='', help='Keychain password')
-    parser_unlock_keychain.set_defaults(func=cmd_unlock_keychain)
 
-    parser_debug = subparsers.add_parser('debug', help='debug help')
-    parser_debug.set_defaults(func=cmd_debug)
 
-    args = parser.parse_args()
-    args.func(args)
+# name, help, function that adds the subcommand's arguments, handler
+SUBCOMMANDS = [
+    ('ipa', 'Create a signed ipa file.',
+     _configure_ipa, cmd_ipa),
+    ('resign', 'Resign an ipa file.',
+     _configure_resign, cmd_resign),
+    ('info', 'Print metadata about ipa files as JSON lines.',
+     _configure_info, cmd_info),
+    ('inspect', 'Print the architectures, UUIDs and linked dylibs of binaries as JSON lines.',
+     _configure_inspect, cmd_inspect),
+    ('cache', 'Show build cache statistics.',
+     _configure_cache, cmd_cache),
+    ('serve', 'Run commands sent by other fox invocations, keeping state warm in memory.',
+     _configure_serve, cmd_serve),
+    ('install-profile', 'Install a provisioning profile.',
+     _configure_install_profile, cmd_install_profile),
+    ('list-profiles', 'List installed Provisioning Profiles.',
+     None, cmd_list),
+    ('find-profiles', 'Get the path(s) of Provisioning Profile by name, or the best one for a bundle id.',
+     _configure_find_profiles, cmd_find_profile),
+    ('profile-uuid', 'Display the UDID of a Provisioning Profile by path.',
+     _configure_profile_uuid, cmd_profile_uuid),
+    ('install-keychain', 'Install a keychain file.',
+     _configure_install_keychain, cmd_install_keychain),
+    ('unlock-keychain', 'Unlock a keychain.',
+     _configure_unlock_keychain, cmd_unlock_keychain),
+    ('debug', 'debug help',
+     None, cmd_debug),
+]
+
+
+def _global_option(arg):
+    """Return the global option `arg` gives, matched the way argparse does:
+    long options may be abbreviated and take their value after an `=`, and
+    `-C` may have its value attached."""
+    if arg.startswith('--'):
+        name = arg.split('=', 1)[0]
+        matches = [option for option in _GLOBAL_LONG_OPTIONS if option.startswith(name)]
+        if name in matches:
+            return name
+        return matches[0] if len(matches) == 1 else name
+    if arg.startswith('-C'):
+        return '-C'
+    return arg
+
+
+def _parse_global_options(argv):
+    """Return the set of global options given in `argv`, and the subcommand,
+    or None."""
+    options = set()
+    args = iter(argv)
+    for arg in args:
+        if not arg.startswith('-'):
+            return options, arg
+        option = _global_option(arg)
+        options.add(option)
+        if option in _GLOBAL_OPTIONS_WITH_VALUES and (arg == option or '=' not in arg and
+                                                      arg.startswith('--')):
+            # the value is the next argument
+            next(args, None)
+    return options, None
+
+
+def _selected_subcommand(argv):
+    return _parse_global_options(argv)[1]
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # hand the command to a running `fox serve` if there is one; traces are
+    # per process, so traced commands always run here
+    options, subcommand = _parse_global_options(argv)
+    if '--no-daemon' not in options and '--trace' not in options:
+        from . import client
+        if subcommand in client.SERVED_SUBCOMMANDS:
+            status = client.forward(argv)
+            if status is not None:
+                sys.exit(status)
+
+    run(argv)
+
+
+def run(argv):
+    """Parse and run the command line `argv` in this process."""
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-C', action='store', required=False, default=defaults['config_path'],
+                        dest='config_path',
+                        help="Path to fox config, defaults to '~/.fox'")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='Log more about what fox is doing.')
+    parser.add_argument('--trace', action='store', required=False, metavar='PATH',
+            help='Write a Chrome trace of where time was spent to PATH.')
+    parser.add_argument('--no-daemon', action='store_true', default=False,
+            help="Run the command in this process even if 'fox serve' is running.")
+    parser.add_argument('--version', action='version', version='fox %s' % (__version__))
+
+    subparsers = parser.add_subparsers(title='subcommands',
+                                       description='valid subcommands',
+                                       help='additional help')
+
+    # only the selected subcommand's arguments are needed to parse argv
+    selected = _selected_subcommand(argv)
+    for (name, help, configure, func) in SUBCOMMANDS:
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.set_defaults(func=func)
+        if configure is not None and name == selected:
+            configure(subparser)
+
+    args = parser.parse_args(argv)
+    if args.verbose:
+        set_log_level(logging.INFO)
+    if args.trace:
+        from . import trace
+        trace.enable()
+    try:
+        args.func(args)
+    except Exception, e:
+        # a command that fails this way has already imported helpers
+        helpers = sys.modules.get(__name__.rsplit('.', 1)[0] + '.helpers')
+        if helpers is None or not isinstance(e, helpers.CommandError):
+            raise
+        logger.error(str(e))
+        sys.exit(1)
+    finally:
+        if args.trace:
+            try:
+                trace.write(args.trace)
+            finally:
+                trace.disable()
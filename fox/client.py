@@ -0,0 +1,102 @@
+"""
+The client side of `fox serve`. When a daemon is listening, the command line
+forwards commands to it and relays the output and exit status, instead of
+loading and running them itself.
+"""
+
+import logging
+import os
+import sys
+
+from . import __version__
+from .defaults import defaults
+
+
+logger = logging.getLogger(__name__)
+
+# subcommands a daemon runs on the client's behalf
+SERVED_SUBCOMMANDS = ('ipa', 'resign', 'info', 'inspect', 'find-profiles')
+
+
+def socket_path():
+    return defaults['server_socket'] or os.path.join(defaults['cache_dir'], 'fox.sock')
+
+
+def connect(path=None):
+    """Return a socket connected to the daemon at `path`, or None if no
+    daemon is listening there."""
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    import socket
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        s.close()
+        return None
+    return s
+
+
+def _exchange(message, path=None):
+    """Send `message` to the daemon and yield each message of the reply.
+    Yields nothing if no daemon is listening."""
+    import json
+    s = connect(path)
+    if s is None:
+        return
+    try:
+        f = s.makefile('r+b')
+        f.write(json.dumps(message) + '\n')
+        f.flush()
+        for line in f:
+            yield json.loads(line)
+    finally:
+        s.close()
+
+
+def control(command, path=None):
+    """Send a control command ('status' or 'stop') and return the reply, or
+    None if no daemon is listening."""
+    import socket
+    try:
+        for reply in _exchange({'control': command}, path=path):
+            return reply
+    except (socket.error, ValueError):
+        pass
+    return None
+
+
+def forward(argv):
+    """
+    Run the command line `argv` on the daemon, relaying its output, and
+    return the exit status. Returns None, so the command is run here
+    instead, if no daemon is listening or it won't run the command.
+    """
+    import socket
+    message = {'version': __version__, 'argv': argv, 'cwd': os.getcwd(),
+               'env': dict(os.environ)}
+    started = False
+    try:
+        for reply in _exchange(message):
+            if 'stdout' in reply:
+                started = True
+                sys.stdout.write(reply['stdout'].encode('utf-8'))
+                sys.stdout.flush()
+            elif 'stderr' in reply:
+                started = True
+                sys.stderr.write(reply['stderr'].encode('utf-8'))
+            elif 'exit' in reply:
+                return reply['exit']
+            elif 'error' in reply:
+                logger.warning("Not using the fox daemon: %s" % (reply['error']))
+                return None
+    except (socket.error, ValueError), e:
+        if not started:
+            return None
+        sys.stderr.write('Lost connection to the fox daemon: %s\n' % (e))
+        return 1
+    if not started:
+        return None
+    sys.stderr.write('The fox daemon closed the connection.\n')
+    return 1
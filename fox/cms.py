@@ -0,0 +1,226 @@
+"""
+A minimal DER/BER reader for the CMS (PKCS #7) SignedData envelope around
+provisioning profiles. It only locates the signed content, it doesn't verify
+signatures.
+"""
+
+from contextlib import contextmanager
+import itertools
+import mmap
+
+OID_SIGNED_DATA = '1.2.840.113549.1.7.2'
+OID_DATA = '1.2.840.113549.1.7.1'
+OID_COMMON_NAME = '2.5.4.3'
+
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_OCTET_STRING_CONSTRUCTED = 0x24
+TAG_OID = 0x06
+TAG_SEQUENCE = 0x30
+TAG_SET = 0x31
+TAG_CONTEXT_0 = 0xa0
+
+
+class CMSError(ValueError):
+    pass
+
+
+def read_header(data, offset, end):
+    """
+    Read the tag and length at `offset`. Returns `(tag, length, offset)` where
+    `offset` is the start of the contents and `length` is None for BER
+    indefinite-length encodings.
+    """
+    if offset + 2 > end:
+        raise CMSError('truncated header at offset %d' % (offset))
+    tag = ord(data[offset])
+    if tag & 0x1f == 0x1f:
+        raise CMSError('high tag numbers are not supported')
+    first = ord(data[offset + 1])
+    offset += 2
+    if first < 0x80:
+        return tag, first, offset
+    if first == 0x80:
+        return tag, None, offset
+    num_bytes = first & 0x7f
+    if offset + num_bytes > end:
+        raise CMSError('truncated length at offset %d' % (offset))
+    length = 0
+    for i in range(num_bytes):
+        length = (length << 8) | ord(data[offset + i])
+    offset += num_bytes
+    if offset + length > end:
+        raise CMSError('element at offset %d overruns its container' % (offset))
+    return tag, length, offset
+
+
+def skip(data, offset, end):
+    """Return the offset just past the element starting at `offset`."""
+    tag, length, offset = read_header(data, offset, end)
+    if length is not None:
+        return offset + length
+    while not _is_end_of_contents(data, offset, end):
+        offset = skip(data, offset, end)
+    return offset + 2
+
+
+def children(data, offset, end):
+    """Yield `(tag, length, offset)` for each child of a constructed element
+    whose contents start at `offset`."""
+    while offset < end:
+        if _is_end_of_contents(data, offset, end):
+            return
+        tag, length, content_offset = read_header(data, offset, end)
+        yield tag, length, content_offset
+        offset = skip(data, offset, end)
+
+
+def _is_end_of_contents(data, offset, end):
+    return offset + 2 <= end and data[offset] == '\x00' and data[offset + 1] == '\x00'
+
+
+def _expect(data, offset, end, tag):
+    actual, length, offset = read_header(data, offset, end)
+    if actual != tag:
+        raise CMSError('expected tag 0x%02x, found 0x%02x' % (tag, actual))
+    return length, offset
+
+
+def _content_end(data, length, offset, end):
+    if length is None:
+        return end
+    return offset + length
+
+
+def decode_oid(data, offset, length):
+    values = []
+    value = 0
+    for i in range(offset, offset + length):
+        b = ord(data[i])
+        value = (value << 7) | (b & 0x7f)
+        if not b & 0x80:
+            values.append(value)
+            value = 0
+    if not values:
+        raise CMSError('empty object identifier')
+    first = min(values[0] // 40, 2)
+    return '.'.join(str(v) for v in [first, values[0] - 40 * first] + values[1:])
+
+
+def _read_oid(data, offset, end):
+    length, offset = _expect(data, offset, end, TAG_OID)
+    return decode_oid(data, offset, length), offset + length
+
+
+def content_chunks(data):
+    """
+    Return a list of `(offset, length)` ranges in `data` that make up the
+    encapsulated content of a CMS SignedData structure. DER encodings (and
+    most BER ones) have exactly one chunk.
+    """
+    end = len(data)
+
+    # ContentInfo ::= SEQUENCE { contentType, [0] EXPLICIT content }
+    length, offset = _expect(data, 0, end, TAG_SEQUENCE)
+    end = _content_end(data, length, offset, end)
+    oid, offset = _read_oid(data, offset, end)
+    if oid != OID_SIGNED_DATA:
+        raise CMSError('not a SignedData structure (%s)' % (oid))
+    length, offset = _expect(data, offset, end, TAG_CONTEXT_0)
+    end = _content_end(data, length, offset, end)
+
+    # SignedData ::= SEQUENCE { version, digestAlgorithms, encapContentInfo, ... }
+    length, offset = _expect(data, offset, end, TAG_SEQUENCE)
+    end = _content_end(data, length, offset, end)
+    offset = skip(data, offset, end)  # version
+    offset = skip(data, offset, end)  # digestAlgorithms
+
+    # EncapsulatedContentInfo ::= SEQUENCE { eContentType, [0] EXPLICIT eContent }
+    length, offset = _expect(data, offset, end, TAG_SEQUENCE)
+    end = _content_end(data, length, offset, end)
+    oid, offset = _read_oid(data, offset, end)
+    if oid != OID_DATA:
+        raise CMSError('unexpected content type %s' % (oid))
+    length, offset = _expect(data, offset, end, TAG_CONTEXT_0)
+    end = _content_end(data, length, offset, end)
+
+    tag, length, offset = read_header(data, offset, end)
+    if tag == TAG_OCTET_STRING:
+        return [(offset, length)]
+    if tag == TAG_OCTET_STRING_CONSTRUCTED:
+        end = _content_end(data, length, offset, end)
+        chunks = []
+        for tag, length, offset in children(data, offset, end):
+            if tag != TAG_OCTET_STRING or length is None:
+                raise CMSError('unsupported constructed content encoding')
+            chunks.append((offset, length))
+        return chunks
+    raise CMSError('expected content octet string, found tag 0x%02x' % (tag))
+
+
+def content(data):
+    """
+    Return the encapsulated content of the CMS structure in `data`. When the
+    content is stored contiguously this is a zero-copy `buffer` into `data`.
+    """
+    chunks = content_chunks(data)
+    if len(chunks) == 1:
+        offset, length = chunks[0]
+        return buffer(data, offset, length)
+    return ''.join(data[offset:offset + length] for (offset, length) in chunks)
+
+
+def certificate_common_name(data):
+    """
+    Return the common name in the subject of the DER-encoded X.509
+    certificate `data`, or None if it has none.
+    """
+    end = len(data)
+
+    # Certificate ::= SEQUENCE { tbsCertificate, signatureAlgorithm, signature }
+    length, offset = _expect(data, 0, end, TAG_SEQUENCE)
+    end = _content_end(data, length, offset, end)
+    length, offset = _expect(data, offset, end, TAG_SEQUENCE)
+    end = _content_end(data, length, offset, end)
+
+    # TBSCertificate ::= SEQUENCE { [0] version OPTIONAL, serialNumber,
+    #     signature, issuer, validity, subject, ... }
+    fields = list(itertools.islice(children(data, offset, end), 6))
+    if fields and fields[0][0] == TAG_CONTEXT_0:
+        fields = fields[1:]
+    if len(fields) < 5:
+        raise CMSError('truncated certificate')
+    tag, length, offset = fields[4]
+    if tag != TAG_SEQUENCE or length is None:
+        raise CMSError('expected certificate subject, found tag 0x%02x' % (tag))
+
+    # Name ::= SEQUENCE OF SET OF SEQUENCE { type, value }
+    for rdn_tag, rdn_length, rdn_offset in children(data, offset, offset + length):
+        if rdn_tag != TAG_SET or rdn_length is None:
+            raise CMSError('malformed certificate subject')
+        for tag, length, offset in children(data, rdn_offset, rdn_offset + rdn_length):
+            if tag != TAG_SEQUENCE or length is None:
+                raise CMSError('malformed certificate subject')
+            end = offset + length
+            oid, offset = _read_oid(data, offset, end)
+            if oid == OID_COMMON_NAME:
+                tag, length, offset = read_header(data, offset, end)
+                return data[offset:offset + length].decode('utf-8', 'replace')
+    return None
+
+
+@contextmanager
+def open_content(path):
+    """
+    Memory-map the file at `path` and yield its encapsulated content. The
+    yielded buffer is only valid inside the `with` block.
+    """
+    with open(path, 'rb') as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise CMSError("'%s' is empty" % (path))
+        try:
+            yield content(m)
+        finally:
+            m.close()
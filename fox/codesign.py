@@ -0,0 +1,173 @@
+"""
+Signing an app bundle together with the code nested in it. Frameworks,
+dylibs, app extensions and watch apps each carry their own signature, and a
+bundle's signature seals those of everything inside it, so nested code has
+to be signed first, innermost to outermost. Bundles that don't contain one
+another are independent and are signed at the same time.
+"""
+
+import logging
+import multiprocessing
+import os
+import Queue
+import sys
+
+from .defaults import defaults
+from .helpers import run_cmd
+from . import executor
+from . import trace
+
+
+logger = logging.getLogger(__name__)
+
+# directories of a bundle that nested code is found in
+NESTED_CODE_DIRS = ('Frameworks', 'PlugIns', 'Extensions', 'Watch', 'AppClips', 'XPCServices')
+
+BUNDLE_EXTENSIONS = ('.app', '.appex', '.framework', '.xpc')
+
+
+class Signable(object):
+    """A bundle or dylib to sign, and the signables nested in it."""
+
+    def __init__(self, path, parent=None):
+        self.path = path
+        self.parent = parent
+        self.children = []
+
+    @property
+    def kind(self):
+        """The extension of the bundle or dylib, without the dot."""
+        return os.path.splitext(self.path)[1][1:]
+
+    @property
+    def is_bundle(self):
+        return os.path.isdir(self.path)
+
+    @property
+    def has_entitlements(self):
+        """Whether this is an app or app extension, which are signed with
+        entitlements; frameworks and dylibs aren't."""
+        return self.kind in ('app', 'appex', 'xpc')
+
+    def walk(self):
+        """Yield this signable and everything nested in it, parents before
+        their children."""
+        yield self
+        for child in self.children:
+            for node in child.walk():
+                yield node
+
+    def relpath(self):
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        return os.path.relpath(self.path, os.path.dirname(root.path))
+
+    def __repr__(self):
+        return '<Signable %s>' % (self.relpath())
+
+
+def discover(bundle_path):
+    """Return the tree of signables rooted at the bundle at `bundle_path`."""
+    root = Signable(bundle_path)
+    _discover(root)
+    return root
+
+
+def _discover(node):
+    for name in NESTED_CODE_DIRS:
+        directory = os.path.join(node.path, name)
+        if os.path.islink(directory) or not os.path.isdir(directory):
+            continue
+        for entry in sorted(os.listdir(directory)):
+            path = os.path.join(directory, entry)
+            if os.path.islink(path):
+                continue
+            ext = os.path.splitext(entry)[1]
+            if ext == '.dylib' and os.path.isfile(path):
+                node.children.append(Signable(path, parent=node))
+            elif ext in BUNDLE_EXTENSIONS and os.path.isdir(path):
+                child = Signable(path, parent=node)
+                node.children.append(child)
+                _discover(child)
+
+
+def sign_tree(root, sign, workers=None):
+    """
+    Call `sign(signable)` for every signable in the tree at `root`, each one
+    only after everything nested in it has been signed. Up to `workers` are
+    signed at once. If one fails, nothing more is started, and its error is
+    raised once the ones already running have finished.
+    """
+    workers = workers or defaults['codesign_workers'] or multiprocessing.cpu_count()
+    nodes = list(root.walk())
+    unsigned = dict((node, len(node.children)) for node in nodes)
+    ready = [node for node in nodes if not node.children]
+    running = dict()
+    finished = Queue.Queue()
+    exc_info = None
+
+    def run(node):
+        try:
+            sign(node)
+        finally:
+            finished.put(node)
+
+    while True:
+        while ready and len(running) < workers and exc_info is None:
+            node = ready.pop(0)
+            running[node] = executor.spawn(run, node)
+        if not running:
+            break
+
+        node = finished.get()
+        try:
+            running.pop(node).result()
+        except Exception:
+            if exc_info is None:
+                exc_info = sys.exc_info()
+            continue
+
+        parent = node.parent
+        if parent is not None:
+            unsigned[parent] -= 1
+            if unsigned[parent] == 0:
+                ready.append(parent)
+
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def codesign_args(path, identity, entitlements=None, keychain_path=None, resource_rules=None):
+    args = ['codesign', '-f', '-s', identity]
+    if entitlements is not None:
+        args.extend(['--entitlements', entitlements])
+    if resource_rules is not None:
+        args.extend(['--resource-rules', resource_rules])
+    if keychain_path is not None:
+        args.extend(['--keychain', keychain_path])
+    args.append(path)
+    return args
+
+
+def sign_bundle(bundle_path, identity, entitlements_for=None, keychain_path=None,
+                resource_rules=None, workers=None):
+    """
+    Sign the bundle at `bundle_path` and all the code nested in it with
+    `identity`. `entitlements_for(signable)` returns the path of the
+    entitlements to sign an app or app extension with, or None.
+    `resource_rules` only applies to the outermost bundle.
+    """
+    root = discover(bundle_path)
+
+    def sign(node):
+        entitlements = None
+        if entitlements_for is not None and node.has_entitlements:
+            entitlements = entitlements_for(node)
+        with trace.span('codesign', bundle=node.relpath()):
+            run_cmd(codesign_args(node.path, identity, entitlements=entitlements,
+                                  keychain_path=keychain_path,
+                                  resource_rules=resource_rules if node is root else None))
+
+    sign_tree(root, sign, workers=workers)
+    return root
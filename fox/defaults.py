@@ -9,3 +9,21 @@ defaults['provisioning_profile_dir'] = os.path.expanduser('~/Library/MobileDevic
 defaults['build_config'] = 'Debug'
 defaults['ipa_output_template'] = '${app_name}_${marketing_version}_${build_version}_${config}.ipa'
 defaults['keychain_unlock_timeout'] = 7200  # two hours
+defaults['cache_dir'] = os.path.expanduser('~/Library/Caches/fox')
+defaults['package_jobs'] = None  # defaults to the number of CPUs
+defaults['package_compresslevel'] = 6
+defaults['resign_workers'] = None  # defaults to the number of CPUs
+defaults['codesign_workers'] = None  # nested bundles signed at once; defaults to the number of CPUs
+defaults['command_tail_lines'] = 50
+defaults['build_settings_cache'] = True
+defaults['build_settings_cache_size'] = 200  # number of cached results to keep
+defaults['build_cache_max_size'] = 5 * 1024 * 1024 * 1024  # bytes
+defaults['server_socket'] = None  # defaults to fox.sock in the cache dir
+defaults['server_workers'] = None  # defaults to the number of CPUs
+defaults['server_poll_interval'] = 2  # seconds between checks for changed profiles and config
+defaults['max_commands'] = None  # external tools run at once; defaults to the number of CPUs
+defaults['staging_dir'] = None  # defaults to the system temp dir
+defaults['staging_memory_dir'] = '/dev/shm'  # RAM-backed staging; None to always use disk
+defaults['staging_memory_budget'] = 1024 * 1024 * 1024  # bytes staged in memory at once
+defaults['staging_reserve'] = 256 * 1024 * 1024  # bytes to leave free on a staging volume
+defaults['staging_pool_size'] = 4  # emptied scratch dirs kept for reuse
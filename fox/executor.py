@@ -0,0 +1,289 @@
+"""
+Running external tools concurrently. Commands are lists of arguments, run
+without a shell. Each command's stdout and stderr are drained on their own
+threads, so neither can fill its pipe and stall the tool, and a command can
+time out or be cancelled. At most `defaults['max_commands']` commands run at
+once across all of fox's threads.
+
+Python 2 has no asyncio, so concurrency comes from threads: `spawn` runs a
+function on a new thread and returns a `Future`. Cancelling a future kills
+the commands running on its behalf and makes any it starts later fail
+straight away.
+"""
+
+import logging
+import multiprocessing
+import os
+from subprocess import Popen, PIPE
+import sys
+import threading
+import time
+
+from .defaults import defaults
+from .helpers import CommandError, CommandResult, CaptureSink, TailSink, shellify
+from .helpers import current_output_prefix, output_prefix
+from . import helpers
+from . import trace
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+_slots = None
+_slots_lock = threading.Lock()
+
+
+def _command_slots():
+    global _slots
+    with _slots_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(
+                defaults['max_commands'] or multiprocessing.cpu_count())
+        return _slots
+
+
+## Futures
+
+class Future(object):
+    """
+    The result of a function running on another thread. Commands started
+    while it runs, on its thread or on threads it spawns, belong to it.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._commands = set()
+
+    def cancelled(self):
+        return self._cancelled or (self.parent is not None and self.parent.cancelled())
+
+    def cancel(self):
+        """Kill the commands running on behalf of this future. Commands it
+        starts from now on fail with a cancelled `CommandError`."""
+        with self._lock:
+            self._cancelled = True
+            commands = list(self._commands)
+        for command in commands:
+            command.cancel()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the function to return and return its result, or raise
+        its exception."""
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for a result')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def _set(self, result=None, exc_info=None):
+        self._result = result
+        self._exc_info = exc_info
+        self._done.set()
+
+    def _add(self, command):
+        with self._lock:
+            self._commands.add(command)
+            cancelled = self._cancelled
+        if self.parent is not None:
+            self.parent._add(command)
+        if cancelled:
+            command.cancel()
+
+    def _remove(self, command):
+        with self._lock:
+            self._commands.discard(command)
+        if self.parent is not None:
+            self.parent._remove(command)
+
+
+def current():
+    """Return the future this thread is working for, or None."""
+    return getattr(_local, 'future', None)
+
+
+def spawn(func, *args, **kwargs):
+    """Call `func(*args, **kwargs)` on a new thread and return a `Future`
+    for its result. The thread keeps the caller's output prefix."""
+    future = Future(parent=current())
+    prefix = current_output_prefix()
+
+    def run():
+        _local.future = future
+        try:
+            with output_prefix(prefix):
+                future._set(result=func(*args, **kwargs))
+        except BaseException:
+            future._set(exc_info=sys.exc_info())
+
+    thread = threading.Thread(target=run, name=getattr(func, '__name__', 'fox-task'))
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def map_async(func, items, workers):
+    """Call `func` on each of `items`, at most `workers` at a time, and
+    return a list of `Future`s for the results."""
+    limit = threading.BoundedSemaphore(workers)
+
+    def call(item):
+        with limit:
+            return func(item)
+    return [spawn(call, item) for item in items]
+
+
+def gather(futures):
+    """Wait for all of `futures` and return their results, in order. If any
+    raised, the first exception is raised once they have all finished."""
+    exc_info = None
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception:
+            results.append(None)
+            if exc_info is None:
+                exc_info = sys.exc_info()
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return results
+
+
+## Commands
+
+class Command(object):
+    """
+    One run of an external tool. `stdout` and `stderr` are lists of sinks
+    that each line is written to as it's read.
+    """
+
+    def __init__(self, argv, cwd=None, env=None, timeout=None, stdout=None, stderr=None,
+                 display_cmd=None):
+        if isinstance(argv, basestring):
+            raise TypeError('Commands are lists of arguments, not shell strings')
+        self.argv = list(argv)
+        self.cwd = cwd
+        self.env = env if env is not None else helpers.command_env()
+        self.timeout = timeout
+        self.display_cmd = display_cmd or shellify(self.argv)
+        self.tail = TailSink()
+        self.stdout = list(stdout or []) + [self.tail]
+        self.stderr = list(stderr or []) + [self.tail]
+        self.process = None
+        self.timed_out = False
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """Kill the command if it's running, and fail it."""
+        with self._lock:
+            self.cancelled = True
+            p = self.process
+        if p is not None and p.poll() is None:
+            p.kill()
+
+    def _timeout(self):
+        with self._lock:
+            self.timed_out = True
+            p = self.process
+        if p is not None and p.poll() is None:
+            p.kill()
+
+    def run(self):
+        """Run the command on this thread and return a `CommandResult`.
+        Raises `CommandError` if it fails, times out or is cancelled."""
+        future = current()
+        if future is not None:
+            future._add(self)
+        try:
+            with trace.span('run %s' % (os.path.basename(self.argv[0])),
+                            cmd=self.display_cmd) as span:
+                with _command_slots():
+                    result = self._execute()
+                span.set(exit_code=result.returncode)
+        finally:
+            if future is not None:
+                future._remove(self)
+
+        if result.returncode != 0 or self.timed_out or self.cancelled:
+            raise CommandError(self.display_cmd, result.returncode, list(self.tail.lines),
+                               result.duration, timed_out=self.timed_out,
+                               cancelled=self.cancelled)
+        return result
+
+    def _execute(self):
+        start = time.time()
+        with self._lock:
+            if self.cancelled:
+                return CommandResult(self.display_cmd, None, 0)
+            # close_fds, so that commands started on other threads meanwhile
+            # don't inherit our pipes and hold them open
+            self.process = p = Popen(self.argv, stdout=PIPE, stderr=PIPE, cwd=self.cwd,
+                                     env=self.env, close_fds=True)
+
+        drains = [threading.Thread(target=_drain, args=(p.stdout, self.stdout)),
+                  threading.Thread(target=_drain, args=(p.stderr, self.stderr))]
+        for thread in drains:
+            thread.daemon = True
+            thread.start()
+
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, self._timeout)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            for thread in drains:
+                thread.join()
+            p.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+            for sink in set(self.stdout + self.stderr):
+                sink.close()
+
+        duration = time.time() - start
+        logger.debug("'%s' exited with status %d in %.1fs" % (self.display_cmd, p.returncode,
+                                                              duration))
+        return CommandResult(self.display_cmd, p.returncode, duration, timed_out=self.timed_out)
+
+
+def _drain(pipe, sinks):
+    for line in iter(pipe.readline, ''):
+        for sink in sinks:
+            sink.write(line)
+    pipe.close()
+
+
+def run(argv, **kwargs):
+    """Run a `Command` for `argv` and wait for it. Takes the same keyword
+    arguments as `Command`."""
+    return Command(argv, **kwargs).run()
+
+
+def start(argv, **kwargs):
+    """Start a `Command` for `argv` on another thread. Returns the command,
+    for cancelling it, and a `Future` for its result."""
+    command = Command(argv, **kwargs)
+    return command, spawn(command.run)
+
+
+def output(argv, stderr=None, **kwargs):
+    """Run `argv` and return its stdout, like `subprocess.check_output`.
+    Lines written to stderr go to the `stderr` sinks."""
+    capture = CaptureSink()
+    run(argv, stdout=[capture], stderr=stderr, **kwargs)
+    return capture.value()
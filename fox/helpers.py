@@ -1,14 +1,59 @@
-import os
+from collections import deque
+from contextlib import contextmanager
+import logging
 import pipes
-import sys
-from subprocess import Popen, STDOUT, PIPE
+import threading
+import time
+from subprocess import Popen, STDOUT, PIPE, CalledProcessError
+
+from .defaults import defaults
+from . import trace
 
 try:
     import clint.textui
-    puts = clint.textui.puts
+    _puts = clint.textui.puts
 except ImportError:
     import util
-    puts = util.puts
+    _puts = util.puts
+
+
+logger = logging.getLogger(__name__)
+
+_output = threading.local()
+_output_lock = threading.Lock()
+
+
+@contextmanager
+def output_prefix(prefix):
+    """Prefix every line written with `puts` from the current thread."""
+    previous = current_output_prefix()
+    _output.prefix = previous + prefix
+    try:
+        yield
+    finally:
+        _output.prefix = previous
+
+
+def current_output_prefix():
+    return getattr(_output, 'prefix', '')
+
+
+def puts(s, newline=True, prefix=None):
+    """Write `s` with each line prefixed with `prefix`, by default the
+    current thread's output prefix."""
+    if prefix is None:
+        prefix = current_output_prefix()
+    if prefix:
+        s = ''.join(prefix + l for l in s.splitlines(True))
+    with _output_lock:
+        _puts(s, newline=newline)
+
+
+def command_env():
+    """Return the environment to run commands with, or None for this
+    process's own. `fox serve` replaces this so that each request's
+    commands get its client's environment."""
+    return None
 
 
 def shellify(args):
@@ -19,17 +64,172 @@ def join_cmds(*cmds):
     return " ; ".join(cmds)
 
 
-def run_cmd(cmd, cwd=None):
-    p = Popen(cmd, stderr=STDOUT, stdout=PIPE, cwd=cwd, shell=True)
-    output = ''
-    while True:
-        line = p.stdout.readline()
-        if not line:
-            break
-        output += line
-        puts(line, newline=False)
-    p.wait()
-    if p.returncode != 0:
-        print "Process exited with non-zero status " + str(p.returncode)
-        sys.exit(1)
-    return output
+class CommandError(CalledProcessError):
+    """
+    Raised by `run_cmd` when a command fails, times out or is cancelled.
+    `tail` holds the last lines of its output.
+    """
+
+    def __init__(self, cmd, returncode, tail, duration, timed_out=False, cancelled=False):
+        CalledProcessError.__init__(self, returncode, cmd, ''.join(tail))
+        self.tail = tail
+        self.duration = duration
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    def __str__(self):
+        if self.cancelled:
+            msg = "Command '%s' was cancelled after %.1fs" % (self.cmd, self.duration)
+        elif self.timed_out:
+            msg = "Command '%s' timed out after %.1fs" % (self.cmd, self.duration)
+        else:
+            msg = "Command '%s' exited with non-zero status %d after %.1fs" % (
+                self.cmd, self.returncode, self.duration)
+        if self.tail:
+            msg += '\nLast %d lines of output:\n%s' % (len(self.tail), ''.join(self.tail).rstrip())
+        return msg
+
+
+class TerminalSink(object):
+    """Echo output to the terminal, with the output prefix of the thread
+    that created the sink, since output is drained on other threads."""
+
+    def __init__(self):
+        self.prefix = current_output_prefix()
+
+    def write(self, line):
+        puts(line, newline=False, prefix=self.prefix)
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """Append output to a log file."""
+
+    def __init__(self, path):
+        self.f = open(path, 'a')
+
+    def write(self, line):
+        self.f.write(line)
+
+    def close(self):
+        self.f.close()
+
+
+class TailSink(object):
+    """Keep the last `maxlen` lines of output."""
+
+    def __init__(self, maxlen=None):
+        self.lines = deque(maxlen=maxlen or defaults['command_tail_lines'])
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def close(self):
+        pass
+
+
+class CaptureSink(object):
+    """Keep all of the output."""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def close(self):
+        pass
+
+    def value(self):
+        return ''.join(self.lines)
+
+
+class CommandResult(object):
+
+    def __init__(self, cmd, returncode, duration, output=None, timed_out=False):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.duration = duration
+        self.output = output
+        self.timed_out = timed_out
+
+
+def run_cmd(cmd, cwd=None, sinks=None, capture=False, timeout=None, quiet=False,
+            display_cmd=None):
+    """
+    Run `cmd`, a list of arguments, without a shell, streaming each line of
+    stdout and stderr to `sinks` and, unless `quiet`, the terminal. With
+    `capture`, the full output is kept and returned as the result's
+    `output`. `display_cmd` replaces the command in logs and errors, e.g. to
+    hide a password. A string is still accepted and run by the shell, for
+    compatibility.
+
+    Raises `CommandError` if the command exits with a non-zero status, runs
+    longer than `timeout` seconds or is cancelled.
+    """
+    sinks = list(sinks or [])
+    if not quiet:
+        sinks.append(TerminalSink())
+    if capture:
+        capture_sink = CaptureSink()
+        sinks.append(capture_sink)
+
+    if isinstance(cmd, basestring):
+        result = _run_shell(cmd, cwd, sinks, timeout, display_cmd or cmd)
+    else:
+        from . import executor
+        result = executor.run(cmd, cwd=cwd, timeout=timeout, stdout=sinks, stderr=sinks,
+                              display_cmd=display_cmd)
+
+    if capture:
+        result.output = capture_sink.value()
+    return result
+
+
+def _run_shell(cmd, cwd, sinks, timeout, display_cmd):
+    tail = TailSink()
+    sinks = sinks + [tail]
+    with trace.span('run %s' % (display_cmd.split(' ')[0]), cmd=display_cmd) as span:
+        result = _run(cmd, display_cmd, cwd, sinks, timeout)
+        span.set(exit_code=result.returncode)
+
+    if result.returncode != 0 or result.timed_out:
+        raise CommandError(display_cmd, result.returncode, list(tail.lines), result.duration,
+                           timed_out=result.timed_out)
+    return result
+
+
+def _run(cmd, display_cmd, cwd, sinks, timeout):
+    start = time.time()
+    p = Popen(cmd, stderr=STDOUT, stdout=PIPE, cwd=cwd, shell=True, env=command_env())
+
+    timed_out = []
+    timer = None
+    if timeout is not None:
+        def kill():
+            timed_out.append(True)
+            p.kill()
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        for line in iter(p.stdout.readline, ''):
+            for sink in sinks:
+                sink.write(line)
+        p.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+        for sink in sinks:
+            sink.close()
+
+    duration = time.time() - start
+    logger.debug("'%s' exited with status %d in %.1fs" % (display_cmd, p.returncode, duration))
+
+    return CommandResult(display_cmd, p.returncode, duration, timed_out=bool(timed_out))
@@ -1,36 +1,46 @@
 import biplist
+from contextlib import contextmanager
+import datetime
 from fnmatch import fnmatch
+import itertools
 import os
+import posixpath
 import re
 import shutil
 import logging
-from subprocess import check_call, check_output
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import sys
-from tempfile import mkdtemp
+import threading
+import time
 from string import Template
+import zipfile
 
+from . import __version__
+from .cache import write_json_atomic
 from .defaults import defaults
-from .helpers import shellify, run_cmd, puts
-from .keychain import add_keychain_cmd, unlock_keychain, find_keychain
+from .helpers import shellify, run_cmd, puts, FileSink
+from .keychain import keychain_session, unlock_keychain, find_keychain
+from .plists import PlistSession, write_plist
 from .util import makedirs
+from . import trace
+from . import archive
+from . import buildcache
+from . import buildsettings
+from . import cms
+from . import codesign
+from . import executor
+from . import macho
 from . import provisioningprofile
+from . import staging
 
 
 logger = logging.getLogger(__name__)
 
+APP_INFO_PLIST_RE = re.compile(r'^Payload/[^/]+\.app/Info\.plist$')
 
-def _parse_build_settings(output):
-
-    build_settings = dict()
-
-    for l in output.splitlines():
-        # match lines like this:
-        #     KEY = VAL
-        if re.match(r'\s+.*( = ).*', l):
-            key, val = [x.strip() for x in l.split('=')[:2]]
-            build_settings[key] = val
-
-    return build_settings
+RESIGN_VARIANT_KEYS = ('profile', 'identity', 'keychain', 'bundle_id',
+                       'entitlements', 'output', 'add_resource_rules')
 
 
 def _determine_target_args(workspace=None, scheme=None, project=None, target=None, **kwargs):
@@ -56,15 +66,41 @@ def _determine_target_args(workspace=None, scheme=None, project=None, target=Non
 
 
 
+@trace.traced('build_ipa')
 def build_ipa(workspace=None, scheme=None, project=None, target=None,
               config=None, profile=None, identity=None, keychain=None,
               keychain_password=None, output=None, overwrite=False,
-              build_dir=None, dsym=False, clean=False, **kwargs):
+              build_dir=None, dsym=False, clean=False, build_log=None,
+              settings_cache=True, derived_data=None, incremental=False,
+              build_cache=False, thin=None, staging_dir=None, **kwargs):
+    """
+    Build and package a signed IPA, and return its path. `build_dir` and
+    `derived_data` set xcodebuild's SYMROOT and -derivedDataPath.
+
+    A manifest is written next to the IPA. With `incremental`, an existing
+    IPA at the output path is updated using it, and members whose files
+    haven't changed since are copied over without recompressing.
+
+    With `build_cache`, xcodebuild is skipped altogether when the same
+    inputs were built before, and the IPA and dSYM zip are restored from
+    the build cache instead.
+
+    `thin` is a list of architectures, or a comma-separated string of them;
+    fat binaries in the app are packaged with only those slices. The thinned
+    copies are written to a workspace from `staging`, in `staging_dir` if
+    that's given.
+    """
+    start = time.time()
+    thin_archs = _thin_archs(thin)
 
+    # unlocking the keychain and showing the build settings don't depend on
+    # each other, so they run at the same time
+    unlocking = None
     if keychain_password is not None:
         if keychain is None:
             keychain = os.path.expanduser("~/Library/Keychains/login.keychain")
-        unlock_keychain(keychain, keychain_password)
+        unlocking = executor.spawn(trace.traced('unlock_keychain')(unlock_keychain),
+                                   keychain, keychain_password)
 
     config = config or defaults['build_config']
 
@@ -83,8 +119,6 @@ def build_ipa(workspace=None, scheme=None, project=None, target=None,
         ])
 
     if keychain is not None:
-        run_cmd(add_keychain_cmd(keychain))
-
         build_args.extend([
             'OTHER_CODE_SIGN_FLAGS=--keychain=%s' %
             find_keychain(keychain)
@@ -95,6 +129,9 @@ def build_ipa(workspace=None, scheme=None, project=None, target=None,
             'SYMROOT=%s' % (os.path.realpath(build_dir))
         ])
 
+    if derived_data is not None:
+        build_args.extend(['-derivedDataPath', os.path.realpath(derived_data)])
+
     if profile is not None:
         prov_profile_path = provisioningprofile.find(profile)
         if prov_profile_path is None:
@@ -118,25 +155,66 @@ def build_ipa(workspace=None, scheme=None, project=None, target=None,
     #build_args.extend([
     #    'CODE_SIGN_RESOURCE_RULES_PATH=$(SDKROOT)/ResourceRules.plist'])
 
-    build_settings_cmd = ['xcodebuild', '-showBuildSettings'] + build_args
-    print shellify(build_settings_cmd)
-    build_settings_output = check_output(build_settings_cmd)
-    build_settings = _parse_build_settings(build_settings_output)
+    try:
+        build_settings_output = buildsettings.show_build_settings(
+            build_args, workspace=workspace, project=project, use_cache=settings_cache)
+    finally:
+        if unlocking is not None:
+            unlocking.result()
+    build_settings = buildsettings.select_target(
+        buildsettings.parse_build_settings(build_settings_output), target=target)
 
     if profile is None:
         # Read the profile from the build settings
         prov_profile_uuid = build_settings.get('PROVISIONING_PROFILE')
         if prov_profile_uuid is None or prov_profile_uuid.strip() == '':
-            print "couldn't find profile in build settings"
-            sys.exit(1)
+            raise Exception("Couldn't find profile in build settings.")
+        else:
+            file_name = '%s.mobileprovision' % (prov_profile_uuid.strip())
+            prov_profile_path = os.path.join(defaults['provisioning_profile_dir'], file_name)
+            if not os.path.exists(prov_profile_path):
+                raise Exception("Profile '%s' from build settings not found." % (prov_profile_uuid))
+
+    ## Restore from the build cache if nothing has changed
+
+    if build_cache:
+        cache = buildcache.BuildCache()
+        with trace.span('build cache lookup') as span:
+            source_root = os.path.dirname(os.path.abspath(workspace or project))
+            cache_key = buildcache.build_key(
+                source_root, build_settings_output,
+                build_args + (['thin=%s' % (','.join(thin_archs))] if thin_archs else []),
+                provisioningprofile.uuid(prov_profile_path), identity,
+                exclude=[build_dir, derived_data],
+                replacements=[(build_dir and os.path.realpath(build_dir), '$(SYMROOT)'),
+                              (derived_data and os.path.realpath(derived_data), '$(DERIVED_DATA)')])
+            entry = cache.lookup(cache_key)
+            span.set(key=cache_key, hit=entry is not None)
+        if entry is not None:
+            full_output_path = _ipa_output_path(output, dict(entry['info'], config=config))
+            paths = {'ipa': full_output_path}
+            if dsym:
+                paths['dsym'] = _dsym_zip_path(full_output_path)
+            with _writing_output(full_output_path):
+                with trace.span('build cache restore'):
+                    restored = cache.restore(cache_key, entry, paths)
+                if restored:
+                    puts("Restored '%s' from the build cache (%s)" % (full_output_path, cache_key))
+                    artifacts = dict((name, dict(path=path, size=entry['artifacts'][name]['size'],
+                                                 sha256=entry['artifacts'][name]['sha256']))
+                                     for (name, path) in paths.items())
+                    _write_artifact_record(full_output_path, dict(entry['info'], config=config),
+                                           prov_profile_path, identity, artifacts,
+                                           cache_key=cache_key)
+                    return full_output_path
         else:
-            # TODO: clean this up
-            file_name = '%s.mobileprovision' % (prov_profile_uuid)
-            prov_profile_path = os.path.join(defaults['provisioning_profile_dir'])
+            logger.info('Build cache miss (%s)' % (cache_key))
+            cache.record_miss()
 
-    build_cmd = shellify(['xcodebuild'] + build_args)
-    print build_cmd
-    run_cmd(build_cmd)
+    build_cmd = ['xcodebuild'] + build_args
+    puts(shellify(build_cmd))
+    with trace.span('xcodebuild build'), keychain_session(keychain):
+        run_cmd(build_cmd, sinks=[FileSink(build_log)] if build_log else None)
 
     # because BUILT_PRODUCTS_DIR from -showBuildSettings can't be trusted if
     # SYMROOT isn't specified...
@@ -147,24 +225,17 @@ def build_ipa(workspace=None, scheme=None, project=None, target=None,
             '%s-iphoneos' % (build_settings['CONFIGURATION']))
 
     full_product_name = build_settings['FULL_PRODUCT_NAME']
-    full_product_path = os.path.join(built_products_dir, full_product_name)
+    # install-style builds (DEPLOYMENT_LOCATION) leave a link to the product
+    full_product_path = os.path.realpath(os.path.join(built_products_dir, full_product_name))
 
     # read Info.plist
-    info_plist_path = os.path.join(built_products_dir, build_settings['INFOPLIST_PATH'])
-    info_plist = biplist.readPlist(info_plist_path)
-    build_version = info_plist['CFBundleVersion']
-    marketing_version = info_plist['CFBundleShortVersionString']
-
-    tmp_dir = mkdtemp()
-    payload_dir = os.path.join(tmp_dir, 'Payload')
-    makedirs(payload_dir)
-
-    payload_app_path = os.path.join(payload_dir, os.path.basename(full_product_path))
-    shutil.copytree(full_product_path, payload_app_path)
-
-    embedded_prov_profile_path = os.path.join(payload_app_path, 'embedded.mobileprovision')
-    src_prov_profile_path = provisioningprofile.find(profile)
-    shutil.copyfile(src_prov_profile_path, embedded_prov_profile_path)
+    with trace.span('read Info.plist'):
+        info_plist_path = os.path.join(built_products_dir, build_settings['INFOPLIST_PATH'])
+        info_plist = biplist.readPlist(info_plist_path)
+        build_version = info_plist['CFBundleVersion']
+        marketing_version = info_plist['CFBundleShortVersionString']
+        bundle_id = info_plist.get('CFBundleIdentifier')
+        executable = info_plist.get('CFBundleExecutable')
 
     app_name = os.path.splitext(full_product_name)[0]
     output_template_vars = {
@@ -174,6 +245,169 @@ def build_ipa(workspace=None, scheme=None, project=None, target=None,
         'config': config,
     }
 
+    full_output_path = _ipa_output_path(output, output_template_vars)
+
+    # jobs running at once mustn't package over each other
+    with _writing_output(full_output_path):
+        if overwrite and not incremental and os.path.exists(full_output_path):
+            os.remove(full_output_path)
+
+        makedirs(os.path.dirname(full_output_path))
+
+        ## Package the app straight from the build products, with the profile
+        ## swapped in, rather than staging a copy. The IPA and dSYM zip are
+        ## written at the same time, and hashed as they're written.
+
+        app_arcname = 'Payload/%s' % (full_product_name)
+        entries = itertools.chain(
+            [archive.Entry.directory('Payload')],
+            archive.tree_entries(full_product_path, app_arcname, follow_external=True))
+        overlays = {
+            app_arcname + '/embedded.mobileprovision':
+                archive.Entry.from_path(app_arcname + '/embedded.mobileprovision',
+                                        os.path.realpath(prov_profile_path)),
+        }
+
+        @trace.traced('package ipa')
+        def package_ipa():
+            return archive.update_archive(full_output_path,
+                                          archive.overlay_entries(entries, overlays),
+                                          reuse=incremental)
+
+        @trace.traced('package dsym')
+        def package_dsym():
+            dsym_name = full_product_name + '.dSYM'
+            dsym_path = os.path.realpath(os.path.join(built_products_dir, dsym_name))
+            return archive.update_archive(
+                _dsym_zip_path(full_output_path),
+                archive.tree_entries(dsym_path, dsym_name, follow_external=True),
+                reuse=incremental)
+
+        packagers = {'ipa': package_ipa}
+        if dsym:
+            packagers['dsym'] = package_dsym
+
+        def package():
+            names = sorted(packagers)
+            return dict(zip(names, executor.gather([executor.spawn(packagers[name])
+                                                    for name in names])))
+
+        def packaged_uuids():
+            # the thinned copy of the executable, if there is one, is the one packaged
+            entry = overlays.get('%s/%s' % (app_arcname, executable))
+            return _binary_uuids(entry.path if entry is not None
+                                 else os.path.join(full_product_path, executable))
+
+        ## Thin fat binaries into a workspace, and package the copies
+
+        if thin_archs:
+            binaries = list(macho.find_binaries(full_product_path))
+            with staging.workspace(size=sum(os.path.getsize(path) for path in binaries),
+                                   prefix='fox-thin-', directory=staging_dir) as workspace:
+                with trace.span('thin binaries', archs=','.join(thin_archs)) as span:
+                    thinned, saved = _thin_binaries(full_product_path, binaries, app_arcname,
+                                                    thin_archs, workspace.path)
+                    span.set(binaries=len(thinned), saved=saved)
+                overlays.update(thinned)
+                logger.info("Thinned %d binaries to %s, dropping %d bytes" % (
+                    len(thinned), ', '.join(thin_archs), saved))
+                artifacts = package()
+                if executable is not None:
+                    output_template_vars['uuids'] = packaged_uuids()
+        else:
+            artifacts = package()
+            if executable is not None:
+                output_template_vars['uuids'] = packaged_uuids()
+
+        output_template_vars['bundle_id'] = bundle_id
+        _write_artifact_record(full_output_path, output_template_vars, prov_profile_path,
+                               identity, artifacts)
+        for name in sorted(artifacts):
+            puts('%s  %s' % (artifacts[name]['sha256'], artifacts[name]['path']))
+
+        if build_cache:
+            with trace.span('build cache store'):
+                try:
+                    cache.store(cache_key,
+                                dict((name, a['path']) for (name, a) in artifacts.items()),
+                                info=dict((k, v) for (k, v) in output_template_vars.items()
+                                          if k != 'config'),
+                                duration=time.time() - start)
+                except (IOError, OSError), e:
+                    logger.warning("Couldn't add the build to the build cache: %s" % (e))
+
+    return full_output_path
+
+
+def _thin_archs(thin):
+    if not thin:
+        return None
+    if isinstance(thin, basestring):
+        thin = [thin]
+    return sorted(set(arch.strip() for value in thin for arch in value.split(',') if arch.strip()))
+
+
+def _thin_binaries(app_path, binaries, app_arcname, archs, dest_dir):
+    """
+    Write copies of the fat ones of `binaries`, in the app at `app_path`,
+    with only the slices for `archs` to `dest_dir`. Returns archive entries
+    for them, by arcname, and the number of bytes dropped.
+    """
+    entries = dict()
+    saved = 0
+    for path in binaries:
+        rel = os.path.relpath(path, app_path)
+        thinned_path = os.path.join(dest_dir, rel)
+        makedirs(os.path.dirname(thinned_path))
+        dropped = macho.thin(path, archs, thinned_path)
+        if dropped is None:
+            continue
+        shutil.copymode(path, thinned_path)
+        arcname = '/'.join([app_arcname] + rel.split(os.sep))
+        entries[arcname] = archive.Entry.from_path(arcname, thinned_path)
+        saved += dropped
+    return entries, saved
+
+
+def _binary_uuids(path):
+    """Return the LC_UUID of each architecture of the binary at `path`, by
+    architecture, for pairing it with its dSYM."""
+    try:
+        return dict((s.arch, s.uuid) for s in macho.read(path))
+    except (IOError, OSError, macho.MachOError), e:
+        logger.warning("Couldn't read the UUIDs of '%s': %s" % (path, e))
+        return None
+
+
+def build_ipa_async(**kwargs):
+    """
+    Start `build_ipa` on another thread and return an `executor.Future` for
+    the IPA's path. Cancelling the future kills the tools the build is
+    running and fails the build.
+    """
+    return executor.spawn(build_ipa, **kwargs)
+
+
+_outputs_lock = threading.Lock()
+_outputs_in_use = set()
+
+
+@contextmanager
+def _writing_output(path):
+    """Claim `path` for the block, raising if another build in this process
+    is already writing it."""
+    with _outputs_lock:
+        if path in _outputs_in_use:
+            raise Exception("Another build is already writing '%s'." % (path))
+        _outputs_in_use.add(path)
+    try:
+        yield
+    finally:
+        with _outputs_lock:
+            _outputs_in_use.discard(path)
+
+
+def _ipa_output_path(output, output_template_vars):
     if output is None:
         output = '.'  # default to current directory and ipa format
 
@@ -182,208 +416,466 @@ def build_ipa(workspace=None, scheme=None, project=None, target=None,
 
     if os.path.isdir(output_path):
         ipa_name = Template(defaults['ipa_output_template']).substitute(output_template_vars)
-        full_output_path = os.path.join(output_path, ipa_name)
-    else:
-        full_output_path = output_path
-
-    if overwrite and os.path.exists(full_output_path):
-        os.remove(full_output_path)
+        return os.path.join(output_path, ipa_name)
+    return output_path
+
+
+def artifact_record_path(ipa_path):
+    return os.path.splitext(ipa_path)[0] + '.artifacts.json'
+
+
+def _write_artifact_record(ipa_path, info, profile_path, identity, artifacts, cache_key=None):
+    """Write a JSON record of a build's artifacts, with their sizes and
+    SHA-256 digests, next to the IPA."""
+    profile = provisioningprofile.metadata(profile_path)
+    write_json_atomic(artifact_record_path(ipa_path), {
+        'fox_version': __version__,
+        'created': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        'app_name': info.get('app_name'),
+        'bundle_id': info.get('bundle_id'),
+        'marketing_version': info.get('marketing_version'),
+        'build_version': info.get('build_version'),
+        'config': info.get('config'),
+        'profile': {'name': profile['name'], 'uuid': profile['uuid']},
+        'identity': identity,
+        'build_cache': cache_key,
+        'uuids': info.get('uuids'),
+        'artifacts': artifacts,
+    })
+
+
+def _dsym_zip_path(ipa_path):
+    ipa_name = os.path.basename(ipa_path)
+    return os.path.join(os.path.dirname(ipa_path),
+                        os.path.splitext(ipa_name)[0] + '.dSYM.zip')
+
+
+def _app_members(zf):
+    """Return the names of the Info.plist and embedded.mobileprovision
+    members of the app in the IPA `zf`, read from its central directory."""
+    info_plist_name = None
+    for member in zf.namelist():
+        if APP_INFO_PLIST_RE.match(member):
+            info_plist_name = member
+            break
+    if info_plist_name is None:
+        raise Exception("Couldn't find an app in '%s'." % (zf.filename))
+    prov_profile_name = posixpath.join(posixpath.dirname(info_plist_name),
+                                       'embedded.mobileprovision')
+    if prov_profile_name not in zf.NameToInfo:
+        prov_profile_name = None
+    return info_plist_name, prov_profile_name
+
+
+def _isoformat(date):
+    if date is None:
+        return None
+    return date.isoformat()
+
+
+@trace.traced('extract_info')
+def extract_info(ipa=None):
+    """
+    Return a dict of metadata about `ipa`: bundle id, versions, and the
+    UUID, name, team and expiration date of its embedded profile. Only
+    Info.plist and embedded.mobileprovision are decompressed.
+    """
 
-    makedirs(os.path.dirname(full_output_path))
+    assert ipa
 
-    # Change working dir so 'Payload' is at the root of the archive.
-    # Might be a way to do this with args to zip but I couldn't find it.
-    pwd = os.getcwd()
-    os.chdir(tmp_dir)
-    check_call(['zip', '-qr', full_output_path, 'Payload'])
-    os.chdir(pwd)
+    if not os.path.exists(ipa):
+        raise IOError("Couldn't find ipa '%s'." % (ipa))
 
-    if dsym:
-        dsym_name = os.path.basename(full_product_path) + '.dSYM'
+    with zipfile.ZipFile(ipa) as zf:
+        info_plist_name, prov_profile_name = _app_members(zf)
+        info_plist = biplist.readPlistFromString(zf.read(info_plist_name))
+        if prov_profile_name is not None:
+            prov_profile_data = zf.read(prov_profile_name)
+        else:
+            prov_profile_data = None
 
-        ipa_name = os.path.basename(full_output_path)
-        output_dir = os.path.dirname(full_output_path)
+    info = {
+        'ipa': ipa,
+        'bundle_id': info_plist.get('CFBundleIdentifier'),
+        'bundle_version': info_plist.get('CFBundleVersion'),
+        'marketing_version': info_plist.get('CFBundleShortVersionString'),
+    }
 
-        dsym_zip_name = os.path.splitext(ipa_name)[0] + '.dSYM.zip'
-        dsym_zip_path = os.path.join(output_dir, dsym_zip_name)
+    if prov_profile_data is not None:
+        prov_profile = provisioningprofile.metadata_from_plist(
+            provisioningprofile.plist_from_content(cms.content(prov_profile_data)))
+        info.update({
+            'profile_uuid': prov_profile['uuid'],
+            'profile_name': prov_profile['name'],
+            'profile_expiration_date': _isoformat(prov_profile['expiration_date']),
+            'team_id': prov_profile['team_id'],
+            'team_name': prov_profile['team_name'],
+        })
 
-        run_cmd(shellify(['zip', '-y', '-r', dsym_zip_path, dsym_name]),
-                cwd=built_products_dir)
+    return info
 
 
-def extract_info(ipa=None):
+def extract_infos(ipas, jobs=None):
+    """
+    Run `extract_info` on each of `ipas` concurrently, yielding results as
+    they complete. A failure is reported as a dict with an `error` key.
+    """
 
-    assert ipa
+    def safe_extract_info(ipa):
+        try:
+            return extract_info(ipa)
+        except Exception, e:
+            return {'ipa': ipa, 'error': str(e)}
 
-    if not os.path.exists(ipa):
-        # TODO: better error
-        print "couldn't find ipa"
-        sys.exit(1)
+    pool = ThreadPool(jobs or multiprocessing.cpu_count())
+    try:
+        for info in pool.imap_unordered(safe_extract_info, ipas):
+            yield info
+    finally:
+        pool.terminate()
 
-    tmp_dir = mkdtemp()
 
-    ## Extract IPA
-
-    check_call(['unzip', '-qq', ipa, '-d', tmp_dir])
-    
-    payload_path = os.path.join(tmp_dir, 'Payload')
+def _find_app(payload_path):
     for file in os.listdir(payload_path):
         if fnmatch(file, '*.app'):
-            app_path = os.path.join(payload_path, file)
+            return os.path.join(payload_path, file)
+    raise Exception("Couldn't find an app in '%s'." % (payload_path))
 
-    # Get Bundle ID from Info.plist
 
-    bundle_id = check_output(["/usr/libexec/PlistBuddy",
-        "-c", "Print :CFBundleIdentifier",
-        os.path.join(app_path, "Info.plist")]).strip()
+def _is_macho(path):
+    with open(path, 'rb') as f:
+        return macho.is_macho(f.read(4))
 
-    bundle_version = check_output(["/usr/libexec/PlistBuddy",
-        "-c", "Print :CFBundleVersion",
-        os.path.join(app_path, "Info.plist")]).strip()
 
-    shutil.rmtree(tmp_dir)
+def _rewritten_by_name(parts):
+    """Whether resigning rewrites the file at the path split into `parts`,
+    going by its name alone."""
+    return parts[-1] in ('Info.plist', 'embedded.mobileprovision') or '_CodeSignature' in parts
 
-    return { 'bundle_id': bundle_id, 'bundle_version': bundle_version }
 
-   
+def _needs_private_copy(path):
+    """Whether resigning might rewrite the file at `path` in place, so it
+    can't be shared between staging trees."""
+    return _rewritten_by_name(path.split(os.sep)) or _is_macho(path)
 
-def resign_ipa(ipa=None, profile=None, identity=None, keychain=None,
-        bundle_id=None, entitlements=None, output=None,
-        add_resource_rules=False, **kwargs):
+
+def _resign_staging_size(ipa, variant_count):
     """
-    Took work from:
+    Estimate the bytes staged to resign the IPA at `ipa` into
+    `variant_count` variants, from its zip directory: the extracted IPA,
+    plus, with several variants, each variant's private copies of the files
+    `_stage_tree` doesn't hardlink.
+    """
+    extracted = 0
+    private = 0
+    with zipfile.ZipFile(ipa) as zf:
+        for zinfo in zf.infolist():
+            if zinfo.filename.endswith('/'):
+                continue
+            extracted += zinfo.file_size
+            if variant_count < 2:
+                continue
+            if _rewritten_by_name(zinfo.filename.split('/')):
+                private += zinfo.file_size
+            elif zinfo.file_size >= 4:
+                with zf.open(zinfo) as member:
+                    if macho.is_macho(member.read(4)):
+                        private += zinfo.file_size
+    return extracted + private * variant_count
+
+
+def _stage_tree(src, dest):
+    """
+    Recreate the tree at `src` under `dest`, hardlinking files that resigning
+    leaves alone and copying the ones it modifies.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        dest_dir = os.path.join(dest, os.path.relpath(dirpath, src))
+        makedirs(dest_dir)
+        for name in list(dirnames) + filenames:
+            path = os.path.join(dirpath, name)
+            dest_path = os.path.join(dest_dir, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), dest_path)
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif name in dirnames:
+                continue
+            elif _needs_private_copy(path):
+                shutil.copy2(path, dest_path)
+            else:
+                try:
+                    os.link(path, dest_path)
+                except OSError:
+                    shutil.copy2(path, dest_path)
+
+
+@trace.traced('read profile')
+def _load_profile(profile):
+    """Find `profile` and return its path and parsed plist."""
+    path = provisioningprofile.find(profile)
+    if path is None:
+        raise Exception("Profile matching '%s' not found." % (profile))
+    return path, provisioningprofile.read_plist(path)
+
+
+def _resign_app(app_path, work_dir, profile=None, identity=None, keychain=None,
+        bundle_id=None, entitlements=None, add_resource_rules=False, loaded_profile=None,
+        sign_workers=None):
+    """Resign the app bundle at `app_path` and the code nested in it,
+    using `work_dir` for scratch files. `loaded_profile` is the result of
+    `_load_profile(profile)`, if it's already been read. Up to
+    `sign_workers` nested bundles are signed at once."""
 
-        http://stackoverflow.com/questions/6896029/re-sign-ipa-iphone
+    ## Remove Old Code Signature
 
-    and:
+    shutil.rmtree(os.path.join(app_path, '_CodeSignature'))
 
-        https://github.com/talk-to/resign-ipa/blob/master/bin/resign-ipa
+    ## Read the Provisioning Profile
 
-    """
+    src_prov_profile_path, prov_profile = loaded_profile or _load_profile(profile)
+    prov_entitlements = prov_profile['Entitlements']
 
-    assert ipa
-    assert profile
-    assert identity
+    ## Install New Provisioning Profile
 
-    if not os.path.exists(ipa):
-        # TODO: better error
-        print "couldn't find ipa"
-        sys.exit(1)
+    with trace.span('install profile'):
+        embedded_prov_profile_path = os.path.join(app_path, 'embedded.mobileprovision')
+        os.remove(embedded_prov_profile_path)
+        shutil.copyfile(src_prov_profile_path, embedded_prov_profile_path)
 
-    tmp_dir = mkdtemp()
 
-    ## Extract IPA
+    ## Extract the App ID and Team ID for later use
 
-    check_call(['unzip', ipa, '-d', tmp_dir])
+    app_id = prov_entitlements['application-identifier']
+    team_id = prov_entitlements['com.apple.developer.team-identifier']
 
-    payload_path = os.path.join(tmp_dir, 'Payload')
-    for file in os.listdir(payload_path):
-        if fnmatch(file, '*.app'):
-            app_path = os.path.join(payload_path, file)
 
-    ## Remove Old Code Signature
+    ## If bundle id is not supplied, set from extracted
 
-    shutil.rmtree(os.path.join(app_path, '_CodeSignature'))
+    if bundle_id is None:
 
-    ## Install New Provisioning Profile
+        assert app_id.startswith(team_id), "app id doesn't start with team id - this is unexpected"
 
-    embedded_prov_profile_path = os.path.join(app_path, 'embedded.mobileprovision')
-    os.remove(embedded_prov_profile_path)
+        bundle_id = app_id[len(team_id) + 1:]  # +1 for '.' between team_id and bundle_id
 
-    src_prov_profile_path = provisioningprofile.find(profile)
-    shutil.copyfile(src_prov_profile_path, embedded_prov_profile_path)
 
-    ## Copy and Strip Provisioning Profile of Code Signature Data
+    ## Set new bundle id
 
-    stripped_prov_profile_path = os.path.join(tmp_dir,
-    'embedded.mobileprovision.stripped.plist')
+    with trace.span('set bundle id'), \
+            PlistSession(os.path.join(app_path, "Info.plist")) as info_plist:
+        old_bundle_id = info_plist.get('CFBundleIdentifier')
+        info_plist.set('CFBundleIdentifier', bundle_id)
 
-    if os.path.exists(stripped_prov_profile_path):
-        os.remove(stripped_prov_profile_path)
+    ## If entitlements are not supplied, extract from provisioning profile
 
-    check_call(["security", "cms", "-D", "-i",  embedded_prov_profile_path,
-        "-o", stripped_prov_profile_path])
+    if entitlements is None:
+        entitlements_data = dict(prov_entitlements)
 
+        ## experimental, set the keychain access group to just the app
 
-    ## Extract the App ID and Team ID for later use
+        if entitlements_data.get('keychain-access-groups'):
+            entitlements_data['keychain-access-groups'] = \
+                [app_id] + entitlements_data['keychain-access-groups'][1:]
 
-    app_id = run_cmd(shellify(["/usr/libexec/PlistBuddy", "-c",
-        "Print:Entitlements:application-identifier",
-        stripped_prov_profile_path])).strip()
+        entitlements = os.path.join(work_dir, 'Extracted-Entitlements.plist')
+        write_plist(entitlements_data, entitlements)
 
-    team_id = run_cmd(shellify(["/usr/libexec/PlistBuddy", "-c",
-        "Print:Entitlements:com.apple.developer.team-identifier",
-        stripped_prov_profile_path])).strip()
 
+    ## Re-sign, nested code first
 
-    ## If bundle id is not supplied, set from extracted
+    keychain_path = find_keychain(keychain) if keychain is not None else None
+    resource_rules = os.path.join(app_path, 'ResourceRules.plist') if add_resource_rules else None
 
-    if bundle_id is None:
+    def entitlements_for(signable):
+        if signable.parent is None:
+            return entitlements
+        return _nested_entitlements(signable, work_dir, identity, team_id,
+                                    old_bundle_id, bundle_id)
 
-        assert app_id.startswith(team_id), "app id doesn't start with team id - this is unexpected"
+    codesign.sign_bundle(app_path, identity, entitlements_for=entitlements_for,
+                         keychain_path=keychain_path, resource_rules=resource_rules,
+                         workers=sign_workers)
 
-        bundle_id = app_id[len(team_id) + 1:]  # +1 for '.' between team_id and bundle_id
 
+def _nested_entitlements(signable, work_dir, identity, team_id, old_bundle_id, bundle_id):
+    """
+    Prepare the app or app extension `signable`, nested in the app being
+    resigned, and return the path of the entitlements to sign it with. Its
+    bundle id follows the app's if the app's changed, and the best profile
+    for it is installed; if there isn't one, it keeps its embedded profile.
+    """
+    nested_id = None
+    info_plist_path = os.path.join(signable.path, 'Info.plist')
+    if os.path.exists(info_plist_path):
+        with PlistSession(info_plist_path) as info_plist:
+            nested_id = info_plist.get('CFBundleIdentifier')
+            if nested_id and old_bundle_id and bundle_id != old_bundle_id and \
+                    nested_id.startswith(old_bundle_id + '.'):
+                nested_id = bundle_id + nested_id[len(old_bundle_id):]
+                info_plist.set('CFBundleIdentifier', nested_id)
+
+    embedded_prov_profile_path = os.path.join(signable.path, 'embedded.mobileprovision')
+    profile_path = None
+    if nested_id:
+        profile_path = provisioningprofile.find_best(nested_id, identity=identity,
+                                                     team_id=team_id)
+    if profile_path is not None:
+        shutil.copyfile(profile_path, embedded_prov_profile_path)
+    elif os.path.exists(embedded_prov_profile_path):
+        logger.warning("No profile for '%s', keeping the one embedded in '%s'" % (
+            nested_id, signable.relpath()))
+        profile_path = embedded_prov_profile_path
+    else:
+        logger.warning("No profile for '%s', signing it without entitlements" % (
+            signable.relpath()))
+        return None
 
-    ## Set new bundle id
+    entitlements = os.path.join(work_dir, 'Entitlements-%s.plist' % (
+        signable.relpath().replace(os.sep, '-')))
+    write_plist(dict(provisioningprofile.read_plist(profile_path)['Entitlements']), entitlements)
+    return entitlements
 
-    check_call(["/usr/libexec/PlistBuddy",
-        "-c", "Set :CFBundleIdentifier %s" % (bundle_id),
-        os.path.join(app_path, "Info.plist")])
 
-    check_call(["cat", os.path.join(app_path, "Info.plist")])
+@trace.traced('resign variant')
+def _resign_variant(ipa, work_dir, extracted, variant, stream=False, profile_future=None,
+                    sign_workers=None):
+    payload_path = os.path.join(work_dir, 'Payload')
+    app_path = _find_app(payload_path)
 
-    ## If entitlements are not supplied, extract from provisioning profile
+    _resign_app(app_path, work_dir,
+                loaded_profile=profile_future.result() if profile_future is not None else None,
+                sign_workers=sign_workers,
+                **dict((k, v) for (k, v) in variant.items()
+                       if k in RESIGN_VARIANT_KEYS and k != 'output'))
 
-    if entitlements is None:
-        entitlements_data = run_cmd(shellify([
-            "/usr/libexec/PlistBuddy", "-x", "-c",
-            "Print :Entitlements", stripped_prov_profile_path]))
+    output_path = os.path.abspath(variant['output'])
 
-        entitlements = os.path.join(tmp_dir, 'Extracted-Entitlements.plist')
-        if os.path.exists(entitlements):
-            os.remove(entitlements)
+    ## Rezip
 
-        with open(entitlements, "w") as f:
-            f.write(entitlements_data)
+    with trace.span('package ipa', stream=stream):
+        if stream:
+            app_arcname = 'Payload/%s/' % (os.path.basename(app_path))
+            archive.rewrite_archive(ipa, output_path, payload_path, 'Payload', extracted,
+                changed=[app_arcname + name for name in
+                         ('Info.plist', 'embedded.mobileprovision', '_CodeSignature/')])
+        else:
+            archive.write_archive(output_path, archive.tree_entries(payload_path, 'Payload'))
 
-        ## experimental, set the keychain access group to just the app
+    return output_path
 
-        check_call(["/usr/libexec/PlistBuddy",
-            "-c", "Set :keychain-access-groups:0 %s" % (app_id),
-            entitlements])
 
-    
-    ## Build codesign command
+@trace.traced('resign_ipa')
+def resign_ipa(ipa=None, profile=None, identity=None, keychain=None,
+        bundle_id=None, entitlements=None, output=None,
+        add_resource_rules=False, stream=False, variants=None, workers=None,
+        sign_workers=None, staging_dir=None, **kwargs):
+    """
+    Took work from:
 
-    codesign_args = ['codesign', '-f', '-s', identity,
-            '--entitlements', entitlements]
+        http://stackoverflow.com/questions/6896029/re-sign-ipa-iphone
 
-    if add_resource_rules:
-        codesign_args.extend(['--resource-rules',
-            os.path.join(app_path, 'ResourceRules.plist')])
+    and:
 
-    if keychain is not None:
-        keychain_path = find_keychain(keychain)
-        codesign_args.extend(['--keychain', keychain_path])
+        https://github.com/talk-to/resign-ipa/blob/master/bin/resign-ipa
 
-    codesign_args.extend([app_path])
+    With `stream`, members of `ipa` that resigning doesn't touch are copied
+    to `output` as-is instead of being recompressed.
 
-   
-     ## Re-sign!
+    `variants` is an optional list of dicts with any of the keys `profile`,
+    `identity`, `keychain`, `bundle_id`, `entitlements` and `output`; missing
+    keys fall back to the matching arguments. The IPA is extracted once and
+    each variant is resigned in its own staging tree, up to `workers` at a
+    time. Returns the list of output paths.
 
-    codesign_output = check_output(codesign_args)
-    puts(codesign_output)
+    Frameworks, dylibs, app extensions and watch apps inside the app are
+    signed before the bundles that contain them, up to `sign_workers` at
+    once in each variant.
 
-    output_path = os.path.abspath(output)
+    The IPA is extracted into a workspace from `staging`, in memory if it
+    fits, or in `staging_dir` if that's given.
+    """
 
-    ## Rezip
+    assert ipa
 
-    # Change working dir so 'Payload' is at the root of the archive.
-    # Might be a way to do this with args to zip but I couldn't find it.
-    pwd = os.getcwd()
-    os.chdir(tmp_dir)
-    check_call(['zip', '-qr', output_path, 'Payload'])
-    os.chdir(pwd)
+    if not os.path.exists(ipa):
+        # TODO: better error
+        print "couldn't find ipa"
+        sys.exit(1)
 
-    shutil.rmtree(tmp_dir)
+    base = dict(profile=profile, identity=identity, keychain=keychain,
+                bundle_id=bundle_id, entitlements=entitlements, output=output,
+                add_resource_rules=add_resource_rules)
+    variants = [dict(base.items() + [(k, v) for (k, v) in variant.items() if v is not None])
+                for variant in (variants or [dict()])]
+    for variant in variants:
+        assert variant['profile']
+        assert variant['identity']
+        assert variant['output']
+
+    # find and decode the profiles while the IPA is extracted
+    profiles = dict((name, executor.spawn(_load_profile, name))
+                    for name in set(variant['profile'] for variant in variants))
+
+    size = _resign_staging_size(ipa, len(variants))
+    with staging.workspace(size=size, prefix='fox-resign-', directory=staging_dir) as workspace:
+        tmp_dir = workspace.path
+
+        ## Extract IPA
+
+        extracted_dir = os.path.join(tmp_dir, 'extracted')
+        archive.extract_archive(ipa, extracted_dir)
+        extracted_payload_path = os.path.join(extracted_dir, 'Payload')
+        _find_app(extracted_payload_path)
+
+        ## Stage a tree for each variant
+
+        jobs = []
+        for i, variant in enumerate(variants):
+            if len(variants) == 1:
+                work_dir = extracted_dir
+            else:
+                work_dir = os.path.join(tmp_dir, 'variant-%d' % (i))
+                with trace.span('stage variant', output=variant['output']):
+                    _stage_tree(extracted_payload_path, os.path.join(work_dir, 'Payload'))
+            jobs.append((work_dir, variant))
+
+        # snapshot after staging, since hardlinking touches every file's ctime
+        jobs = [(work_dir, archive.snapshot(os.path.join(work_dir, 'Payload'), 'Payload')
+                 if stream else None, variant) for (work_dir, variant) in jobs]
+
+        ## Resign variants
+
+        workers = min(workers or defaults['resign_workers'] or multiprocessing.cpu_count(),
+                      len(jobs))
+
+        def resign_job(job):
+            work_dir, extracted, variant = job
+            return _resign_variant(ipa, work_dir, extracted, variant, stream=stream,
+                                   profile_future=profiles[variant['profile']],
+                                   sign_workers=sign_workers)
+
+        futures = executor.map_async(resign_job, jobs, workers)
+        if len(futures) == 1:
+            return [futures[0].result()]
+        output_paths = []
+        failures = []
+        for variant, future in zip(variants, futures):
+            try:
+                output_paths.append(future.result())
+            except Exception, e:
+                logger.error("Resigning '%s' failed: %s" % (variant['output'], e))
+                failures.append(e)
+
+        if failures:
+            raise Exception("%d of %d variants failed to resign." % (len(failures), len(variants)))
+
+        return output_paths
+
+
+def resign_ipa_async(**kwargs):
+    """
+    Start `resign_ipa` on another thread and return an `executor.Future`
+    for its output paths. Cancelling the future kills the running codesigns
+    and fails the resign.
+    """
+    return executor.spawn(resign_ipa, **kwargs)
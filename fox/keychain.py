@@ -1,20 +1,52 @@
+from contextlib import contextmanager
+import errno
+import json
+import logging
 import os
 import shutil
-from subprocess import check_output
+import threading
+import uuid
 
+from .cache import write_json_atomic
 from .helpers import run_cmd, shellify
+from . import executor
 from .defaults import defaults
+from .util import file_lock
 
 USER_KEYCHAIN_DIR = os.path.expanduser("~/Library/Keychains/")
 
+logger = logging.getLogger(__name__)
+
+_search_list_cache = None
+_search_list_lock = threading.Lock()
+
+
+def search_list(refresh=False):
+    """
+    Return the keychain search list, in order. The list is cached for the
+    life of the process and refreshed whenever fox changes it.
+    """
+    global _search_list_cache
+    with _search_list_lock:
+        if refresh or _search_list_cache is None:
+            security_output = executor.output(['security', 'list-keychains'])
+            _search_list_cache = [k.strip()[1:-1] for k in security_output.split('\n')
+                                  if len(k.strip()) > 0]
+        return list(_search_list_cache)
+
+
+def _set_search_list(keychains):
+    global _search_list_cache
+    run_cmd(['security', 'list-keychains', '-s'] + keychains)
+    with _search_list_lock:
+        _search_list_cache = list(keychains)
+
 
 def list_keychains():
     """
     Return a set containing paths to all installed keychains.
     """
-    security_output = check_output(['security', 'list-keychains'])
-    keychains = set([k.strip()[1:-1] for k in security_output.split('\n') if len(k) > 0])
-    return keychains
+    return set(search_list())
 
 
 def find_keychain(keychain_name):
@@ -50,19 +82,132 @@ def add_keychain_cmd(keychain):
     """
     
     keychain_path = find_keychain(keychain)
-    keychains = list_keychains()
-    keychains.add(keychain_path)
+    keychains = search_list()
+    if keychain_path not in keychains:
+        keychains.append(keychain_path)
     args = ['security', 'list-keychains', '-s']
-    args.extend(list(keychains))
+    args.extend(keychains)
     return shellify(args)
 
 
 def add_keychain(keychain):
     """
     Searches for `keychain` using `find_keychain` and adds to the to keychain
-    search list.
+    search list, unless it's already there.
+    """
+    keychain_path = _find_keychain_or_raise(keychain)
+    with _search_list_mutation():
+        keychains = search_list(refresh=True)
+        if keychain_path not in keychains:
+            _set_search_list(keychains + [keychain_path])
+
+
+def _find_keychain_or_raise(keychain):
+    keychain_path = find_keychain(keychain)
+    if keychain_path is None:
+        raise ValueError("Keychain '%s' not found." % (keychain))
+    return keychain_path
+
+
+@contextmanager
+def _search_list_mutation():
+    """
+    Hold an exclusive lock, shared by all fox processes on this host, while
+    reading and changing the search list and the session state.
     """
-    run_cmd(add_keychain_cmd(keychain))
+    with file_lock(os.path.join(defaults['cache_dir'], 'keychain.lock')):
+        yield
+
+
+def _sessions_path():
+    return os.path.join(defaults['cache_dir'], 'keychain-sessions.json')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _load_sessions():
+    """Return a dict of keychain path to the owners of its temporary
+    addition, dropping owners whose process has exited."""
+    try:
+        with open(_sessions_path()) as f:
+            sessions = json.load(f)
+    except (IOError, ValueError):
+        sessions = {}
+    for owners in sessions.values():
+        owners[:] = [o for o in owners if _pid_alive(int(o.split(':')[0]))]
+    return sessions
+
+
+class KeychainSession(object):
+    """
+    Temporarily adds a keychain to the search list. Concurrent sessions for
+    the same keychain share one addition, which is removed when the last of
+    them ends. Keychains that were already in the search list are left alone.
+    """
+
+    def __init__(self, keychain):
+        self.keychain_path = _find_keychain_or_raise(keychain)
+        self.owner = '%d:%s' % (os.getpid(), uuid.uuid4().hex)
+        self.active = False
+
+    def acquire(self):
+        with _search_list_mutation():
+            sessions = _load_sessions()
+            owners = sessions.get(self.keychain_path)
+            if owners:
+                # another session already added it
+                owners.append(self.owner)
+            else:
+                keychains = search_list(refresh=True)
+                if self.keychain_path in keychains:
+                    sessions.pop(self.keychain_path, None)
+                else:
+                    _set_search_list(keychains + [self.keychain_path])
+                    sessions[self.keychain_path] = [self.owner]
+            write_json_atomic(_sessions_path(), sessions)
+        self.active = True
+
+    def release(self):
+        if not self.active:
+            return
+        self.active = False
+        with _search_list_mutation():
+            sessions = _load_sessions()
+            owners = sessions.get(self.keychain_path)
+            if owners is None:
+                return
+            if self.owner in owners:
+                owners.remove(self.owner)
+            if not owners:
+                del sessions[self.keychain_path]
+                keychains = search_list(refresh=True)
+                if self.keychain_path in keychains:
+                    keychains.remove(self.keychain_path)
+                    _set_search_list(keychains)
+            write_json_atomic(_sessions_path(), sessions)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+@contextmanager
+def keychain_session(keychain):
+    """A `KeychainSession` for `keychain`, or nothing if it's None."""
+    if keychain is None:
+        yield None
+    else:
+        with KeychainSession(keychain) as session:
+            yield session
 
 
 def install_keychain(keychain_path, add=True):
@@ -86,17 +231,16 @@ def unlock_keychain(keychain, password):
 
     keychain_path = find_keychain(keychain)
 
-    print(_unlock_keychain_cmd(keychain_path, None))  # print the command without showing the password
-    run_cmd(_unlock_keychain_cmd(keychain_path, password))
+    display_cmd = shellify(_unlock_keychain_cmd(keychain_path, None))  # the command without showing the password
+    print(display_cmd)
+    run_cmd(_unlock_keychain_cmd(keychain_path, password), display_cmd=display_cmd)
 
-    run_cmd(shellify(["security", "-v", "set-keychain-settings", "-lut",
-        str(defaults['keychain_unlock_timeout']), keychain_path]))
+    run_cmd(["security", "-v", "set-keychain-settings", "-lut",
+        str(defaults['keychain_unlock_timeout']), keychain_path])
 
     
 def _unlock_keychain_cmd(keychain_path, password):
-    """Pass `None` as the password to generate a string with the password
-    obfuscated, suitable for logging."""
-    args = ['security', 'unlock-keychain', '-p',
+    """Pass `None` as the password to generate the arguments with the
+    password obfuscated, suitable for logging."""
+    return ['security', 'unlock-keychain', '-p',
             password or '********', keychain_path]
-    cmd = shellify(args)
-    return cmd
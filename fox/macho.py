@@ -0,0 +1,319 @@
+"""
+Reading Mach-O and fat (universal) binaries without Xcode's tools. Files are
+mapped rather than read, so only the headers and load commands of even very
+large binaries are touched. For each architecture a binary reports its
+LC_UUID, which is what pairs it with its dSYM, and the dylibs it links.
+
+`thin` drops slices from a fat binary, like `lipo -thin` / `lipo -extract`.
+Each slice carries its own code signature, so the slices that are kept stay
+validly signed.
+"""
+
+from contextlib import contextmanager
+import logging
+import mmap
+import os
+import struct
+import uuid as uuidlib
+import zipfile
+
+
+logger = logging.getLogger(__name__)
+
+FAT_MAGIC = '\xca\xfe\xba\xbe'
+FAT_MAGIC_64 = '\xca\xfe\xba\xbf'
+MACHO_MAGICS_BE = ('\xfe\xed\xfa\xce', '\xfe\xed\xfa\xcf')
+MACHO_MAGICS_LE = ('\xce\xfa\xed\xfe', '\xcf\xfa\xed\xfe')
+
+# Java class files share the fat magic; their version numbers are much
+# larger than any real count of architectures
+MAX_FAT_ARCHS = 30
+
+CPU_ARCH_ABI64 = 0x01000000
+CPU_ARCH_ABI64_32 = 0x02000000
+CPU_SUBTYPE_MASK = 0x00ffffff
+
+CPU_TYPE_X86 = 7
+CPU_TYPE_ARM = 12
+CPU_TYPE_POWERPC = 18
+
+ARCH_NAMES = {
+    (CPU_TYPE_X86, 3): 'i386',
+    (CPU_TYPE_X86 | CPU_ARCH_ABI64, 3): 'x86_64',
+    (CPU_TYPE_X86 | CPU_ARCH_ABI64, 8): 'x86_64h',
+    (CPU_TYPE_ARM, 6): 'armv6',
+    (CPU_TYPE_ARM, 9): 'armv7',
+    (CPU_TYPE_ARM, 11): 'armv7s',
+    (CPU_TYPE_ARM, 12): 'armv7k',
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64, 0): 'arm64',
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64, 1): 'arm64',
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64, 2): 'arm64e',
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64_32, 1): 'arm64_32',
+    (CPU_TYPE_POWERPC, 0): 'ppc',
+}
+
+FILE_TYPES = {
+    1: 'object',
+    2: 'execute',
+    6: 'dylib',
+    8: 'bundle',
+    9: 'dylib_stub',
+    10: 'dsym',
+}
+
+LC_REQ_DYLD = 0x80000000
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_UUID = 0x1b
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+
+DYLIB_LOAD_COMMANDS = {
+    LC_LOAD_DYLIB: 'load',
+    LC_LOAD_WEAK_DYLIB: 'weak',
+    LC_REEXPORT_DYLIB: 'reexport',
+    LC_LAZY_LOAD_DYLIB: 'lazy',
+    LC_LOAD_UPWARD_DYLIB: 'upward',
+}
+
+
+class MachOError(Exception):
+    pass
+
+
+def arch_name(cputype, cpusubtype):
+    subtype = cpusubtype & CPU_SUBTYPE_MASK
+    return ARCH_NAMES.get((cputype, subtype)) or 'cpu%d/%d' % (cputype, subtype)
+
+
+def is_macho(header):
+    """Whether `header`, the first 4 bytes of a file, starts a Mach-O or
+    fat binary."""
+    return header in (FAT_MAGIC, FAT_MAGIC_64) + MACHO_MAGICS_BE + MACHO_MAGICS_LE
+
+
+class Slice(object):
+    """One architecture of a binary: the Mach-O image at `offset` in the
+    file, `size` bytes long."""
+
+    def __init__(self, cputype, cpusubtype, offset, size, align=None):
+        self.cputype = cputype
+        self.cpusubtype = cpusubtype
+        self.offset = offset
+        self.size = size
+        self.align = align
+        self.filetype = None
+        self.uuid = None
+        self.install_name = None
+        self.dylibs = []  # (path, kind)
+
+    @property
+    def arch(self):
+        return arch_name(self.cputype, self.cpusubtype)
+
+    def to_dict(self):
+        return {
+            'arch': self.arch,
+            'filetype': FILE_TYPES.get(self.filetype, self.filetype),
+            'uuid': self.uuid,
+            'size': self.size,
+            'install_name': self.install_name,
+            'dylibs': [{'path': path, 'kind': kind} for (path, kind) in self.dylibs],
+        }
+
+    def __repr__(self):
+        return '<Slice %s %s>' % (self.arch, self.uuid)
+
+
+def _unpack(fmt, data, offset):
+    size = struct.calcsize(fmt)
+    if offset < 0 or offset + size > len(data):
+        raise MachOError('Truncated binary at offset %d' % (offset))
+    return struct.unpack(fmt, data[offset:offset + size])
+
+
+def fat_slices(data):
+    """Return the `Slice`s listed in the fat header of `data`, or None if it
+    isn't a fat binary."""
+    magic = data[:4]
+    if magic not in (FAT_MAGIC, FAT_MAGIC_64):
+        return None
+    nfat_arch, = _unpack('>I', data, 4)
+    if nfat_arch > MAX_FAT_ARCHS:
+        return None
+    slices = []
+    offset = 8
+    for i in range(nfat_arch):
+        if magic == FAT_MAGIC_64:
+            cputype, cpusubtype, slice_offset, size, align, reserved = \
+                _unpack('>iiQQII', data, offset)
+            offset += 32
+        else:
+            cputype, cpusubtype, slice_offset, size, align = _unpack('>iiIII', data, offset)
+            offset += 20
+        if slice_offset + size > len(data):
+            raise MachOError('Slice %d extends past the end of the binary' % (i))
+        slices.append(Slice(cputype, cpusubtype, slice_offset, size, align))
+    return slices
+
+
+def _read_slice(data, s):
+    """Fill in `s` from the Mach-O header and load commands at its offset."""
+    base = s.offset
+    magic = data[base:base + 4]
+    if magic in MACHO_MAGICS_BE:
+        endian = '>'
+    elif magic in MACHO_MAGICS_LE:
+        endian = '<'
+    else:
+        raise MachOError('No Mach-O header at offset %d' % (base))
+    is64 = magic in (MACHO_MAGICS_BE[1], MACHO_MAGICS_LE[1])
+
+    cputype, cpusubtype, filetype, ncmds, sizeofcmds, flags = \
+        _unpack(endian + 'iiIIII', data, base + 4)
+    s.cputype, s.cpusubtype, s.filetype = cputype, cpusubtype, filetype
+
+    offset = base + (32 if is64 else 28)
+    end = offset + sizeofcmds
+    for i in range(ncmds):
+        cmd, cmdsize = _unpack(endian + 'II', data, offset)
+        if cmdsize < 8 or offset + cmdsize > end:
+            raise MachOError('Bad load command %d at offset %d' % (i, offset))
+        if cmd == LC_UUID:
+            s.uuid = str(uuidlib.UUID(bytes=data[offset + 8:offset + 24])).upper()
+        elif cmd in DYLIB_LOAD_COMMANDS or cmd == LC_ID_DYLIB:
+            name_offset, = _unpack(endian + 'I', data, offset + 8)
+            name = data[offset + name_offset:offset + cmdsize].split('\0', 1)[0]
+            if cmd == LC_ID_DYLIB:
+                s.install_name = name
+            else:
+                s.dylibs.append((name, DYLIB_LOAD_COMMANDS[cmd]))
+        offset += cmdsize
+
+
+def parse(data):
+    """Return the `Slice`s of the binary in `data`, a string or mmap: one
+    for a thin binary, one per architecture for a fat one."""
+    slices = fat_slices(data)
+    if slices is None:
+        if data[:4] not in MACHO_MAGICS_BE + MACHO_MAGICS_LE:
+            raise MachOError('Not a Mach-O binary')
+        slices = [Slice(None, None, 0, len(data))]
+    for s in slices:
+        _read_slice(data, s)
+    return slices
+
+
+@contextmanager
+def mapped(path):
+    """Map the file at `path` read-only."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise MachOError("'%s' is empty" % (path))
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield m
+        finally:
+            m.close()
+
+
+def read(path):
+    """Return the `Slice`s of the binary at `path`."""
+    with mapped(path) as data:
+        try:
+            return parse(data)
+        except MachOError, e:
+            raise MachOError("'%s': %s" % (path, e))
+
+
+def _is_macho_file(path):
+    if os.path.islink(path) or not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return is_macho(f.read(4))
+
+
+def find_binaries(root):
+    """Yield the path of every Mach-O binary below `root`, in order."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if _is_macho_file(path):
+                yield path
+
+
+def inspect(path):
+    """
+    Yield `(name, slices)` for every binary in `path`: a binary, a bundle
+    such as an app or dSYM, or an IPA or zip, whose members are read
+    without extracting them.
+    """
+    if os.path.isdir(path):
+        for binary in find_binaries(path):
+            yield os.path.relpath(binary, path), read(binary)
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            for zinfo in zf.infolist():
+                if zinfo.filename.endswith('/') or zinfo.file_size < 4:
+                    continue
+                with zf.open(zinfo) as member:
+                    if not is_macho(member.read(4)):
+                        continue
+                try:
+                    yield zinfo.filename, parse(zf.read(zinfo))
+                except MachOError, e:
+                    raise MachOError("'%s': %s" % (zinfo.filename, e))
+    else:
+        yield os.path.basename(path), read(path)
+
+
+def thin(path, archs, output_path):
+    """
+    Write the fat binary at `path` to `output_path` with only the slices for
+    `archs`; a binary left with one slice is written as a thin one. Returns
+    the number of bytes dropped, or None, writing nothing, if there's
+    nothing to drop: `path` isn't fat, or has none of `archs` or only them.
+    """
+    archs = set(archs)
+    with mapped(path) as data:
+        slices = fat_slices(data)
+        if slices is None:
+            return None
+        kept = [s for s in slices if arch_name(s.cputype, s.cpusubtype) in archs]
+        if not kept or len(kept) == len(slices):
+            if not kept:
+                logger.warning("'%s' has none of %s, leaving it alone" % (
+                    path, ', '.join(sorted(archs))))
+            return None
+
+        with open(output_path, 'wb') as out:
+            if len(kept) == 1:
+                s = kept[0]
+                out.write(data[s.offset:s.offset + s.size])
+            else:
+                _write_fat(out, data, kept, data[:4] == FAT_MAGIC_64)
+            return len(data) - out.tell()
+
+
+def _write_fat(out, data, slices, is64):
+    header_size = 8 + len(slices) * (32 if is64 else 20)
+    offsets = []
+    offset = header_size
+    for s in slices:
+        alignment = 1 << s.align
+        offset = (offset + alignment - 1) // alignment * alignment
+        offsets.append(offset)
+        offset += s.size
+
+    out.write((FAT_MAGIC_64 if is64 else FAT_MAGIC) + struct.pack('>I', len(slices)))
+    for s, offset in zip(slices, offsets):
+        if is64:
+            out.write(struct.pack('>iiQQII', s.cputype, s.cpusubtype, offset, s.size, s.align, 0))
+        else:
+            out.write(struct.pack('>iiIII', s.cputype, s.cpusubtype, offset, s.size, s.align))
+    for s, offset in zip(slices, offsets):
+        out.write('\0' * (offset - out.tell()))
+        out.write(data[s.offset:s.offset + s.size])
@@ -0,0 +1,84 @@
+"""
+In-process plist reading and editing, in place of PlistBuddy. A session loads
+a plist once, applies any number of reads and edits in memory and writes it
+back once, in the format (binary or XML) it was read in.
+"""
+
+import biplist
+
+
+BINARY_HEADER = 'bplist'
+
+
+def _split_keypath(keypath):
+    """Split a PlistBuddy style key path like 'Entitlements:keychain-access-groups:0'."""
+    if isinstance(keypath, (list, tuple)):
+        return list(keypath)
+    return [k for k in keypath.split(':') if k != '']
+
+
+def _index(container, key):
+    if isinstance(container, list):
+        return int(key)
+    return key
+
+
+class PlistSession(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.binary = data.startswith(BINARY_HEADER)
+        self.root = biplist.readPlistFromString(data)
+        self.modified = False
+
+    def get(self, keypath, default=None):
+        value = self.root
+        for key in _split_keypath(keypath):
+            try:
+                value = value[_index(value, key)]
+            except (KeyError, IndexError, ValueError, TypeError):
+                return default
+        return value
+
+    def set(self, keypath, value):
+        keys = _split_keypath(keypath)
+        container = self.root
+        for key in keys[:-1]:
+            container = container[_index(container, key)]
+        container[_index(container, keys[-1])] = value
+        self.modified = True
+
+    def delete(self, keypath):
+        keys = _split_keypath(keypath)
+        container = self.get(keys[:-1])
+        if container is None:
+            return
+        try:
+            del container[_index(container, keys[-1])]
+            self.modified = True
+        except (KeyError, IndexError, ValueError):
+            pass
+
+    def save(self, path=None, binary=None):
+        """Write the plist to `path` (defaults to where it was read from)."""
+        if binary is None:
+            binary = self.binary
+        biplist.writePlist(self.root, path or self.path, binary=binary)
+        self.modified = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.modified:
+            self.save()
+
+
+def read_plist(path):
+    return PlistSession(path).root
+
+
+def write_plist(root, path, binary=False):
+    biplist.writePlist(root, path, binary=binary)
@@ -1,9 +1,15 @@
 import os
+import cStringIO
+import datetime
 import fnmatch
+import hashlib
 import logging
 import plistlib
 import shutil
+import threading
 
+from . import cms
+from .cache import FileMetadataCache
 from .defaults import defaults
 
 
@@ -14,34 +20,91 @@ def _is_prov_file(filePath):
     return filePath.endswith('.mobileprovision')
 
 
-def _plist_string_from_prov_file(path):
-    beginToken = '<?xml'
-    endToken = '</plist>'
-    f = open(path)
-    data = f.read()
-    begin = data.index(beginToken)
-    end = data.rindex(endToken) + len(endToken)
-    return data[begin:end]
+def plist_from_content(content):
+    """Parse the plist embedded in a profile, given its CMS content."""
+    return plistlib.readPlist(cStringIO.StringIO(content))
+
+
+def read_plist(path):
+    """Return the parsed plist embedded in the profile at `path`."""
+    with cms.open_content(path) as content:
+        return plist_from_content(content)
+
+
+def _certificate_name(der):
+    try:
+        return cms.certificate_common_name(der)
+    except cms.CMSError, e:
+        logger.debug("Couldn't read certificate: %s" % (e))
+        return None
+
+
+def metadata_from_plist(plist):
+    entitlements = plist.get('Entitlements', {})
+    team_ids = plist.get('TeamIdentifier') or [
+        entitlements.get('com.apple.developer.team-identifier')]
+    certificates = [c.data for c in plist.get('DeveloperCertificates', [])]
+    return {
+        'name': plist.get('Name'),
+        'uuid': plist.get('UUID'),
+        'team_id': team_ids[0],
+        'team_name': plist.get('TeamName'),
+        'app_id': entitlements.get('application-identifier'),
+        'entitlements': entitlements,
+        'creation_date': plist.get('CreationDate'),
+        'expiration_date': plist.get('ExpirationDate'),
+        'certificate_fingerprints': [hashlib.sha1(c).hexdigest().upper() for c in certificates],
+        'certificate_names': [_certificate_name(c) for c in certificates],
+    }
+
+
+def _load_metadata(filePath):
+    return metadata_from_plist(read_plist(filePath))
+
+
+_metadata_cache = None
+# the cache and index are shared by the threads of `fox serve`
+_lock = threading.RLock()
+
+
+def _cache():
+    global _metadata_cache
+    cache_path = os.path.join(defaults['cache_dir'], 'profiles.json')
+    if _metadata_cache is None or _metadata_cache.cache_path != cache_path:
+        _metadata_cache = FileMetadataCache(cache_path, _load_metadata)
+    return _metadata_cache
+
+
+def metadata(filePath):
+    """Return a dict of name, uuid, team, app id, entitlements, dates and
+    certificate fingerprints and names for the profile at `filePath`. Results are cached on disk until the file
+    changes."""
+    with _lock:
+        cache = _cache()
+        m = cache.get(os.path.expanduser(filePath))
+        cache.save()
+        return m
+
+
+def scan(directory=None):
+    """Return a list of `(path, metadata)` for every profile in `directory`."""
+    if directory is None:
+        directory = defaults['provisioning_profile_dir']
+    with _lock:
+        return _cache().scan(directory, predicate=_is_prov_file)
 
 
 def name(filePath):
-    plistString = _plist_string_from_prov_file(filePath)
-    plist = plistlib.readPlistFromString(plistString)
-    return plist['Name']
+    return metadata(filePath)['name']
 
 
 def _path(provName, path=None, patternMatch=False):
-    if path is None:
-        path = defaults['provisioning_profile_dir']
-
     paths = []
-    for f in os.listdir(path):
-        if _is_prov_file(f):
-            filePath = os.path.join(path, f)
-            if not patternMatch and name(filePath) == provName:
-                paths.append(filePath)
-            elif patternMatch and fnmatch.fnmatch(name(filePath), provName):
-                paths.append(filePath)
+    for filePath, m, expires in index(path).profiles:
+        if not patternMatch and m['name'] == provName:
+            paths.append(filePath)
+        elif patternMatch and fnmatch.fnmatch(m['name'], provName):
+            paths.append(filePath)
     return paths
 
 
@@ -51,7 +114,7 @@ def find_all(input, patternMatch=True):
 
     # check if it's a valid path first
     if os.path.exists(input):
-        return os.path.abspath(input)
+        return [os.path.abspath(input)]
 
     # assume it's a name of a provisioning profile
     paths = _path(input, path=defaults['provisioning_profile_dir'],
@@ -64,6 +127,8 @@ def find_all(input, patternMatch=True):
 
 def find(input, patternMatch=True):
     paths = find_all(input, patternMatch=patternMatch)
+    if paths is None:
+        return None
     path = paths[0]
     if len(paths) > 1:
         logger.warning('Multiple matches found for "%s", returning first match.'
@@ -78,20 +143,170 @@ def uuid(path):
         #sys.stderr.write(err)
         raise ValueError(err)  # TODO: ValueError the right kind of exception?
         return None
-    plistString = _plist_string_from_prov_file(fullpath)
-    plist = plistlib.readPlistFromString(plistString)
-    return plist['UUID']
+    return metadata(fullpath)['uuid']
 
 
-def list(directory=None):
+def _bundle_pattern(app_id, team_id):
+    """Strip the team (or app id) prefix from an application identifier,
+    leaving the bundle id or wildcard it matches."""
+    if team_id and app_id.startswith(team_id + '.'):
+        return app_id[len(team_id) + 1:]
+    return app_id.partition('.')[2] or app_id
 
+
+def _bundle_patterns(bundle_id):
+    """Return the patterns that match `bundle_id`, most specific first:
+    the bundle id itself, then each wildcard from the longest prefix to
+    '*'."""
+    patterns = [bundle_id]
+    parts = bundle_id.split('.')
+    for i in range(len(parts) - 1, 0, -1):
+        patterns.append('.'.join(parts[:i]) + '.*')
+    patterns.append('*')
+    return patterns
+
+
+def _parse_date(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+class ProfileIndex(object):
+    """
+    Profiles indexed by the bundle id or wildcard of their application
+    identifier, their team, and the fingerprints and names of their
+    certificates.
+    """
+
+    def __init__(self, profiles):
+        self.profiles = []
+        self.by_pattern = dict()
+        self.by_team = dict()
+        self.by_fingerprint = dict()
+        self.by_certificate_name = dict()
+        self._identities = dict()
+        for path, m in profiles:
+            entry = (path, m, _parse_date(m.get('expiration_date')))
+            self.profiles.append(entry)
+            if m.get('app_id'):
+                pattern = _bundle_pattern(m['app_id'], m.get('team_id'))
+                self.by_pattern.setdefault(pattern, []).append(entry)
+            self.by_team.setdefault(m.get('team_id'), []).append(entry)
+            for fingerprint in m.get('certificate_fingerprints') or []:
+                self.by_fingerprint.setdefault(fingerprint, []).append(entry)
+            for cert_name in m.get('certificate_names') or []:
+                if cert_name:
+                    self.by_certificate_name.setdefault(cert_name, []).append(entry)
+        # latest expiration first, so lookups can stop at the first match
+        for entries in self.by_pattern.values():
+            entries.sort(key=lambda e: e[0])
+            entries.sort(key=lambda e: e[2] or datetime.datetime.min, reverse=True)
+
+    def _identity_paths(self, identity):
+        """Return the set of paths of profiles with a certificate whose
+        SHA-1 fingerprint is `identity`, or whose name contains it, the way
+        codesign matches identities."""
+        paths = self._identities.get(identity)
+        if paths is not None:
+            return paths
+        paths = set(path for (path, m, expires) in
+                    self.by_fingerprint.get(identity.upper().replace(' ', ''), []))
+        for cert_name, entries in self.by_certificate_name.items():
+            if identity in cert_name:
+                paths.update(path for (path, m, expires) in entries)
+        self._identities[identity] = paths
+        return paths
+
+    def iter_candidates(self, bundle_id, identity=None, team_id=None, include_expired=False,
+                        now=None):
+        """
+        Yield `(path, metadata)` for the profiles usable to sign `bundle_id`,
+        best first: an exact app id beats a wildcard, a longer wildcard
+        beats a shorter one, and a later expiration breaks ties. Expired
+        profiles are left out unless `include_expired`.
+        """
+        now = now or datetime.datetime.utcnow()
+        paths = self._identity_paths(identity) if identity else None
+        for pattern in _bundle_patterns(bundle_id):
+            for path, m, expires in self.by_pattern.get(pattern, ()):
+                if team_id is not None and m.get('team_id') != team_id:
+                    continue
+                if paths is not None and path not in paths:
+                    continue
+                if not include_expired and expires is not None and expires < now:
+                    continue
+                yield path, m
+
+    def candidates(self, bundle_id, **kwargs):
+        """Return a list of the results of `iter_candidates`."""
+        return [c for c in self.iter_candidates(bundle_id, **kwargs)]
+
+    def for_identity(self, identity, team_id=None):
+        """Return a list of `(path, metadata)` for the profiles that include
+        the certificate `identity`."""
+        paths = self._identity_paths(identity)
+        return [(path, m) for (path, m, expires) in self.profiles
+                if path in paths and (team_id is None or m.get('team_id') == team_id)]
+
+
+_index = None
+_index_key = None
+
+
+def _directory_key(directory):
+    """Return the name, mtime and size of each profile in `directory`, which
+    change when one is added, removed or replaced in place."""
+    files = []
+    for f in sorted(os.listdir(directory)):
+        if not _is_prov_file(f):
+            continue
+        try:
+            st = os.stat(os.path.join(directory, f))
+        except OSError:
+            continue
+        files.append((f, st.st_mtime, st.st_size))
+    return tuple(files)
+
+
+def index(directory=None):
+    """
+    Return a `ProfileIndex` of the profiles in `directory`. The index is
+    kept in memory and rebuilt when a profile in the directory changes.
+    """
+    global _index, _index_key
     if directory is None:
         directory = defaults['provisioning_profile_dir']
+    with _lock:
+        try:
+            key = (os.path.abspath(directory), _cache().cache_path, _directory_key(directory))
+        except OSError:
+            key = None
+        if _index is None or key is None or key != _index_key:
+            _index = ProfileIndex(scan(directory))
+            _index_key = key
+        return _index
+
+
+def find_best(bundle_id, identity=None, team_id=None, directory=None):
+    """
+    Return the path of the most specific unexpired profile for `bundle_id`
+    that includes the certificate `identity` (a name or SHA-1 fingerprint),
+    or None.
+    """
+    for path, m in index(directory).iter_candidates(bundle_id, identity=identity,
+                                                    team_id=team_id):
+        return path
+    return None
 
+
+def list(directory=None):
     l = []
-    for f in os.listdir(directory):
-        if _is_prov_file(f):
-            l.append("%s : '%s'" % (f, name(os.path.join(directory, f))))
+    for filePath, m in scan(directory):
+        l.append("%s : '%s'" % (os.path.basename(filePath), m['name']))
     return l
 
 
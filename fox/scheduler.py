@@ -0,0 +1,128 @@
+"""
+Running several builds at once. Each job gets its own build directory and
+derived data, and its output is prefixed with the job's name.
+"""
+
+import itertools
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import time
+
+from .helpers import output_prefix, puts
+from .util import makedirs
+
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+
+    def __init__(self, name, kwargs):
+        self.name = name
+        self.kwargs = kwargs
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.duration = None
+
+
+def _slug(name):
+    return re.sub(r'[^A-Za-z0-9_.=-]+', '_', name).strip('_') or 'job'
+
+
+def matrix_jobs(base_name, kwargs, matrix):
+    """
+    Expand `matrix`, a list of `(key, values)`, into one `Job` per
+    combination of values, each with a copy of `kwargs` updated with that
+    combination.
+    """
+    if not matrix:
+        return [Job(base_name or 'default', dict(kwargs))]
+    jobs = []
+    keys = [key for (key, values) in matrix]
+    for combination in itertools.product(*[values for (key, values) in matrix]):
+        job_kwargs = dict(kwargs)
+        job_kwargs.update(zip(keys, combination))
+        parts = ([base_name] if base_name else []) + \
+            ['%s=%s' % (k, v) for (k, v) in zip(keys, combination)]
+        jobs.append(Job(','.join(parts), job_kwargs))
+    return jobs
+
+
+def isolate(jobs, base_dir):
+    """
+    Give each job its own SYMROOT and derived data directory under
+    `base_dir`. Jobs that would write their IPAs to the same directory
+    write them to a subdirectory of it named after the job instead; jobs
+    that would write the same file raise a ValueError.
+    """
+    for job in jobs:
+        job_dir = os.path.join(base_dir, _slug(job.name))
+        job.kwargs['build_dir'] = os.path.join(job_dir, 'Products')
+        if job.kwargs.get('scheme') is not None:
+            # xcodebuild only honors -derivedDataPath with a scheme
+            job.kwargs['derived_data'] = os.path.join(job_dir, 'DerivedData')
+
+    by_output = dict()
+    for job in jobs:
+        output = os.path.abspath(job.kwargs.get('output') or '.')
+        by_output.setdefault(output, []).append(job)
+    for output, shared in sorted(by_output.items()):
+        if len(shared) < 2:
+            continue
+        if os.path.isdir(output):
+            for job in shared:
+                job_output = os.path.join(output, _slug(job.name))
+                makedirs(job_output)
+                job.kwargs['output'] = job_output
+        elif '$' not in output:
+            raise ValueError("Jobs %s would all write '%s'" % (
+                ', '.join(job.name for job in shared), output))
+        # outputs with template variables are told apart once they're
+        # substituted, when the IPA is written
+
+
+def run_jobs(func, jobs, max_jobs=None):
+    """
+    Call `func(**job.kwargs)` for each of `jobs`, up to `max_jobs` at a
+    time. Failures are recorded on the job rather than raised.
+    """
+
+    def run(job):
+        start = time.time()
+        job.status = 'running'
+        with output_prefix('[%s] ' % (job.name)):
+            try:
+                job.result = func(**job.kwargs)
+                job.status = 'ok'
+            except Exception, e:
+                job.error = e
+                job.status = 'failed'
+                puts('FAILED: %s' % (e))
+        job.duration = time.time() - start
+
+    pool = ThreadPool(min(max_jobs or multiprocessing.cpu_count(), len(jobs)))
+    try:
+        pool.map(run, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return jobs
+
+
+def summary_table(jobs):
+    """Return a list of lines summarizing the status of `jobs`."""
+    rows = [('JOB', 'STATUS', 'TIME', 'RESULT')]
+    for job in jobs:
+        duration = '%.1fs' % (job.duration) if job.duration is not None else '-'
+        if job.status == 'failed':
+            result = str(job.error).splitlines()[0] if str(job.error) else repr(job.error)
+        else:
+            result = job.result or ''
+        rows.append((job.name, job.status, duration, str(result)))
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    return ['  '.join(row[i].ljust(widths[i]) for i in range(3)) + '  ' + row[3]
+            for row in rows]
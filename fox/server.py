@@ -0,0 +1,471 @@
+"""
+`fox serve`: a long-running process that runs fox commands sent to it over a
+Unix socket. Commands skip interpreter startup and find profile metadata,
+parsed configs and the keychain search list already in memory; a watcher
+thread reloads them when the profile directory, the config or the keychain
+preferences change.
+
+The protocol is one JSON object per line. A client sends
+`{"version", "argv", "cwd", "env"}` and gets back `{"stdout": s}` and
+`{"stderr": s}` messages as the command runs, then `{"exit": status}`, or
+a single `{"error": message}` if the server won't run it. Sending
+`{"control": "status"}` or `{"control": "stop"}` instead queries or stops
+the server.
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from . import __version__
+from . import client
+from .defaults import defaults
+from .util import makedirs
+
+
+logger = logging.getLogger(__name__)
+
+KEYCHAIN_PREFERENCES = os.path.expanduser('~/Library/Preferences/com.apple.security.plist')
+
+# seconds a client has to send its request after connecting
+REQUEST_TIMEOUT = 5
+
+
+## Per-request output
+
+def current_request():
+    """Return the request being run by this thread, or None."""
+    return getattr(threading.current_thread(), '_fox_request', None)
+
+
+_thread_init = threading.Thread.__init__
+
+
+def _inherit_request(self, *args, **kwargs):
+    _thread_init(self, *args, **kwargs)
+    self._fox_request = current_request()
+
+
+class Request(object):
+    """A command being run for a client. Output is sent to the client as it
+    is written; once the client has gone it's dropped."""
+
+    def __init__(self, f, argv, env=None):
+        self.f = f
+        self.argv = argv
+        self.env = env
+        self.log_level = logging.WARNING
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, **message):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.f.write(json.dumps(message) + '\n')
+                self.f.flush()
+            except (IOError, socket.error):
+                self.closed = True
+
+
+class RequestStream(object):
+    """Stands in for `sys.stdout` or `sys.stderr`, sending what a request's
+    threads write to its client and everything else to the real stream."""
+
+    def __init__(self, name, stream):
+        self.name = name
+        self.stream = stream
+        self.softspace = 0
+
+    def write(self, s):
+        request = current_request()
+        if request is None:
+            self.stream.write(s)
+            return
+        if isinstance(s, str):
+            s = s.decode('utf-8', 'replace')
+        request.send(**{self.name: s})
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if current_request() is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class RequestLogFilter(logging.Filter):
+    """Applies each request's log level to the records logged for it, and
+    `level` to the server's own."""
+
+    def __init__(self, level):
+        logging.Filter.__init__(self)
+        self.level = level
+
+    def filter(self, record):
+        request = current_request()
+        return record.levelno >= (request.log_level if request is not None else self.level)
+
+
+def _set_request_log_level(level):
+    request = current_request()
+    if request is not None:
+        request.log_level = level
+
+
+def _request_env():
+    request = current_request()
+    return request.env if request is not None else None
+
+
+def _install_output():
+    """Route output, logging and the environment commands run with to the
+    request being run by the current thread. Threads started while running a
+    request belong to it too."""
+    from . import cli
+    from . import helpers
+
+    threading.Thread.__init__ = _inherit_request
+    root = logging.getLogger()
+    log_filter = RequestLogFilter(root.getEffectiveLevel())
+    for name in ('stdout', 'stderr'):
+        original = getattr(sys, name)
+        stream = RequestStream(name, original)
+        setattr(sys, name, stream)
+        for handler in root.handlers:
+            if getattr(handler, 'stream', None) is original:
+                handler.stream = stream
+    for handler in root.handlers:
+        handler.addFilter(log_filter)
+    root.setLevel(min(root.getEffectiveLevel(), logging.INFO))
+    cli.set_log_level = _set_request_log_level
+    helpers.command_env = _request_env
+
+
+## Working directory
+
+class WorkingDirectory(object):
+    """
+    The process has one working directory, and commands resolve relative
+    paths (including those in presets) against it. Requests from the same
+    directory run at once; a request from another waits until they finish.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.cwd = None
+        self.users = 0
+
+    @contextmanager
+    def use(self, cwd):
+        with self.cond:
+            while self.users and self.cwd != cwd:
+                self.cond.wait()
+            if self.cwd != cwd:
+                os.chdir(cwd)
+                self.cwd = cwd
+            self.users += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.users -= 1
+                self.cond.notify_all()
+
+
+## Warm state
+
+def _stat_key(path):
+    """Return the mtime and size of `path` and, for a directory, of each
+    file in it, since replacing a file in place leaves the directory's
+    alone."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = [(st.st_mtime, st.st_size)]
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            key.append((name, st.st_mtime, st.st_size))
+    return key
+
+
+def warm_profiles():
+    from . import provisioningprofile
+    if os.path.isdir(defaults['provisioning_profile_dir']):
+        provisioningprofile.index()
+
+
+def warm_config():
+    from . import cli
+    if os.path.exists(defaults['config_path']):
+        cli.load_fox_config(defaults['config_path'])
+
+
+def warm_keychains():
+    from . import keychain
+    keychain.search_list(refresh=True)
+
+
+class Watcher(threading.Thread):
+    """Polls `watched`, a list of `(path, reload)`, and calls `reload` when
+    the file or directory at `path` changes."""
+
+    def __init__(self, watched, interval):
+        threading.Thread.__init__(self, name='fox-watcher')
+        self.daemon = True
+        self.watched = watched
+        self.interval = interval
+        self.keys = dict((path, _stat_key(path)) for (path, reload) in watched)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for path, reload in self.watched:
+                key = _stat_key(path)
+                if key == self.keys[path]:
+                    continue
+                self.keys[path] = key
+                logger.info("'%s' changed, reloading" % (path))
+                _reload(reload)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _reload(reload):
+    try:
+        reload()
+    except Exception, e:
+        logger.warning("Couldn't reload %s: %s" % (reload.__name__, e))
+
+
+## Server
+
+class Server(object):
+
+    def __init__(self, path=None, workers=None):
+        self.path = path or client.socket_path()
+        self.workers = workers or defaults['server_workers'] or multiprocessing.cpu_count()
+        self.cwd = WorkingDirectory()
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.active = 0
+        self.served = 0
+        self.sock = None
+        self.pool = None
+        self.watcher = None
+
+    def _listen(self):
+        if client.connect(self.path) is not None:
+            raise RuntimeError("A fox daemon is already listening on '%s'" % (self.path))
+        if os.path.exists(self.path):
+            os.remove(self.path)  # left behind by a daemon that didn't exit cleanly
+        makedirs(os.path.dirname(os.path.abspath(self.path)))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only this user may connect
+        umask = os.umask(0177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(64)
+        return sock
+
+    def serve_forever(self):
+        self.sock = self._listen()
+        _install_output()
+        for reload in (warm_profiles, warm_config, warm_keychains):
+            _reload(reload)
+        self.watcher = Watcher([(defaults['provisioning_profile_dir'], warm_profiles),
+                                (defaults['config_path'], warm_config),
+                                (KEYCHAIN_PREFERENCES, warm_keychains)],
+                               defaults['server_poll_interval'])
+        self.watcher.start()
+        self.pool = ThreadPool(self.workers)
+        print "fox %s listening on '%s' with %d workers" % (__version__, self.path, self.workers)
+        try:
+            while self._accept():
+                pass
+        finally:
+            with self.lock:
+                self.stopping = True
+            self.watcher.stop()
+            self.sock.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.pool.close()
+            self.pool.join()
+
+    def _accept(self):
+        """Accept one connection and read its request on another thread, so
+        a client that's slow to send it holds up no one else. Returns False
+        once the server has been asked to stop."""
+        conn, address = self.sock.accept()
+        with self.lock:
+            stopping = self.stopping
+        if stopping:
+            conn.close()
+            return False
+        thread = threading.Thread(target=self._receive, args=(conn,), name='fox-receive')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _receive(self, conn):
+        """Read the request on `conn` and run it on the pool. Control
+        commands, and requests the server won't run, are answered here."""
+        f = conn.makefile('r+b')
+        try:
+            conn.settimeout(REQUEST_TIMEOUT)
+            message = json.loads(f.readline())
+            conn.settimeout(None)
+            if not isinstance(message, dict):
+                raise ValueError('not an object')
+        except (IOError, socket.error, ValueError), e:
+            logger.warning("Ignoring bad request: %s" % (e))
+            _close(f, conn)
+            return
+
+        if 'control' in message:
+            try:
+                self._control(f, message['control'])
+            finally:
+                _close(f, conn)
+            return
+
+        error = self._check(message)
+        if error is None:
+            with self.lock:
+                if self.stopping:
+                    error = 'the daemon is stopping'
+                else:
+                    self.pool.apply_async(self._handle, (f, conn, message))
+        if error is not None:
+            Request(f, None).send(error=error)
+            _close(f, conn)
+
+    def _check(self, message):
+        """Return why the server won't run `message`, or None."""
+        if message.get('version') != __version__:
+            return 'the daemon runs fox %s, not %s' % (__version__, message.get('version'))
+        from .cli import _parse_global_options
+        argv = message.get('argv')
+        if not isinstance(argv, list):
+            return "the daemon doesn't run that command"
+        options, subcommand = _parse_global_options(argv)
+        if subcommand not in client.SERVED_SUBCOMMANDS:
+            return "the daemon doesn't run that command"
+        if '--trace' in options:
+            # tracing is per process, and would record other requests' spans
+            return "the daemon doesn't trace commands"
+        if not os.path.isabs(message.get('cwd') or ''):
+            return 'no working directory'
+        if not isinstance(message.get('env'), dict):
+            return 'no environment'
+        return None
+
+    def _control(self, f, command):
+        """Handle a control command."""
+        if command == 'status':
+            Request(f, None).send(**self.status())
+        elif command == 'stop':
+            Request(f, None).send(stopping=True, **self.status())
+            print 'Stopping'
+            self.stop()
+        else:
+            Request(f, None).send(error="unknown control command '%s'" % (command))
+
+    def stop(self):
+        """Stop accepting requests. Those already running finish first."""
+        with self.lock:
+            self.stopping = True
+        # wake the accept loop up
+        s = client.connect(self.path)
+        if s is not None:
+            s.close()
+
+    def status(self):
+        with self.lock:
+            return {'pid': os.getpid(), 'version': __version__, 'socket': self.path,
+                    'uptime': time.time() - self.started, 'workers': self.workers,
+                    'active': self.active, 'served': self.served}
+
+    def _handle(self, f, conn, message):
+        env = dict((k.encode('utf-8'), v.encode('utf-8')) for (k, v) in message['env'].items())
+        request = Request(f, message['argv'], env=env)
+        thread = threading.current_thread()
+        with self.lock:
+            self.active += 1
+        start = time.time()
+        try:
+            thread._fox_request = request
+            try:
+                status = self._run(request, message['cwd'])
+            finally:
+                thread._fox_request = None
+            logger.info("%s: exit %d in %.1fs" % (' '.join(request.argv), status, time.time() - start))
+            request.send(exit=status)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.served += 1
+            _close(f, conn)
+
+    def _run(self, request, cwd):
+        from . import cli
+        try:
+            with self.cwd.use(cwd):
+                cli.run(request.argv)
+            return 0
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            sys.stderr.write('%s\n' % (e.code))
+            return 1
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            return 1
+
+
+def _close(f, conn):
+    try:
+        f.close()
+        conn.close()
+    except (IOError, socket.error):
+        pass
+
+
+def serve(path=None, workers=None):
+    """Run a server until it's stopped, interrupted or terminated."""
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        Server(path=path, workers=workers).serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,187 @@
+"""
+Scratch space for extracting and staging app bundles. A workspace is put in
+a RAM-backed directory (`defaults['staging_memory_dir']`, `/dev/shm` where
+there is one) when its payload fits in what's left of
+`defaults['staging_memory_budget']`, and on disk otherwise. Before a
+workspace is handed out, its volume is checked for room for the payload
+plus `defaults['staging_reserve']`.
+
+Workspaces are removed when their block exits, however it exits. Emptied
+directories are kept in a small pool and reused by later workspaces, which
+matters under `fox serve`; the pool is removed when the process exits.
+"""
+
+import atexit
+from contextlib import contextmanager
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from .defaults import defaults
+
+
+logger = logging.getLogger(__name__)
+
+
+class StagingError(Exception):
+    pass
+
+
+class Workspace(object):
+    """A scratch directory at `path`, on the volume `location`."""
+
+    def __init__(self, path, location, size=None, in_memory=False):
+        self.path = path
+        self.location = location
+        self.size = size
+        self.in_memory = in_memory
+
+    def __repr__(self):
+        return '<Workspace %s%s>' % (self.path, ' (in memory)' if self.in_memory else '')
+
+
+_lock = threading.Lock()
+_memory_in_use = 0
+_pool = dict()  # (location, prefix): [empty directories]
+_active = set()
+
+
+def free_space(path):
+    """Return the number of bytes available to this user on the volume
+    holding `path`."""
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def disk_location():
+    return defaults['staging_dir'] or tempfile.gettempdir()
+
+
+def memory_location():
+    """Return the RAM-backed directory to stage in, or None if there isn't a
+    usable one."""
+    path = defaults['staging_memory_dir']
+    if path and os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+        return path
+    return None
+
+
+def _has_room(location, size):
+    if size is None:
+        return True
+    try:
+        available = free_space(location)
+    except OSError, e:
+        logger.debug("Couldn't check free space in '%s': %s" % (location, e))
+        return True
+    if available - size < defaults['staging_reserve']:
+        logger.info("Not staging %d bytes in '%s', only %d bytes are free" % (
+            size, location, available))
+        return False
+    return True
+
+
+def _reserve(size, directory=None):
+    """Pick where to stage `size` bytes, which may be None if unknown, and
+    return `(location, in_memory)`. Raises `StagingError` if nowhere has
+    room for it."""
+    global _memory_in_use
+    memory = None
+    if directory is not None:
+        candidates = [directory]
+    else:
+        candidates = [disk_location()]
+        memory = memory_location()
+        if memory is not None and size is not None and memory != candidates[0]:
+            candidates.insert(0, memory)
+
+    for location in candidates:
+        if location != memory:
+            if _has_room(location, size):
+                return location, False
+            continue
+        with _lock:
+            if _memory_in_use + size > defaults['staging_memory_budget']:
+                continue
+            _memory_in_use += size
+        if _has_room(location, size):
+            return location, True
+        with _lock:
+            _memory_in_use -= size
+
+    raise StagingError("Not enough free space to stage %d bytes in %s" % (
+        size, ' or '.join("'%s'" % (c) for c in candidates)))
+
+
+def _acquire(location, prefix):
+    with _lock:
+        pooled = _pool.get((location, prefix))
+        path = pooled.pop() if pooled else None
+    if path is None or not os.path.isdir(path):
+        path = tempfile.mkdtemp(prefix=prefix, dir=location)
+    with _lock:
+        _active.add(path)
+    return path
+
+
+def _empty(path):
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+        if os.path.isdir(child) and not os.path.islink(child):
+            shutil.rmtree(child)
+        else:
+            os.remove(child)
+
+
+def _release(location, prefix, path):
+    with _lock:
+        _active.discard(path)
+    try:
+        _empty(path)
+    except OSError, e:
+        logger.warning("Couldn't clean up '%s': %s" % (path, e))
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    with _lock:
+        pooled = _pool.setdefault((location, prefix), [])
+        if sum(len(paths) for paths in _pool.values()) < defaults['staging_pool_size']:
+            pooled.append(path)
+            return
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def workspace(size=None, prefix='fox-', directory=None):
+    """
+    Yield a `Workspace` with room for `size` bytes, removing everything in
+    it when the block exits. With `directory`, the workspace is put there
+    instead of in memory or the default staging directory.
+    """
+    global _memory_in_use
+    location, in_memory = _reserve(size, directory=directory)
+    try:
+        path = _acquire(location, prefix)
+        logger.debug("Staging in '%s'%s" % (path, ' (in memory)' if in_memory else ''))
+        try:
+            yield Workspace(path, location, size=size, in_memory=in_memory)
+        finally:
+            _release(location, prefix, path)
+    finally:
+        if in_memory:
+            with _lock:
+                _memory_in_use -= size
+
+
+def clear_pool():
+    """Remove the pooled directories, and any workspaces still in use."""
+    with _lock:
+        paths = [path for paths in _pool.values() for path in paths] + list(_active)
+        _pool.clear()
+        _active.clear()
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+atexit.register(clear_pool)
@@ -0,0 +1,196 @@
+"""
+Phase-level tracing. Spans nest per thread and record wall time, CPU time
+and arbitrary arguments such as bytes processed or exit codes. `cpu_s` is
+the CPU time of the span's own thread; where that can't be measured (Python
+2 only has it on Linux) `process_cpu_s`, that of all of fox's threads, is
+recorded instead. `child_cpu_s` is that of the subprocesses that exited
+during the span, whichever thread ran them. Recorded spans can be written
+out in the Chrome trace-event format, which chrome://tracing and Perfetto
+can load.
+
+Tracing is off until `enable` is called; until then `span` costs next to
+nothing.
+"""
+
+from contextlib import contextmanager
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+_tracer = None
+_local = threading.local()
+
+# Python 2 doesn't name RUSAGE_THREAD, which is 1 on Linux and missing elsewhere
+if resource is not None and sys.platform.startswith('linux'):
+    RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+else:
+    RUSAGE_THREAD = None
+
+
+def _thread_cpu():
+    """Return the CPU time used by the current thread, or None if it can't
+    be measured."""
+    if RUSAGE_THREAD is None:
+        return None
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Span(object):
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.thread = threading.current_thread()
+        self.start = time.time()
+        self.times = os.times()
+        self.thread_cpu = _thread_cpu()
+        self.end = None
+        self.end_times = None
+        self.end_thread_cpu = None
+
+    def set(self, **args):
+        """Add or update arguments recorded with this span."""
+        self.args.update(args)
+
+    def finish(self):
+        self.end = time.time()
+        self.end_times = os.times()
+        self.end_thread_cpu = _thread_cpu()
+
+    def event(self, origin):
+        child_cpu = (self.end_times[2] + self.end_times[3]) - (self.times[2] + self.times[3])
+        args = dict(self.args)
+        args['child_cpu_s'] = round(child_cpu, 3)
+        if self.thread_cpu is not None:
+            args['cpu_s'] = round(self.end_thread_cpu - self.thread_cpu, 3)
+        else:
+            cpu = (self.end_times[0] + self.end_times[1]) - (self.times[0] + self.times[1])
+            args['process_cpu_s'] = round(cpu, 3)
+        return {
+            'name': self.name,
+            'cat': 'fox',
+            'ph': 'X',
+            'ts': int((self.start - origin) * 1e6),
+            'dur': int((self.end - self.start) * 1e6),
+            'pid': os.getpid(),
+            'tid': self.thread.ident,
+            'args': args,
+        }
+
+
+class _NullSpan(object):
+
+    def set(self, **args):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.origin = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def events(self):
+        with self.lock:
+            spans = list(self.spans)
+        events = [span.event(self.origin) for span in spans]
+        threads = dict((span.thread.ident, span.thread.name) for span in spans)
+        for tid, name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                           'tid': tid, 'args': {'name': name}})
+        return events
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f)
+
+
+def enable():
+    """Start recording spans, and return the `Tracer` they're recorded to."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def enabled():
+    return _tracer is not None
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+@contextmanager
+def span(name, **args):
+    """Record the enclosed block as a span named `name`."""
+    tracer = _tracer
+    if tracer is None:
+        yield _null_span
+        return
+    s = Span(name, args)
+    stack = _stack()
+    stack.append(s)
+    try:
+        yield s
+    except BaseException, e:
+        s.set(error=str(e) or e.__class__.__name__)
+        raise
+    finally:
+        stack.pop()
+        s.finish()
+        tracer.record(s)
+
+
+def traced(name):
+    """Decorator that records each call of the function as a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current():
+    """Return the innermost open span on this thread."""
+    if _tracer is None:
+        return _null_span
+    stack = _stack()
+    return stack[-1] if stack else _null_span
+
+
+def annotate(**args):
+    """Add arguments to the innermost open span on this thread."""
+    current().set(**args)
+
+
+def write(path):
+    if _tracer is not None:
+        _tracer.write(path)
@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+import fcntl
 import os
 import sys
 
@@ -17,3 +19,16 @@ def makedirs(path):
             pass  # directory already exists
         else:
             raise e
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `path`, shared by all processes on this
+    host, for the duration of the block."""
+    makedirs(os.path.dirname(path))
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
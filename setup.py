@@ -1,10 +1,12 @@
 from setuptools import setup, find_packages
 import os
+import re
 
 here = os.path.abspath(os.path.dirname(__file__))
 README = open(os.path.join(here, 'README.rst')).read()
 
-version = '0.1.10'
+with open(os.path.join(here, 'fox', '__init__.py')) as f:
+    version = re.search(r"^__version__ = '([^']+)'", f.read(), re.M).group(1)
 
 install_requires = [
     "toml==0.8.1",